@@ -0,0 +1,484 @@
+# -*- coding: utf-8 -*-
+"""
+所有过滤器的性能测试 内存和redis，同步和asyncio，不同的hash函数、容量和错误率
+每个组合测量: 构建时间，批量加入/判断的吞吐量，单个加入/判断的延迟分位数，内存占用，实际的误判率
+
+python benchmarks/bench_filters.py --json result.json
+python benchmarks/bench_filters.py --json new.json --compare result.json  # 变差超过阈值时退出码为1
+
+redis: 传入--redis-url时使用已有的redis，否则在PATH中找到redis-server时启动一个临时实例，
+都没有时使用fakeredis。fakeredis在python里执行lua，结果只能和同样使用fakeredis的结果比较
+"""
+
+import argparse
+import asyncio
+import contextlib
+import gc
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+import pyfilters
+from pyfilters import (
+    BlockedMemoryBloomFilter,
+    CountMemoryBloomFilter,
+    CuckooMemoryFilter,
+    HashlibHashMap,
+    MemoryBloomFilter,
+    MMH3HashMap,
+    MmapMemoryBloomFilter,
+    PyHashMap,
+    ScalableMemoryBloomFilter,
+    SharedMemoryBloomFilter,
+    XorFilter,
+)
+from pyfilters import asyncio as async_filters
+from pyfilters import redis_storage
+
+HASH_TYPES = {
+    "PyHashMap": PyHashMap,
+    "MMH3HashMap": MMH3HashMap,
+    "HashlibHashMap": HashlibHashMap,
+}
+
+# 内存过滤器 (容量, 错误率, hash函数类型, 临时目录) -> 过滤器
+MEMORY_FILTERS: Dict[str, Callable[..., Any]] = {
+    "MemoryBloomFilter": lambda n, p, h, tmp: MemoryBloomFilter(n, p, h),
+    "BlockedMemoryBloomFilter": lambda n, p, h, tmp: BlockedMemoryBloomFilter(n, p, h),
+    "CountMemoryBloomFilter": lambda n, p, h, tmp: CountMemoryBloomFilter(n, p, h),
+    "CountMemoryBloomFilter(counter_bits=4)": lambda n, p, h, tmp: (
+        CountMemoryBloomFilter(n, p, h, counter_bits=4)
+    ),
+    "ScalableMemoryBloomFilter": lambda n, p, h, tmp: (
+        ScalableMemoryBloomFilter(n, p, h)
+    ),
+    "CuckooMemoryFilter": lambda n, p, h, tmp: CuckooMemoryFilter(n, p, h),
+    "MmapMemoryBloomFilter": lambda n, p, h, tmp: MmapMemoryBloomFilter(
+        os.path.join(tmp, f"bench-{time.perf_counter_ns()}.bf"), n, p, h
+    ),
+    "SharedMemoryBloomFilter": lambda n, p, h, tmp: (
+        SharedMemoryBloomFilter(None, n, p, h)
+    ),
+}
+
+# redis过滤器的类名 同步和asyncio版本的参数相同: (客户端, key, 容量, 错误率, hash函数类型)
+REDIS_FILTERS = [
+    "RedisBloomFilter",
+    "ChunkedRedisBloomFilter",
+    "CountRedisBloomFilter",
+    "ScalableRedisBloomFilter",
+    "CuckooRedisFilter",
+]
+
+# 越大越好的指标 其他的越小越好
+HIGHER_IS_BETTER = {"add_per_s", "contains_per_s"}
+
+
+def _percentiles(samples: List[int]) -> Tuple[float, float, float]:
+    """:return: 纳秒样本的p50, p90, p99 单位微秒"""
+    p50, p90, p99 = np.percentile(np.array(samples) / 1000, [50, 90, 99])
+    return float(p50), float(p90), float(p99)
+
+
+def _release(bloom_filter) -> None:
+    """关闭mmap/共享内存"""
+    if isinstance(bloom_filter, SharedMemoryBloomFilter):
+        bloom_filter.close()
+        bloom_filter.unlink()
+    elif isinstance(bloom_filter, MmapMemoryBloomFilter):
+        bloom_filter.close()
+
+
+def _latency_record(record: dict, name: str, samples: List[int]) -> None:
+    record[f"{name}_p50_us"], record[f"{name}_p90_us"], record[f"{name}_p99_us"] = (
+        _percentiles(samples)
+    )
+
+
+def bench_memory(
+    factory: Callable[[], Any],
+    items: List[str],
+    misses: List[str],
+    batch_size: int,
+    samples: int,
+) -> dict:
+    record: Dict[str, Any] = {}
+    begin = time.perf_counter()
+    bloom_filter = factory()
+    record["construct_s"] = time.perf_counter() - begin
+    try:
+        if not isinstance(bloom_filter, XorFilter):  # 只能在构建时加入
+            begin = time.perf_counter()
+            for start in range(0, len(items), batch_size):
+                bloom_filter.add_many(items[start : start + batch_size])
+            record["add_per_s"] = len(items) / (time.perf_counter() - begin)
+            latency = []
+            for i in range(samples):
+                item = f"latency-{i}"
+                begin = time.perf_counter_ns()
+                bloom_filter.add(item)
+                latency.append(time.perf_counter_ns() - begin)
+            _latency_record(record, "add", latency)
+        begin = time.perf_counter()
+        for start in range(0, len(items), batch_size):
+            bloom_filter.contains_many(items[start : start + batch_size])
+        record["contains_per_s"] = len(items) / (time.perf_counter() - begin)
+        latency = []
+        for item in items[:samples]:
+            begin = time.perf_counter_ns()
+            item in bloom_filter
+            latency.append(time.perf_counter_ns() - begin)
+        _latency_record(record, "contains", latency)
+        record["fpr"] = float(bloom_filter.contains_many(misses).mean())
+    finally:
+        _release(bloom_filter)
+    return record
+
+
+def memory_footprint(factory: Callable[[], Any], items: List[str]) -> int:
+    """加入所有元素之后过滤器占用的内存 单独构建一次，tracemalloc的开销不影响计时"""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        bloom_filter = factory()
+        if not isinstance(bloom_filter, XorFilter):
+            bloom_filter.add_many(items)
+        gc.collect()
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    if isinstance(bloom_filter, (MmapMemoryBloomFilter, SharedMemoryBloomFilter)):
+        size += bloom_filter.bitarray.nbytes  # 映射的内存不经过python的分配器
+    _release(bloom_filter)
+    return size
+
+
+def redis_footprint(client, prefix: str) -> int:
+    """prefix开头的所有key占用的内存 不支持MEMORY USAGE时(比如fakeredis)用数据的长度代替"""
+    import redis
+
+    total = 0
+    for key in client.scan_iter(match=prefix + "*"):
+        try:
+            total += client.memory_usage(key) or 0
+        except redis.ResponseError:
+            if client.type(key) == b"hash":
+                fields = client.hgetall(key).items()
+                total += sum(len(field) + len(value) for field, value in fields)
+            else:
+                total += client.strlen(key)
+    return total
+
+
+def _delete_prefix(client, prefix: str) -> None:
+    keys = list(client.scan_iter(match=prefix + "*"))
+    if keys:
+        client.delete(*keys)
+
+
+def bench_redis(
+    factory: Callable[[], Any],
+    items: List[str],
+    misses: List[str],
+    batch_size: int,
+    samples: int,
+) -> dict:
+    record: Dict[str, Any] = {}
+    begin = time.perf_counter()
+    bloom_filter = factory()
+    bloom_filter.clear()
+    record["construct_s"] = time.perf_counter() - begin
+    begin = time.perf_counter()
+    bloom_filter.add_many(items, batch_size)
+    record["add_per_s"] = len(items) / (time.perf_counter() - begin)
+    latency = []
+    for i in range(samples):
+        begin = time.perf_counter_ns()
+        bloom_filter.add(f"latency-{i}")
+        latency.append(time.perf_counter_ns() - begin)
+    _latency_record(record, "add", latency)
+    begin = time.perf_counter()
+    bloom_filter.contains_many(items, batch_size)
+    record["contains_per_s"] = len(items) / (time.perf_counter() - begin)
+    latency = []
+    for item in items[:samples]:
+        begin = time.perf_counter_ns()
+        item in bloom_filter
+        latency.append(time.perf_counter_ns() - begin)
+    _latency_record(record, "contains", latency)
+    record["fpr"] = float(bloom_filter.contains_many(misses, batch_size).mean())
+    return record
+
+
+async def bench_async(
+    factory: Callable[[], Any],
+    items: List[str],
+    misses: List[str],
+    batch_size: int,
+    samples: int,
+) -> dict:
+    record: Dict[str, Any] = {}
+    begin = time.perf_counter()
+    bloom_filter = factory()
+    await bloom_filter.clear()
+    record["construct_s"] = time.perf_counter() - begin
+    begin = time.perf_counter()
+    await bloom_filter.add_many(items, batch_size)
+    record["add_per_s"] = len(items) / (time.perf_counter() - begin)
+    latency = []
+    for i in range(samples):
+        begin = time.perf_counter_ns()
+        await bloom_filter.add(f"latency-{i}")
+        latency.append(time.perf_counter_ns() - begin)
+    _latency_record(record, "add", latency)
+    begin = time.perf_counter()
+    await bloom_filter.contains_many(items, batch_size)
+    record["contains_per_s"] = len(items) / (time.perf_counter() - begin)
+    latency = []
+    for item in items[:samples]:
+        begin = time.perf_counter_ns()
+        await bloom_filter.contains(item)
+        latency.append(time.perf_counter_ns() - begin)
+    _latency_record(record, "contains", latency)
+    record["fpr"] = float((await bloom_filter.contains_many(misses, batch_size)).mean())
+    return record
+
+
+@contextlib.contextmanager
+def redis_backend(url: Optional[str]) -> Iterator[Tuple[str, Any, Callable[[], Any]]]:
+    """
+    :return: 后端的名字, 同步客户端, 创建asyncio客户端的函数(每个事件循环一个)
+    """
+    import redis
+    import redis.asyncio
+
+    if url:
+        yield url, redis.Redis.from_url(url), lambda: redis.asyncio.Redis.from_url(url)
+        return
+    server = shutil.which("redis-server")
+    if server is None:
+        import fakeredis
+
+        fake = fakeredis.FakeServer()
+        yield (
+            "fakeredis",
+            fakeredis.FakeRedis(server=fake),
+            lambda: fakeredis.FakeAsyncRedis(server=fake),
+        )
+        return
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    process = subprocess.Popen(
+        [server, "--port", str(port), "--save", "", "--appendonly", "no"],
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        client = redis.Redis(port=port)
+        for _ in range(100):
+            try:
+                client.ping()
+                break
+            except redis.ConnectionError:
+                time.sleep(0.05)
+        yield "redis-server", client, lambda: redis.asyncio.Redis(port=port)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def run_cases(args: argparse.Namespace) -> List[dict]:
+    results = []
+
+    def report(record: dict) -> None:
+        results.append(record)
+        print(
+            f"{record['storage']:<14}{record['filter']:<40}{record['hash']:<16}"
+            f"n={record['capacity']:<9}p={record['error_rate']:<8}"
+            f"add={record.get('add_per_s', 0):>12,.0f}/s "
+            f"contains={record['contains_per_s']:>12,.0f}/s "
+            f"mem={record['memory_bytes'] or 0:>12,}B",
+            flush=True,
+        )
+
+    def selected(name: str) -> bool:
+        return not args.filters or any(part in name for part in args.filters)
+
+    with contextlib.ExitStack() as stack:
+        tmp = stack.enter_context(tempfile.TemporaryDirectory())
+        if {"redis", "asyncio"} & set(args.storage):
+            backend, client, async_client = stack.enter_context(
+                redis_backend(args.redis_url)
+            )
+            print(f"redis backend: {backend}")
+        for capacity in args.capacity:
+            count = min(capacity, args.items)
+            items = [str(i) for i in range(count)]
+            misses = [str(i) for i in range(count, 2 * count)]
+            for error_rate in args.error_rate:
+                for hash_name in args.hash:
+                    hash_type = HASH_TYPES[hash_name]
+                    case = {
+                        "hash": hash_name,
+                        "capacity": capacity,
+                        "error_rate": error_rate,
+                        "items": count,
+                    }
+                    factories = {}
+                    if "memory" in args.storage:
+                        for name, make in MEMORY_FILTERS.items():
+                            factories[name] = lambda make=make: make(
+                                capacity, error_rate, hash_type, tmp
+                            )
+                        factories["XorFilter"] = lambda: XorFilter(
+                            items, error_rate, hash_type
+                        )
+                    for name, factory in factories.items():
+                        if not selected(name):
+                            continue
+                        record = bench_memory(
+                            factory, items, misses, args.batch, args.samples
+                        )
+                        record["memory_bytes"] = memory_footprint(factory, items)
+                        report(dict(case, filter=name, storage="memory", **record))
+                    for name in REDIS_FILTERS:
+                        if not selected(name):
+                            continue
+                        prefix = f"bench:{name}:{hash_name}:{capacity}:{error_rate}"
+                        if "redis" in args.storage:
+                            cls = getattr(redis_storage, name)
+                            record = bench_redis(
+                                lambda: cls(
+                                    client, prefix, capacity, error_rate, hash_type
+                                ),
+                                items,
+                                misses,
+                                args.batch,
+                                args.samples,
+                            )
+                            record["memory_bytes"] = redis_footprint(client, prefix)
+                            _delete_prefix(client, prefix)
+                            record["backend"] = backend
+                            report(dict(case, filter=name, storage="redis", **record))
+                        if "asyncio" in args.storage:
+                            cls = getattr(async_filters, name)
+                            record = asyncio.run(
+                                bench_async(
+                                    lambda: cls(
+                                        async_client(),
+                                        prefix,
+                                        capacity,
+                                        error_rate,
+                                        hash_type,
+                                    ),
+                                    items,
+                                    misses,
+                                    args.batch,
+                                    args.samples,
+                                )
+                            )
+                            record["memory_bytes"] = redis_footprint(client, prefix)
+                            _delete_prefix(client, prefix)
+                            record["backend"] = backend
+                            report(dict(case, filter=name, storage="asyncio", **record))
+    return results
+
+
+def _case_key(record: dict) -> tuple:
+    return (
+        record["storage"],
+        record.get("backend"),  # 真实的redis和fakeredis的结果不能比较
+        record["filter"],
+        record["hash"],
+        record["capacity"],
+        record["error_rate"],
+    )
+
+
+def compare(results: List[dict], baseline: List[dict], threshold: float) -> int:
+    """
+    与之前的结果比较 按指标的方向判断，变差超过threshold的打印出来
+    :return: 变差的指标个数
+    """
+    old = {_case_key(record): record for record in baseline}
+    regressions = 0
+    for record in results:
+        before = old.get(_case_key(record))
+        if before is None:
+            continue
+        for metric, value in record.items():
+            if not metric.endswith(("_s", "_us", "_bytes")) or not before.get(metric):
+                continue
+            change = value / before[metric] - 1
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            if worse > threshold:
+                regressions += 1
+                case = " ".join(str(part) for part in _case_key(record) if part)
+                print(
+                    f"REGRESSION {case} "
+                    f"{metric}: {before[metric]:.6g} -> {value:.6g} ({change:+.1%})"
+                )
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--capacity", type=int, nargs="+", default=[100000])
+    parser.add_argument("--error-rate", type=float, nargs="+", default=[0.001])
+    parser.add_argument(
+        "--hash", nargs="+", choices=list(HASH_TYPES), default=list(HASH_TYPES)
+    )
+    parser.add_argument(
+        "--storage",
+        nargs="+",
+        choices=["memory", "redis", "asyncio"],
+        default=["memory", "redis", "asyncio"],
+    )
+    parser.add_argument("--filters", nargs="*", help="只测试名字包含这些字符串的过滤器")
+    parser.add_argument(
+        "--items", type=int, default=20000, help="加入的元素个数 不超过容量"
+    )
+    parser.add_argument("--batch", type=int, default=1000, help="批量操作每批的个数")
+    parser.add_argument("--samples", type=int, default=1000, help="测量延迟的次数")
+    parser.add_argument(
+        "--redis-url", help="使用已有的redis 比如redis://localhost:6379/0"
+    )
+    parser.add_argument("--json", help="结果写入这个文件")
+    parser.add_argument("--compare", help="与之前--json写入的结果比较")
+    parser.add_argument(
+        "--threshold", type=float, default=0.1, help="变差超过这个比例算退化"
+    )
+    args = parser.parse_args()
+    results = run_cases(args)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "pyfilters": pyfilters.__version__,
+                    "python": platform.python_version(),
+                    "numpy": np.__version__,
+                    "machine": platform.machine(),
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+多线程共享一个内存过滤器的吞吐量
+python benchmarks/bench_threads.py [元素个数] [每批元素个数]
+在free-threaded的python(python3.13t)上运行才能看到多核的扩展，普通的python受GIL限制
+"""
+
+import sys
+import threading
+import time
+
+from pyfilters import (
+    BlockedMemoryBloomFilter,
+    CountMemoryBloomFilter,
+    MemoryBloomFilter,
+)
+
+
+def run(bloom_filter, threads: int, total: int, batch_size: int) -> float:
+    """
+    每个线程加入total/threads个元素，再判断一遍
+    :return: 每秒处理的元素个数
+    """
+    per_thread = total // threads
+
+    def work(start: int) -> None:
+        for i in range(start, start + per_thread, batch_size):
+            bloom_filter.add_many(range(i, min(i + batch_size, start + per_thread)))
+        for i in range(start, start + per_thread, batch_size):
+            bloom_filter.contains_many(
+                range(i, min(i + batch_size, start + per_thread))
+            )
+
+    workers = [
+        threading.Thread(target=work, args=(i * per_thread,)) for i in range(threads)
+    ]
+    begin = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - begin
+    return 2 * per_thread * threads / elapsed
+
+
+def main() -> None:
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 10**6
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    gil = getattr(sys, "_is_gil_enabled", lambda: True)()
+    print(f"python {sys.version.split()[0]} gil={gil} total={total} batch={batch_size}")
+    factories = {
+        "MemoryBloomFilter": lambda: MemoryBloomFilter(total, 0.0001, stripes=64),
+        "BlockedMemoryBloomFilter": lambda: BlockedMemoryBloomFilter(
+            total, 0.0001, stripes=64
+        ),
+        "CountMemoryBloomFilter": lambda: CountMemoryBloomFilter(
+            total, 0.0001, counter_bits=4, stripes=64
+        ),
+    }
+    for name, factory in factories.items():
+        for threads in (1, 2, 4, 8, 16):
+            rate = run(factory(), threads, total, batch_size)
+            print(f"{name:<26}threads={threads:<4}{rate:>14,.0f} items/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,66 @@
 # -*- coding: utf-8 -*-
-from pyfilters.abc import BaseBloomFilter, BaseHash
+from pyfilters.abc import BaseBloomFilter, BaseCuckooFilter, BaseHash
+from pyfilters.buffer import BufferedFilter
+from pyfilters.bulk import build_parallel
+from pyfilters.cache import PositiveCache
 from pyfilters.hashmap import HashlibHashMap, MMH3HashMap, PyHashMap
-from pyfilters.memory_storage import CountMemoryBloomFilter, MemoryBloomFilter
+from pyfilters.health import HealthMonitor
+from pyfilters.memory_storage import (
+    BlockedMemoryBloomFilter,
+    CountMemoryBloomFilter,
+    CuckooMemoryFilter,
+    MemoryBloomFilter,
+    MmapMemoryBloomFilter,
+    ScalableMemoryBloomFilter,
+    SharedMemoryBloomFilter,
+    XorFilter,
+)
+from pyfilters.metrics import (
+    CallbackSink,
+    InstrumentedFilter,
+    MetricsSink,
+    OpenTelemetrySink,
+    PrometheusSink,
+    StatsSink,
+)
 from pyfilters.redis_storage import (
     ChunkedRedisBloomFilter,
     CountRedisBloomFilter,
+    CuckooRedisFilter,
     RedisBloomFilter,
+    ScalableRedisBloomFilter,
 )
 
 __all__ = [
     "MemoryBloomFilter",
     "CountMemoryBloomFilter",
+    "MmapMemoryBloomFilter",
+    "SharedMemoryBloomFilter",
+    "BlockedMemoryBloomFilter",
+    "ScalableMemoryBloomFilter",
+    "CuckooMemoryFilter",
+    "XorFilter",
     "RedisBloomFilter",
     "ChunkedRedisBloomFilter",
     "CountRedisBloomFilter",
+    "ScalableRedisBloomFilter",
+    "CuckooRedisFilter",
+    "PositiveCache",
+    "BufferedFilter",
+    "build_parallel",
+    "HealthMonitor",
+    "InstrumentedFilter",
+    "MetricsSink",
+    "CallbackSink",
+    "StatsSink",
+    "PrometheusSink",
+    "OpenTelemetrySink",
     "PyHashMap",
     "MMH3HashMap",
     "HashlibHashMap",
     "BaseHash",
     "BaseBloomFilter",
+    "BaseCuckooFilter",
 ]
 
 __author__ = "synodriver"
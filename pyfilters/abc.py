@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 from abc import ABC, abstractmethod
-from typing import List
+from typing import Iterable, List, Optional, Tuple, Type
 
+import numpy as np
 from _collections_abc import _check_methods
 
+from pyfilters.metrics import timed_hash
+from pyfilters.utils import calculation_cuckoo_filter
+
 
 class BaseBloomFilter(ABC):
     """Base BloomFilter"""
@@ -111,6 +115,44 @@ class BaseBloomFilter(ABC):
         518,
     ]
 
+    double_hashing: bool = False  # 是否只计算一次摘要推导出k个偏移量
+
+    @timed_hash
+    def _offsets(self, item: str) -> Iterable[int]:
+        """
+        计算元素的k个偏移量
+        double_hashing模式下只计算一次128位摘要，用 h1 + i*h2 mod m 推导出k个偏移量(Kirsch–Mitzenmacher)
+        否则每个种子都完整hash一次，兼容已有的数据
+        """
+        if self.double_hashing:
+            h1, h2 = self.hashmaps[0].hash128(item)
+            h1 %= self.m
+            h2 = h2 % self.m or 1
+            return [(h1 + i * h2) % self.m for i in range(self.k)]
+        return map(lambda x: x.hash(item), self.hashmaps)
+
+    @timed_hash
+    def _offsets_many(self, items: List[str]) -> np.ndarray:
+        """
+        批量计算偏移量
+        :return: shape为(len(items), k)的数组
+        """
+        if self.double_hashing:
+            digests = np.array(
+                [self.hashmaps[0].hash128(item) for item in items], dtype=np.uint64
+            ).reshape(len(items), 2)
+            h1 = digests[:, 0] % np.uint64(self.m)
+            h2 = digests[:, 1] % np.uint64(self.m)
+            h2[h2 == 0] = 1
+            steps = np.arange(self.k, dtype=np.uint64)
+            return (
+                (h1[:, None] + steps[None, :] * h2[:, None]) % np.uint64(self.m)
+            ).astype(np.int64)
+        return np.array(
+            [[map_.hash(item) for map_ in self.hashmaps] for item in items],
+            dtype=np.int64,
+        ).reshape(len(items), len(self.hashmaps))
+
     @abstractmethod
     def add(self, item):
         """
@@ -133,6 +175,115 @@ class BaseBloomFilter(ABC):
     def __len__(self):
         raise NotImplementedError
 
+    def _health(self) -> Tuple[float, float, int]:
+        """(填充率, 当前的误判率, 估计的元素个数) 每次都由当前的数据重新计算"""
+        raise NotImplementedError
+
+    def fill_ratio(self) -> float:
+        """置位的位数占总位数的比例 计数过滤器是非0的计数器，布谷鸟过滤器是占用的槽"""
+        return self._health()[0]
+
+    def estimated_fpr(self) -> float:
+        """按当前的填充率估计的误判率 超过构造时的error_rate说明已经装满"""
+        return self._health()[1]
+
+    def estimated_items(self) -> int:
+        """由填充率估计的元素个数 多个客户端共享redis中的过滤器时也准确"""
+        return self._health()[2]
+
+
+class BaseCuckooFilter(BaseBloomFilter):
+    """
+    Base Cuckoo filter (Fan et al.)
+    每个元素在两个候选桶之一里保存一个指纹，支持删除，查询最多访问两个桶
+    候选桶 i2 = i1 ^ hash(指纹)，只凭指纹就能算出另一个桶，桶数必须是2的幂
+    内存和redis的实现共用这里的指纹和桶的计算
+    """
+
+    _FINGERPRINT_MIX = 0x5BD1E995  # 把指纹散列成桶的偏移
+
+    def _init_cuckoo(
+        self,
+        capacity: int,
+        error_rate: float,
+        hash_type: "Type[BaseHash]",
+        fingerprint_bits: Optional[int],
+        bucket_size: int,
+        max_kicks: int,
+    ) -> None:
+        """检查参数 计算桶数和指纹位数"""
+        if not (0 < error_rate < 1):
+            raise ValueError("Error_Rate must be between 0 and 1.")
+        if not capacity > 0:
+            raise ValueError("Capacity must be > 0")
+        if fingerprint_bits not in (None, 8, 16, 32):
+            raise ValueError("fingerprint_bits must be 8, 16 or 32")
+        if not bucket_size > 0:
+            raise ValueError("bucket_size must be > 0")
+        buckets, bits = calculation_cuckoo_filter(
+            capacity, error_rate, bucket_size, fingerprint_bits or 0
+        )
+        self.count = 0
+        self.num_buckets = buckets
+        self.bucket_size = bucket_size
+        self.fingerprint_bits = bits
+        self.max_kicks = max_kicks
+        self.seeds = self._seeds.copy()[0:1]
+        self.hashmaps = [hash_type(buckets, self.seeds[0])]
+
+    @property
+    def capacity(self) -> int:
+        """槽的总数"""
+        return self.num_buckets * self.bucket_size
+
+    def _cuckoo_health(self, count: int) -> Tuple[float, float, int]:
+        """
+        由占用的槽数估计状态 判断时比较两个桶的所有槽，每个占用的槽有2^-f的概率指纹相同
+        :param count: 占用的槽数
+        """
+        load = count / self.capacity
+        miss = (1 - 2.0**-self.fingerprint_bits) ** (2 * self.bucket_size * load)
+        return load, 1 - miss, count
+
+    @property
+    def _fingerprint_dtype(self) -> np.dtype:
+        return np.dtype(f"u{self.fingerprint_bits // 8}")
+
+    def _alt_index(self, index: int, fingerprint: int) -> int:
+        return (index ^ (fingerprint * self._FINGERPRINT_MIX)) & (self.num_buckets - 1)
+
+    @timed_hash
+    def _locate(self, item: str) -> Tuple[int, int, int]:
+        """
+        桶取摘要前半的低位，指纹混合前半的高位和后半，避免某一半退化时指纹都一样
+        :return: 两个候选桶, 指纹(不为0)
+        """
+        h1, h2 = self.hashmaps[0].hash128(item)
+        index = h1 & (self.num_buckets - 1)
+        fingerprint = ((h1 >> 32) ^ h2) % ((1 << self.fingerprint_bits) - 1) + 1
+        return index, self._alt_index(index, fingerprint), fingerprint
+
+    @timed_hash
+    def _locate_many(
+        self, items: List[str]
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """批量计算候选桶和指纹 与_locate的结果一致"""
+        digests = np.array(
+            [self.hashmaps[0].hash128(item) for item in items], dtype=np.uint64
+        ).reshape(len(items), 2)
+        mask = np.uint64(self.num_buckets - 1)
+        index = digests[:, 0] & mask
+        fingerprints = (digests[:, 0] >> np.uint64(32)) ^ digests[:, 1]
+        fingerprints %= np.uint64((1 << self.fingerprint_bits) - 1)
+        fingerprints += np.uint64(1)
+        # uint64乘法溢出时回绕，低位与python整数的结果相同
+        alt = (index ^ (fingerprints * np.uint64(self._FINGERPRINT_MIX))) & mask
+        return (
+            index.astype(np.int64),
+            alt.astype(np.int64),
+            fingerprints.astype(self._fingerprint_dtype),
+        )
+
 
 class BaseHash(ABC):
     """Base Hash Functions"""
@@ -144,6 +295,12 @@ class BaseHash(ABC):
     def hash(self, value):
         raise NotImplementedError
 
+    def hash128(self, value) -> Tuple[int, int]:
+        """
+        128位摘要，拆成两个64位无符号整数，供双重哈希使用
+        """
+        raise NotImplementedError
+
     @classmethod
     def __subclasshook__(cls, subclass):
         return _check_methods(cls, "hash")
@@ -1,6 +1,12 @@
 # -*- coding: utf-8 -*-
+from pyfilters.asyncio.buffer import BufferedFilter
+from pyfilters.asyncio.coalesce import CoalescingFilter
+from pyfilters.asyncio.health import HealthMonitor
+from pyfilters.asyncio.metrics import InstrumentedFilter
 from pyfilters.asyncio.redis_storage import (
     ChunkedRedisBloomFilter,
     CountRedisBloomFilter,
+    CuckooRedisFilter,
     RedisBloomFilter,
+    ScalableRedisBloomFilter,
 )
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from pyfilters.abc import BaseBloomFilter
+
+
+class CoalescingFilter:
+    """
+    把并发的单个调用合并成一次批量脚本调用
+    在max_delay秒内到达的调用，或者攒够max_batch_size个时，通过过滤器的xxx_many一次发出，
+    再把结果分发给每个调用者。高并发时N次往返变成一次
+    """
+
+    def __init__(
+        self,
+        bloom_filter: BaseBloomFilter,
+        max_batch_size: int = 512,
+        max_delay: float = 0.001,
+        max_pending: int = 10000,
+    ):
+        """
+        :param bloom_filter: pyfilters.asyncio中的过滤器，需要有add_many/contains_many
+        :param max_batch_size: 每批最多合并的调用数，攒够了立即发出
+        :param max_delay: 第一个调用到达后最多等待的秒数
+        :param max_pending: 最多允许多少个add/remove还没有完成，超出时调用者会等待
+        """
+        if not max_batch_size > 0:
+            raise ValueError("max_batch_size must be > 0")
+        if not max_delay >= 0:
+            raise ValueError("max_delay must be >= 0")
+        if not max_pending > 0:
+            raise ValueError("max_pending must be > 0")
+        self.bloom_filter = bloom_filter
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._pending: Dict[str, List[Tuple[Any, asyncio.Future]]] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._closed = False
+
+    async def add(self, item: Any) -> bool:
+        """
+        加入元素
+        :param item: 一个可以变成str的对象
+        :return: bool 是否插入成功
+        """
+        async with self._write_semaphore():
+            return await self._submit("add", item)
+
+    async def remove(self, item: Any) -> bool:
+        """
+        删除元素 需要过滤器支持remove_many
+        :param item:
+        :return: 是否删除
+        """
+        async with self._write_semaphore():
+            return await self._submit("remove", item)
+
+    async def contains(self, item: Any) -> bool:
+        return await self._submit("contains", item)
+
+    def __len__(self) -> int:
+        raise NotImplementedError("use await self.size() instead")
+
+    async def size(self) -> int:
+        return await self.bloom_filter.size()
+
+    async def flush(self) -> None:
+        """立即发出所有等待中的调用，并等待正在执行的批次完成"""
+        for op in list(self._pending):
+            self._start_batch(op)
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def close(self) -> None:
+        """发出剩余的调用，之后不再接受新的调用"""
+        self._closed = True
+        await self.flush()
+
+    async def __aenter__(self) -> "CoalescingFilter":
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        await self.close()
+
+    def _write_semaphore(self) -> asyncio.Semaphore:
+        """写操作的背压 在第一次写操作时所在的事件循环里创建"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_pending)
+        return self._semaphore
+
+    def _submit(self, op: str, item: Any) -> "asyncio.Future[bool]":
+        if self._closed:
+            raise RuntimeError("CoalescingFilter is closed")
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        pending = self._pending.setdefault(op, [])
+        pending.append((item, future))
+        if len(pending) >= self.max_batch_size:
+            self._start_batch(op)
+        elif op not in self._timers:
+            self._timers[op] = loop.call_later(self.max_delay, self._start_batch, op)
+        return future
+
+    def _start_batch(self, op: str) -> None:
+        timer: Optional[asyncio.TimerHandle] = self._timers.pop(op, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(op, None)
+        if not batch:
+            return
+        task = asyncio.ensure_future(self._run_batch(op, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, op: str, batch: List[Tuple[Any, asyncio.Future]]):
+        try:
+            results = await getattr(self.bloom_filter, op + "_many")(
+                [item for item, _ in batch], batch_size=len(batch)
+            )
+        except asyncio.CancelledError:
+            for _, future in batch:
+                future.cancel()  # 批次被取消(比如flush被取消)时调用者也收到CancelledError，不会一直等待
+            raise
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():  # 调用者可能已经取消
+                future.set_result(bool(result))
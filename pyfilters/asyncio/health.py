@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import inspect
+from typing import Any, Callable, Iterable, Optional
+
+import numpy as np
+
+from pyfilters.abc import BaseBloomFilter
+
+
+class HealthMonitor:
+    """
+    误判率阈值 与pyfilters.health.HealthMonitor一样，包装pyfilters.asyncio中的过滤器
+    callback可以是普通函数，也可以是async函数
+    """
+
+    def __init__(
+        self,
+        bloom_filter: BaseBloomFilter,
+        max_fpr: float,
+        callback: Callable[[BaseBloomFilter, float], Any],
+        check_every: int = 1000,
+    ):
+        """
+        :param bloom_filter: 有estimated_fpr的过滤器
+        :param max_fpr: 误判率的阈值 一般取构造时的error_rate，或者略小一点提前处理
+        :param callback: 超过阈值时调用 返回新的过滤器时换成它
+        :param check_every: 每加入多少个元素检查一次
+        """
+        if not (0 < max_fpr < 1):
+            raise ValueError("max_fpr must be between 0 and 1")
+        if not check_every > 0:
+            raise ValueError("check_every must be > 0")
+        self.bloom_filter = bloom_filter
+        self.max_fpr = max_fpr
+        self.callback = callback
+        self.check_every = check_every
+        self._since_check = 0
+        self._fired = False
+        self._lock: Optional[asyncio.Lock] = None  # 在第一次检查时的事件循环里创建
+
+    async def check(self) -> float:
+        """
+        立即估计误判率，超过阈值时调用callback
+        :return: 估计的误判率 换了过滤器时是原来的过滤器的
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:  # callback还没有返回时不会再次调用
+            self._since_check = 0
+            fpr = await self.bloom_filter.estimated_fpr()
+            if fpr < self.max_fpr:
+                self._fired = False
+            elif not self._fired:
+                self._fired = True
+                replacement = self.callback(self.bloom_filter, fpr)
+                if inspect.isawaitable(replacement):
+                    replacement = await replacement
+                if replacement is not None:
+                    self.bloom_filter = replacement
+                    self._fired = False
+            return fpr
+
+    async def _added(self, count: int) -> None:
+        self._since_check += count
+        if self._since_check >= self.check_every:
+            self._since_check = 0  # 并发的add同时到期时只检查一次
+            await self.check()
+
+    async def add(self, item: Any) -> bool:
+        added = await self.bloom_filter.add(item)
+        await self._added(1)
+        return added
+
+    async def add_many(self, items: Iterable[Any], **kwargs) -> np.ndarray:
+        added = await self.bloom_filter.add_many(items, **kwargs)
+        await self._added(len(added))
+        return added
+
+    def __contains__(self, item: Any) -> bool:
+        raise NotImplementedError("use await self.contains() instead")
+
+    def __len__(self) -> int:
+        raise NotImplementedError("use await self.size() instead")
+
+    def __getattr__(self, name: str):
+        return getattr(self.bloom_filter, name)
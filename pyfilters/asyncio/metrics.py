@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from typing import Any, Callable, Iterable, List, Optional
+
+import numpy as np
+
+from pyfilters.metrics import MetricsSink, finish_operation, start_operation
+from pyfilters.utils import stringify
+
+
+class InstrumentedFilter:
+    """
+    统计过滤器的操作 与pyfilters.metrics.InstrumentedFilter一样，包装pyfilters.asyncio中的过滤器
+    hash耗时和脚本调用记在当前task的contextvar里，并发的操作互不影响
+    """
+
+    def __init__(self, bloom_filter, sink: MetricsSink, name: Optional[str] = None):
+        """
+        :param bloom_filter: pyfilters.asyncio中的任意过滤器
+        :param sink: 统计结果的去向
+        :param name: labels中过滤器的名字 默认是redis的key或者类名
+        """
+        self.bloom_filter = bloom_filter
+        self.sink = sink
+        self.name = name or getattr(bloom_filter, "key", type(bloom_filter).__name__)
+
+    async def _call(self, op: str, method: Callable, items: List[str], **kwargs) -> Any:
+        state = start_operation()
+        result = None
+        try:
+            result = await method(items, **kwargs)
+        finally:
+            labels = {"filter": self.name, "op": op}
+            finish_operation(self.sink, labels, state, len(items), result)
+        return result
+
+    async def _call_one(self, op: str, method: Callable, item: Any) -> Any:
+        return await self._call(op, lambda items: method(items[0]), [item])
+
+    async def add(self, item: Any) -> bool:
+        return await self._call_one("add", self.bloom_filter.add, item)
+
+    async def add_many(self, items: Iterable[Any], **kwargs) -> np.ndarray:
+        return await self._call(
+            "add", self.bloom_filter.add_many, stringify(items), **kwargs
+        )
+
+    async def remove(self, item: Any) -> bool:
+        return await self._call_one("remove", self.bloom_filter.remove, item)
+
+    async def remove_many(self, items: Iterable[Any], **kwargs) -> np.ndarray:
+        return await self._call(
+            "remove", self.bloom_filter.remove_many, stringify(items), **kwargs
+        )
+
+    def __contains__(self, item: Any) -> bool:
+        raise NotImplementedError("use await self.contains() instead")
+
+    async def contains(self, item: Any) -> bool:
+        return await self._call_one("contains", self.bloom_filter.contains, item)
+
+    async def contains_many(self, items: Iterable[Any], **kwargs) -> np.ndarray:
+        return await self._call(
+            "contains", self.bloom_filter.contains_many, stringify(items), **kwargs
+        )
+
+    def __len__(self) -> int:
+        raise NotImplementedError("use await self.size() instead")
+
+    def __getattr__(self, name: str):
+        return getattr(self.bloom_filter, name)
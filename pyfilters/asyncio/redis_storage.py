@@ -1,13 +1,209 @@
 # -*- coding: utf-8 -*-
+import asyncio
 from hashlib import md5
-from typing import Any, Optional, Type
+from itertools import chain, compress
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Type
 
-from pyfilters.abc import BaseBloomFilter, BaseHash
+import numpy as np
+from typing_extensions import Literal
+
+from pyfilters import scripts
+from pyfilters.abc import BaseBloomFilter, BaseCuckooFilter, BaseHash
+from pyfilters.cache import PositiveCache
 from pyfilters.hashmap import MMH3HashMap
-from pyfilters.utils import calculation_bloom_filter
+from pyfilters.metrics import register_script
+from pyfilters.utils import (
+    bloom_health,
+    calculation_bloom_filter,
+    estimate_cardinality,
+    key_slot,
+    same_slot_key,
+    scalable_stage,
+    spread_keys,
+    stringify,
+)
+
+
+def _group_by_node(
+    redis_client, calls: List[Tuple[List[str], list]]
+) -> List[List[int]]:
+    """
+    按第一个key所在的节点给redis cluster上的脚本调用分组
+    :return: 每个节点的调用的下标
+    """
+    groups: Dict[str, List[int]] = {}
+    for i, (keys, _) in enumerate(calls):
+        node = redis_client.get_node_from_key(keys[0])
+        groups.setdefault(node.name, []).append(i)
+    return list(groups.values())
+
+
+async def _execute_cluster(
+    redis_client, script, calls: List[Tuple[List[str], list]]
+) -> list:
+    """
+    在redis cluster上执行多次脚本调用 每个节点一个pipeline，各个节点的pipeline用task并发执行
+    集群的pipeline不支持EVALSHA，用EVAL发送脚本，不依赖各个节点的脚本缓存
+    :return: 每次调用的返回值
+    """
+
+    async def run(indexes: List[int]) -> list:
+        pipe = redis_client.pipeline()
+        for i in indexes:
+            keys, args = calls[i]
+            pipe.eval(script.script, len(keys), *keys, *args)
+        return await pipe.execute()
+
+    groups = _group_by_node(redis_client, calls)
+    results: list = [None] * len(calls)
+    for indexes, values in zip(
+        groups, await asyncio.gather(*(run(indexes) for indexes in groups))
+    ):
+        for i, value in zip(indexes, values):
+            results[i] = value
+    return results
+
+
+async def _execute_scripts(
+    redis_client, script, calls: List[Tuple[List[str], list]]
+) -> list:
+    """
+    执行多次脚本调用 放在一个pipeline里只需要一次往返，每次调用在redis中单独执行
+    redis cluster上按节点分成多个pipeline并发执行
+    :return: 每次调用的返回值
+    """
+    if not calls:
+        return []
+    if len(calls) == 1:
+        return [await script(keys=calls[0][0], args=calls[0][1])]
+    if hasattr(redis_client, "get_node_from_key"):  # redis.asyncio.RedisCluster
+        return await _execute_cluster(redis_client, script, calls)
+    pipe = redis_client.pipeline(transaction=False)
+    for keys, args in calls:
+        await script(keys=keys, args=args, client=pipe)
+    return await pipe.execute()
+
+
+async def _execute_batches(
+    redis_client, script, calls: List[Tuple[List[str], List[int]]]
+) -> np.ndarray:
+    """
+    执行批量脚本
+    :return: 每个元素的结果 布尔数组
+    """
+    results = await _execute_scripts(redis_client, script, calls)
+    return np.array(list(chain.from_iterable(results)), dtype=bool)
+
+
+async def _check_cache(bloom_filter) -> Optional[PositiveCache]:
+    """
+    取出过滤器的本地缓存 超过check_interval时先检查redis中的代数，其他客户端clear过就清空缓存
+    :return: 没有缓存时返回None
+    """
+    cache = bloom_filter.cache
+    if cache is not None and cache.expired():
+        generation = await bloom_filter.redis_client.get(bloom_filter.generation_key)
+        cache.validate(int(generation or 0))
+    return cache
+
+
+async def _clear_generation(bloom_filter) -> None:
+    """clear之后增加redis中的代数，让其他客户端的本地缓存失效"""
+    generation = await bloom_filter.redis_client.incr(bloom_filter.generation_key)
+    if bloom_filter.cache is not None:
+        bloom_filter.cache.validate(int(generation))
+
+
+class _HealthMixin:
+    """
+    asyncio版本的fill_ratio/estimated_fpr/estimated_items 子类提供async的_health
+    说明见pyfilters.abc.BaseBloomFilter
+    """
+
+    async def fill_ratio(self) -> float:
+        return (await self._health())[0]
+
+    async def estimated_fpr(self) -> float:
+        return (await self._health())[1]
+
+    async def estimated_items(self) -> int:
+        return (await self._health())[2]
 
 
-class RedisBloomFilter(BaseBloomFilter):
+class _BitopMixin:
+    """
+    redis位数组过滤器的合并 每个分片一次BITOP脚本调用，所有调用一次往返，数据不经过客户端
+    子类提供_bitop_keys和_bitop_script
+    """
+
+    def _bitop_keys(self) -> Tuple[List[str], List[str]]:
+        """:return: 每个分片的key, 每个分片的计数key"""
+        raise NotImplementedError
+
+    def _params(self) -> tuple:
+        return (
+            type(self),
+            self.m,
+            self.k,
+            list(self.seeds),
+            type(self.hashmaps[0]),
+            self.double_hashing,
+            len(self._bitop_keys()[0]),
+        )
+
+    async def _combine(self, others: Tuple["_BitopMixin", ...], operation: str) -> None:
+        """
+        把其他过滤器的每个分片按位运算到这个过滤器对应的分片上
+        :param operation: OR/AND
+        """
+        for other in others:
+            if other._params() != self._params():
+                raise ValueError("filters are not compatible")
+        keys, count_keys = self._bitop_keys()
+        other_keys = [other._bitop_keys()[0] for other in others]
+        calls = [
+            (
+                [key, count_key] + [chunks[i] for chunks in other_keys],
+                [operation, self.m, self.k],
+            )
+            for i, (key, count_key) in enumerate(zip(keys, count_keys))
+        ]
+        if hasattr(self.redis_client, "get_node_from_key"):
+            for call_keys, _ in calls:
+                if len(set(map(key_slot, call_keys))) > 1:
+                    raise ValueError(
+                        "keys to combine must be in the same cluster slot, "
+                        "give the filters a common hash tag"
+                    )
+        await _execute_scripts(self.redis_client, self._bitop_script, calls)
+
+    async def update(self, *others: "_BitopMixin") -> None:
+        """
+        把其他过滤器的元素合并进来 在redis中用BITOP按位或，和set.update一样原地修改
+        结果写入自己的key，不返回新的过滤器(内存过滤器的union才返回新的过滤器)
+        count按合并后置位的位数估计
+        redis cluster上要合并的key需要在同一个slot，比如key带上相同的hash tag
+        :param others: 类型, m, k, 种子, hash函数类型和分片个数都相同的过滤器
+        """
+        await self._combine(others, "OR")
+
+    async def intersection_update(self, *others: "_BitopMixin") -> None:
+        """
+        只保留同时在其他过滤器中的元素 在redis中用BITOP按位与，和set.intersection_update一样原地修改
+        误判率比直接用交集的元素构建的过滤器高，count按置位的位数估计，各个客户端的本地缓存失效
+        :param others: 类型, m, k, 种子, hash函数类型和分片个数都相同的过滤器
+        """
+        await self._combine(others, "AND")
+        await _clear_generation(self)
+
+    def __ior__(self, other: "_BitopMixin") -> "_BitopMixin":
+        raise NotImplementedError("use await self.update() instead")
+
+    def __iand__(self, other: "_BitopMixin") -> "_BitopMixin":
+        raise NotImplementedError("use await self.intersection_update() instead")
+
+
+class RedisBloomFilter(_BitopMixin, _HealthMixin, BaseBloomFilter):
     """BloomFilter that uses Redis"""
 
     def __init__(
@@ -17,6 +213,8 @@ class RedisBloomFilter(BaseBloomFilter):
         capacity: int,
         error_rate: Optional[float] = 0.001,
         hash_type: Optional[Type[BaseHash]] = MMH3HashMap,
+        double_hashing: Optional[bool] = False,
+        cache: Optional[PositiveCache] = None,
     ):
         """
         Redis简单存储 没有拆分大Key
@@ -24,6 +222,8 @@ class RedisBloomFilter(BaseBloomFilter):
         :param capacity: 容量
         :param error_rate: 错误率
         :param hash_type: hash函数类型
+        :param double_hashing: 只计算一次128位摘要推导出k个偏移量，与默认模式的数据不兼容
+        :param cache: 已知存在的元素的本地缓存，命中时不访问redis。代数保存在key:gen
         """
         if not (0 < error_rate < 1):
             raise ValueError("Error_Rate must be between 0 and 1.")
@@ -31,58 +231,73 @@ class RedisBloomFilter(BaseBloomFilter):
             raise ValueError("Capacity must be > 0")
         self.redis_client = redis_client  # type: redis.asyncio.Redis
         self.key = key
+        # 已插入的元素个数 与key在同一个slot，由加入的脚本原子地更新，所有客户端共享
+        self.count_key = same_slot_key(key, ":count")
+        self.cache = cache
+        # clear的次数 多个客户端的缓存用它判断是否失效
+        self.generation_key = key + ":gen"
 
         m, k, mem, block_num = calculation_bloom_filter(capacity, error_rate)
-        self.count = 0
         self.m = m if m <= (1 << 32) else 1 << 32  # redis string 最大 512MB，即 2^32
         self.k = k  # number of hash functions
         self.seeds = self._seeds.copy()[0:k]
-        self.hashmaps = [hash_type(m, seed) for seed in self.seeds]
-
-        self._add_script = self.redis_client.register_script(
-            """
-            local redis_chunk_key = KEYS[1]
-            for key = 2, #KEYS do
-                redis.call("SETBIT", redis_chunk_key, tonumber(KEYS[key]), 1)
-            end
-            return {ok='OK'}
-            """
-        )
-        self._contains_script = self.redis_client.register_script(
-            """
-           local redis_chunk_key = KEYS[1]
-            for key = 2, #KEYS do
-                local ret = redis.call("GETBIT", redis_chunk_key, tonumber(KEYS[key]))
-                if ret == 0 then
-                    return 0
-                end
-            end
-            return 1
-            """
+        self.double_hashing = bool(double_hashing)
+        if self.double_hashing:
+            self.hashmaps = [hash_type(m, self.seeds[0])]
+        else:
+            self.hashmaps = [hash_type(m, seed) for seed in self.seeds]
+
+        self._add_script = register_script(self.redis_client, scripts.SETBIT_ITEM)
+        self._contains_script = register_script(self.redis_client, scripts.GETBIT_ITEM)
+        self._add_many_script = register_script(self.redis_client, scripts.BATCH_SETBIT)
+        self._contains_many_script = register_script(
+            self.redis_client, scripts.BATCH_GETBIT
         )
+        self._bitop_script = register_script(self.redis_client, scripts.BITOP_MERGE)
 
     async def add(self, item: Any) -> bool:
         """
-        加入元素
+        加入元素 判断和写入在一个脚本里完成，一次往返 缓存命中时说明已经存在，不需要往返
         :param item: 一个可以变成str的对象
         :return: bool 是否插入成功
         """
-        if not await self.contains(item):
-            if not isinstance(item, str):
-                item = str(item)
-            offsets = list(map(lambda x: x.hash(item), self.hashmaps))
-            await self._add_script(keys=[self.key] + offsets)
-            self.count += 1
-            return True
-        return False
+        if not isinstance(item, str):
+            item = str(item)
+        cache = await _check_cache(self)
+        if cache is not None and cache.get(item):
+            return False
+        offsets = list(self._offsets(item))
+        added = await self._add_script(keys=[self.key, self.count_key], args=offsets)
+        if cache is not None:
+            cache.put(item)
+        return bool(added)
 
     async def clear(self) -> None:
         """清空过滤器"""
-        await self.redis_client.delete(self.key)
-        self.count = 0
+        await self.redis_client.delete(self.key, self.count_key)
+        await _clear_generation(self)
 
     def __len__(self) -> int:
-        return self.count
+        raise NotImplementedError("use await self.size() instead")
+
+    async def size(self) -> int:
+        """redis中记录的已插入的元素个数 所有客户端共享"""
+        return int(await self.redis_client.get(self.count_key) or 0)
+
+    async def estimate_cardinality(self) -> float:
+        """
+        由BITCOUNT估计过滤器中的元素个数 不依赖计数，其他方式写入的数据也能估计
+        :return: 估计的元素个数
+        """
+        bits = await self.redis_client.bitcount(self.key)
+        return estimate_cardinality(self.m, self.k, bits)
+
+    async def _health(self) -> Tuple[float, float, int]:
+        bits = await self.redis_client.bitcount(self.key)
+        return bloom_health([(self.m, self.k, bits)])
+
+    def _bitop_keys(self) -> Tuple[List[str], List[str]]:
+        return [self.key], [self.count_key]
 
     def __contains__(self, item: Any) -> bool:
         raise NotImplementedError("use await self.contains() instead")
@@ -90,12 +305,67 @@ class RedisBloomFilter(BaseBloomFilter):
     async def contains(self, item: Any) -> bool:
         if not isinstance(item, str):
             item = str(item)
-        offsets = list(map(lambda x: x.hash(item), self.hashmaps))
-        result = await self._contains_script(keys=[self.key] + offsets)
-        return bool(result)
+        cache = await _check_cache(self)
+        if cache is not None and cache.get(item):
+            return True
+        offsets = list(self._offsets(item))
+        result = bool(await self._contains_script(keys=[self.key], args=offsets))
+        if result and cache is not None:
+            cache.put(item)
+        return result
+
+    async def _run(self, script, items: List[str], batch_size: int) -> np.ndarray:
+        """执行批量脚本"""
+        calls = scripts.pack_batch_args(
+            [self.key] * len(items), self._offsets_many(items), batch_size
+        )
+        if script is self._add_many_script:
+            calls = scripts.with_count_keys(calls, lambda key: self.count_key)
+        return await _execute_batches(self.redis_client, script, calls)
 
+    async def add_many(
+        self, items: Iterable[Any], batch_size: int = 1000
+    ) -> np.ndarray:
+        """
+        批量加入元素 每batch_size个元素打包成一次脚本调用，所有调用一次往返
+        :param items: 可迭代对象，元素需可以变成str
+        :param batch_size: 每次脚本调用最多处理的元素个数
+        :return: 布尔数组 每个元素是否插入成功
+        """
+        items = stringify(items)
+        cache = await _check_cache(self)
+        if cache is None:
+            result = await self._run(self._add_many_script, items, batch_size)
+        else:
+            hit = cache.get_many(items)
+            missed = list(compress(items, ~hit))
+            result = np.zeros(len(items), dtype=bool)
+            result[~hit] = await self._run(self._add_many_script, missed, batch_size)
+            cache.put_many(missed)
+        return result
+
+    async def contains_many(
+        self, items: Iterable[Any], batch_size: int = 1000
+    ) -> np.ndarray:
+        """
+        批量判断元素是否存在 只有缓存没有命中的元素需要访问redis
+        :param items: 可迭代对象，元素需可以变成str
+        :param batch_size: 每次脚本调用最多处理的元素个数
+        :return: 布尔数组
+        """
+        items = stringify(items)
+        cache = await _check_cache(self)
+        if cache is None:
+            return await self._run(self._contains_many_script, items, batch_size)
+        result = cache.get_many(items)
+        missed = list(compress(items, ~result))
+        found = await self._run(self._contains_many_script, missed, batch_size)
+        result[~result] = found
+        cache.put_many(compress(missed, found))
+        return result
 
-class ChunkedRedisBloomFilter(BaseBloomFilter):
+
+class ChunkedRedisBloomFilter(_BitopMixin, _HealthMixin, BaseBloomFilter):
     """BloomFilter that uses Redis, Chunk big keys"""
 
     def __init__(
@@ -105,6 +375,10 @@ class ChunkedRedisBloomFilter(BaseBloomFilter):
         capacity: int,
         error_rate: Optional[float] = 0.001,
         hash_type: Optional[Type[BaseHash]] = MMH3HashMap,
+        double_hashing: Optional[bool] = False,
+        cluster: Optional[bool] = False,
+        chunk_num: Optional[int] = None,
+        cache: Optional[PositiveCache] = None,
     ):
         """
         Redis简单存储 会拆分大Key
@@ -112,23 +386,43 @@ class ChunkedRedisBloomFilter(BaseBloomFilter):
         :param capacity: 容量
         :param error_rate: 错误率
         :param hash_type: hash函数类型
+        :param double_hashing: 只计算一次128位摘要推导出k个偏移量，与默认模式的数据不兼容
+        :param cluster: redis cluster模式 分片的key带上hash tag，均匀地分布在各个slot上，
+                        批量操作按分片拆分脚本调用。与默认模式的key不兼容
+        :param chunk_num: 分片个数 默认只在超过512MB时分片，指定后按分片个数平分m，
+                          cluster模式下分片越多，越能分散到所有节点上。最多4096个
+        :param cache: 已知存在的元素的本地缓存，命中时不访问redis。代数保存在key:gen
         """
         if not (0 < error_rate < 1):
             raise ValueError("Error_Rate must be between 0 and 1.")
         if not capacity > 0:
             raise ValueError("Capacity must be > 0")
+        if chunk_num is not None and not (0 < chunk_num <= 4096):
+            raise ValueError("chunk_num must be between 1 and 4096")
         self.redis_client = redis_client  # redis server
         self.key = key
+        self.cache = cache
+        # clear的次数 多个客户端的缓存用它判断是否失效
+        self.generation_key = key + ":gen"
 
         m, k, mem, block_num = calculation_bloom_filter(capacity, error_rate)
-        self.count = 0
+        if chunk_num is not None:
+            block_num = max(block_num, chunk_num)
+            m = -(-m // block_num)  # 每个分片只保存一部分元素
         self.m = m if m <= (1 << 32) else 1 << 32  # redis string 最大 512MB，即 2^32
         self.k = k  # number of hash functions 哈希函数的个数，与种子数一样
         self.block_num = block_num  # number of memory blocks 需要的内存块数量
         self.seeds = self._seeds.copy()[0:k]
-        self.hashmaps = [hash_type(m, seed) for seed in self.seeds]
+        self.double_hashing = bool(double_hashing)
+        if self.double_hashing:
+            self.hashmaps = [hash_type(m, self.seeds[0])]
+        else:
+            self.hashmaps = [hash_type(m, seed) for seed in self.seeds]
 
-        if block_num <= 256:
+        if chunk_num is not None:
+            # 分片个数不一定整除256/4096，取32位再取模，各个分片的元素个数才均匀
+            self.value_split_num = 8
+        elif block_num <= 256:
             self.value_split_num = 2  # 0-255
         else:
             self.value_split_num = 3  # 0-4095
@@ -137,63 +431,81 @@ class ChunkedRedisBloomFilter(BaseBloomFilter):
         # 这样，每一个value会落在不同的key上，绕过一个string只能2^32位长度(512Mb)的限制
         # 计算方式:对给定的value,计算一次md5,转换16进制，取前value_split_num位十六进制数转换10进制，对block_num取模，就是给定的后缀
         # 按照上述算法，可见，这里限制最大分key数量为4096  K大说最好10000以下，除非有设置过期
-        self._add_script = self.redis_client.register_script(
-            """
-            local redis_chunk_key = KEYS[1]
-            for key = 2, #KEYS do
-                redis.call("SETBIT", redis_chunk_key, tonumber(KEYS[key]), 1)
-            end
-            return {ok='OK'}
-            """
-        )
-        self._contains_script = self.redis_client.register_script(
-            """
-           local redis_chunk_key = KEYS[1]
-            for key = 2, #KEYS do
-                local ret = redis.call("GETBIT", redis_chunk_key, tonumber(KEYS[key]))
-                if ret == 0 then
-                    return 0
-                end
-            end
-            return 1
-            """
+        # cluster模式下分片的key是key:suffix:{tag}，tag让各个分片落在间隔均匀的slot上
+        self.cluster = bool(cluster)
+        if self.cluster:
+            self.chunk_keys = spread_keys(key, min(block_num, 4096))
+        else:
+            self.chunk_keys = [f"{key}:{i}" for i in range(min(block_num, 4096))]
+        # 每个分片的元素个数 与分片在同一个slot，由加入的脚本原子地更新
+        self.count_keys = {
+            chunk_key: same_slot_key(chunk_key, ":count")
+            for chunk_key in self.chunk_keys
+        }
+        self._add_script = register_script(self.redis_client, scripts.SETBIT_ITEM)
+        self._contains_script = register_script(self.redis_client, scripts.GETBIT_ITEM)
+        self._add_many_script = register_script(self.redis_client, scripts.BATCH_SETBIT)
+        self._contains_many_script = register_script(
+            self.redis_client, scripts.BATCH_GETBIT
         )
+        self._bitop_script = register_script(self.redis_client, scripts.BITOP_MERGE)
 
     async def add(self, item: Any) -> bool:
         """
-        加入元素
+        加入元素 判断和写入在一个脚本里完成，一次往返
         :param item: 一个可以变成str的对象
         :return: bool 是否插入成功
         """
-        if not await self.contains(item):
-            if not isinstance(item, str):
-                item = str(item)
-            redis_chunk_key = (
-                self.key
-                + ":"
-                + str(
-                    int(md5(item.encode()).hexdigest()[0 : self.value_split_num], 16)
-                    % self.block_num
-                )
-            )  # 计算分片key的值 后缀是:0,1...
-            offsets = list(map(lambda x: x.hash(item), self.hashmaps))
-            await self._add_script(keys=[redis_chunk_key] + offsets)  # todo return?
-            self.count += 1
-            return True
-        return False
+        if not isinstance(item, str):
+            item = str(item)
+        cache = await _check_cache(self)
+        if cache is not None and cache.get(item):
+            return False
+        redis_chunk_key = self._chunk_key(item)  # 计算分片key的值 后缀是:0,1...
+        offsets = list(self._offsets(item))
+        added = await self._add_script(
+            keys=[redis_chunk_key, self.count_keys[redis_chunk_key]], args=offsets
+        )
+        if cache is not None:
+            cache.put(item)
+        return bool(added)
 
     async def clear(self) -> None:
         """清空过滤器"""
-        await self.redis_client.delete(
-            *(
-                self.key + ":" + str(i)
-                for i in range(self.block_num if self.block_num <= 4096 else 4096)
-            )
-        )
-        self.count = 0
+        await self.redis_client.delete(*self.chunk_keys, *self.count_keys.values())
+        await _clear_generation(self)
+
+    async def _chunk_values(self, command: str, keys: List[str]) -> list:
+        """在一个pipeline里对每个分片执行一次命令"""
+        pipe = self.redis_client.pipeline(transaction=False)
+        for key in keys:
+            getattr(pipe, command)(key)
+        return await pipe.execute()
 
     def __len__(self) -> int:
-        return self.count
+        raise NotImplementedError("use await self.size() instead")
+
+    async def size(self) -> int:
+        """redis中记录的已插入的元素个数 所有分片的计数一次往返"""
+        counts = await self._chunk_values("get", list(self.count_keys.values()))
+        return sum(int(count or 0) for count in counts)
+
+    async def estimate_cardinality(self) -> float:
+        """
+        由每个分片的BITCOUNT估计过滤器中的元素个数 所有分片一次往返
+        :return: 估计的元素个数
+        """
+        return sum(
+            estimate_cardinality(self.m, self.k, bits)
+            for bits in await self._chunk_values("bitcount", self.chunk_keys)
+        )
+
+    async def _health(self) -> Tuple[float, float, int]:
+        bits = await self._chunk_values("bitcount", self.chunk_keys)
+        return bloom_health([(self.m, self.k, value) for value in bits])
+
+    def _bitop_keys(self) -> Tuple[List[str], List[str]]:
+        return self.chunk_keys, [self.count_keys[key] for key in self.chunk_keys]
 
     def __contains__(self, item: Any) -> bool:
         raise NotImplementedError("use await self.contains() instead")
@@ -201,20 +513,94 @@ class ChunkedRedisBloomFilter(BaseBloomFilter):
     async def contains(self, item: Any) -> bool:
         if not isinstance(item, str):
             item = str(item)
-        redis_chunk_key = (
-            self.key
-            + ":"
-            + str(
-                int(md5(item.encode()).hexdigest()[0 : self.value_split_num], 16)
-                % self.block_num
-            )
+        cache = await _check_cache(self)
+        if cache is not None and cache.get(item):
+            return True
+        redis_chunk_key = self._chunk_key(item)
+        offsets = list(self._offsets(item))
+        result = bool(await self._contains_script(keys=[redis_chunk_key], args=offsets))
+        if result and cache is not None:
+            cache.put(item)
+        return result
+
+    def _chunk_key(self, item: str) -> str:
+        """计算元素所在分片的key"""
+        return self.chunk_keys[
+            int(md5(item.encode()).hexdigest()[0 : self.value_split_num], 16)
+            % self.block_num
+        ]
+
+    def _pack(
+        self, items: List[str], batch_size: int
+    ) -> Tuple[List[Tuple[List[str], List[int]]], Optional[np.ndarray]]:
+        """
+        生成每次批量脚本调用的keys和args
+        cluster模式下按分片排序，每次调用只访问一个分片
+        :return: 脚本调用, 排序用的下标 结果按它放回原来的顺序，不排序时为None
+        """
+        item_keys = list(map(self._chunk_key, items))
+        offsets = self._offsets_many(items)
+        if not self.cluster:
+            return scripts.pack_batch_args(item_keys, offsets, batch_size), None
+        order = np.argsort(np.array(item_keys), kind="stable")
+        calls = scripts.pack_batch_args(
+            [item_keys[i] for i in order], offsets[order], batch_size, True
         )
-        offsets = list(map(lambda x: x.hash(item), self.hashmaps))
-        result = await self._contains_script(keys=[redis_chunk_key] + offsets)
-        return bool(result)
+        return calls, order
 
+    async def _run(self, script, items: List[str], batch_size: int) -> np.ndarray:
+        """执行批量脚本 结果按元素原来的顺序返回"""
+        calls, order = self._pack(items, batch_size)
+        if script is self._add_many_script:
+            calls = scripts.with_count_keys(calls, self.count_keys.__getitem__)
+        result = await _execute_batches(self.redis_client, script, calls)
+        if order is not None:
+            result[order] = result.copy()
+        return result
 
-class CountRedisBloomFilter(BaseBloomFilter):
+    async def add_many(
+        self, items: Iterable[Any], batch_size: int = 1000
+    ) -> np.ndarray:
+        """
+        批量加入元素 每batch_size个元素打包成一次脚本调用，所有调用一次往返
+        :param items: 可迭代对象，元素需可以变成str
+        :param batch_size: 每次脚本调用最多处理的元素个数
+        :return: 布尔数组 每个元素是否插入成功
+        """
+        items = stringify(items)
+        cache = await _check_cache(self)
+        if cache is None:
+            result = await self._run(self._add_many_script, items, batch_size)
+        else:
+            hit = cache.get_many(items)
+            missed = list(compress(items, ~hit))
+            result = np.zeros(len(items), dtype=bool)
+            result[~hit] = await self._run(self._add_many_script, missed, batch_size)
+            cache.put_many(missed)
+        return result
+
+    async def contains_many(
+        self, items: Iterable[Any], batch_size: int = 1000
+    ) -> np.ndarray:
+        """
+        批量判断元素是否存在 只有缓存没有命中的元素需要访问redis
+        :param items: 可迭代对象，元素需可以变成str
+        :param batch_size: 每次脚本调用最多处理的元素个数
+        :return: 布尔数组
+        """
+        items = stringify(items)
+        cache = await _check_cache(self)
+        if cache is None:
+            return await self._run(self._contains_many_script, items, batch_size)
+        result = cache.get_many(items)
+        missed = list(compress(items, ~result))
+        found = await self._run(self._contains_many_script, missed, batch_size)
+        result[~result] = found
+        cache.put_many(compress(missed, found))
+        return result
+
+
+class CountRedisBloomFilter(_HealthMixin, BaseBloomFilter):
     """
     BloomFilter that uses Redis, capable of remove elements
     使用hashmap来代替，避免产生大量key
@@ -227,6 +613,7 @@ class CountRedisBloomFilter(BaseBloomFilter):
         capacity: int,
         error_rate: Optional[float] = 0.001,
         hash_type: Optional[Type[BaseHash]] = MMH3HashMap,
+        double_hashing: Optional[bool] = False,
     ):
         """
         Redis key当做counter
@@ -234,6 +621,7 @@ class CountRedisBloomFilter(BaseBloomFilter):
         :param capacity: 容量
         :param error_rate: 错误率
         :param hash_type: hash函数类型
+        :param double_hashing: 只计算一次128位摘要推导出k个偏移量，与默认模式的数据不兼容
         """
         if not (0 < error_rate < 1):
             raise ValueError("Error_Rate must be between 0 and 1.")
@@ -241,98 +629,78 @@ class CountRedisBloomFilter(BaseBloomFilter):
             raise ValueError("Capacity must be > 0")
         self.redis_client = redis_client  # redis server
         self.key = key
+        # 已插入的元素个数 与key在同一个slot，由加入和删除的脚本原子地更新，所有客户端共享
+        self.count_key = same_slot_key(key, ":count")
 
         m, k, mem, block_num = calculation_bloom_filter(capacity, error_rate)
-        self.count = 0
         self.m = m if m <= (1 << 32) else 1 << 32
         self.k = k  # number of hash functions
         self.block_num = block_num
         self.seeds = self._seeds.copy()[0:k]
-        self.hashmaps = [hash_type(m, seed) for seed in self.seeds]  # k个hash函数
-
-        self._add_script = self.redis_client.register_script(
-            """
-            if tonumber(#KEYS) < 2 then
-                return { err = "wrong argument numbers" }
-            end
-            for key = 2, #KEYS do
-                redis.call("HINCRBY", KEYS[1], KEYS[key], 1)
-            end
-            return { ok = "incr by field success" }
-            """
+        self.double_hashing = bool(double_hashing)
+        if self.double_hashing:
+            self.hashmaps = [hash_type(m, self.seeds[0])]
+        else:
+            self.hashmaps = [hash_type(m, seed) for seed in self.seeds]  # k个hash函数
+
+        self._add_script = register_script(self.redis_client, scripts.HASH_ADD_ITEM)
+        self._remove_script = register_script(
+            self.redis_client, scripts.HASH_REMOVE_ITEM
+        )
+        self._contains_script = register_script(
+            self.redis_client, scripts.HASH_CONTAINS_ITEM
         )
-        self._remove_script = self.redis_client.register_script(
-            """
-            if tonumber(#KEYS) < 2 then
-                return { err = "wrong argument numbers" }
-            end
-
-            for key = 2, #KEYS do
-                redis.call("HINCRBY", KEYS[1], KEYS[key], -1)
-            end
-            return { ok = "decr by field success" }
-            """
+        self._add_many_script = register_script(
+            self.redis_client, scripts.BATCH_HASH_ADD
         )
-        self._contains_script = self.redis_client.register_script(
-            """
-            if #KEYS < 2 then
-                return { err = "wrong argument numbers" }
-            end
-            if redis.call("EXISTS", KEYS[1]) == 0 then
-                return 0
-            end
-            for key = 2, #KEYS do
-                local ret = redis.call("HGET", KEYS[1], KEYS[key])
-                if not ret then
-                    ret = 0
-                else
-                    ret = tonumber(ret)
-                end
-                if ret<=0 then
-                    return 0
-                end
-            end
-            return 1
-            """
+        self._remove_many_script = register_script(
+            self.redis_client, scripts.BATCH_HASH_REMOVE
+        )
+        self._contains_many_script = register_script(
+            self.redis_client, scripts.BATCH_HASH_CONTAINS
         )
 
     async def add(self, item: Any) -> bool:
         """
-        加入元素
+        加入元素 判断和写入在一个脚本里完成，一次往返
         :param item: 一个可以变成str的对象
         :return: bool 是否插入成功
         """
-        if not await self.contains(item):
-            if not isinstance(item, str):
-                item = str(item)
-            offsets = list(map(lambda x: x.hash(item), self.hashmaps))  # k个偏移量
-            await self._add_script(keys=[self.key] + offsets)
-            self.count += 1
-            return True
-        return False
+        if not isinstance(item, str):
+            item = str(item)
+        offsets = list(self._offsets(item))  # k个偏移量
+        added = await self._add_script(keys=[self.key, self.count_key], args=offsets)
+        return bool(added)
 
     async def remove(self, item: Any) -> bool:
         """
-        删除元素
+        删除元素 判断和删除在一个脚本里完成，一次往返
         :param item:
         :return: 是否删除
         """
-        if await self.contains(item):
-            if not isinstance(item, str):
-                item = str(item)
-            offsets = list(map(lambda x: x.hash(item), self.hashmaps))
-            await self._remove_script(keys=[self.key] + offsets)
-            self.count -= 1
-            return True
-        return False
+        if not isinstance(item, str):
+            item = str(item)
+        offsets = list(self._offsets(item))
+        removed = await self._remove_script(
+            keys=[self.key, self.count_key], args=offsets
+        )
+        return bool(removed)
 
     async def clear(self) -> None:
         """清空过滤器"""
-        await self.redis_client.delete(self.key)
-        self.count = 0
+        await self.redis_client.delete(self.key, self.count_key)
 
     def __len__(self) -> int:
-        return self.count
+        raise NotImplementedError("use await self.size() instead")
+
+    async def size(self) -> int:
+        """redis中记录的元素个数 所有客户端共享"""
+        return int(await self.redis_client.get(self.count_key) or 0)
+
+    async def _health(self) -> Tuple[float, float, int]:
+        # redis的计数器是整数，不会饱和 删除脚本把减到0的计数器删掉，hash的字段数就是非0的个数
+        nonzero = int(await self.redis_client.hlen(self.key))
+        return bloom_health([(self.m, self.k, nonzero)])
 
     def __contains__(self, item: Any) -> bool:
         raise NotImplementedError("use await self.contains() instead")
@@ -340,6 +708,421 @@ class CountRedisBloomFilter(BaseBloomFilter):
     async def contains(self, item: Any) -> bool:
         if not isinstance(item, str):
             item = str(item)
-        offsets = list(map(lambda x: x.hash(item), self.hashmaps))
-        result = await self._contains_script(keys=[self.key] + offsets)
+        offsets = list(self._offsets(item))
+        result = await self._contains_script(keys=[self.key], args=offsets)
         return bool(result)
+
+    async def add_many(
+        self, items: Iterable[Any], batch_size: int = 1000
+    ) -> np.ndarray:
+        """
+        批量加入元素 每batch_size个元素打包成一次脚本调用，所有调用一次往返
+        :param items: 可迭代对象，元素需可以变成str
+        :param batch_size: 每次脚本调用最多处理的元素个数
+        :return: 布尔数组 每个元素是否插入成功
+        """
+        items = stringify(items)
+        calls = scripts.pack_batch_args(
+            [self.key] * len(items), self._offsets_many(items), batch_size
+        )
+        calls = scripts.with_count_keys(calls, lambda key: self.count_key)
+        return await _execute_batches(self.redis_client, self._add_many_script, calls)
+
+    async def remove_many(
+        self, items: Iterable[Any], batch_size: int = 1000
+    ) -> np.ndarray:
+        """
+        批量删除元素
+        :param items: 可迭代对象，元素需可以变成str
+        :param batch_size: 每次脚本调用最多处理的元素个数
+        :return: 布尔数组 每个元素是否删除
+        """
+        items = stringify(items)
+        calls = scripts.pack_batch_args(
+            [self.key] * len(items), self._offsets_many(items), batch_size
+        )
+        calls = scripts.with_count_keys(calls, lambda key: self.count_key)
+        return await _execute_batches(
+            self.redis_client, self._remove_many_script, calls
+        )
+
+    async def contains_many(
+        self, items: Iterable[Any], batch_size: int = 1000
+    ) -> np.ndarray:
+        """
+        批量判断元素是否存在
+        :param items: 可迭代对象，元素需可以变成str
+        :param batch_size: 每次脚本调用最多处理的元素个数
+        :return: 布尔数组
+        """
+        items = stringify(items)
+        calls = scripts.pack_batch_args(
+            [self.key] * len(items), self._offsets_many(items), batch_size
+        )
+        return await _execute_batches(
+            self.redis_client, self._contains_many_script, calls
+        )
+
+
+class ScalableRedisBloomFilter(_HealthMixin, BaseBloomFilter):
+    """
+    Scalable BloomFilter that uses Redis
+    由多个RedisBloomFilter串联而成，阶段数、最新阶段和所有阶段的元素个数保存在redis的key:meta中，
+    阶段i的数据保存在key:i。最新的阶段装满时由脚本原子地切换到下一个阶段，多个客户端共享同一组阶段
+    每个阶段的参数由阶段的序号推导出来，所有客户端需要使用相同的参数
+    """
+
+    def __init__(
+        self,
+        redis_client,
+        key: str,
+        initial_capacity: int,
+        error_rate: Optional[float] = 0.001,
+        hash_type: Optional[Type[BaseHash]] = MMH3HashMap,
+        double_hashing: Optional[bool] = False,
+        growth: Optional[int] = 2,
+        ratio: Optional[float] = 0.9,
+        cluster: Optional[bool] = False,
+    ):
+        """
+        :param key: redis中的键名前缀
+        :param initial_capacity: 第一个阶段的容量
+        :param error_rate: 总的错误率
+        :param hash_type: hash函数类型
+        :param double_hashing: 只计算一次128位摘要推导出k个偏移量
+        :param growth: 每个新阶段的容量是上一个的多少倍
+        :param ratio: 每个新阶段的错误率是上一个的多少倍
+        :param cluster: redis cluster模式 所有key的前缀是{key}，落在同一个slot上，与默认模式的key不兼容
+        """
+        if not (0 < error_rate < 1):
+            raise ValueError("Error_Rate must be between 0 and 1.")
+        if not initial_capacity > 0:
+            raise ValueError("Capacity must be > 0")
+        if not growth >= 1:
+            raise ValueError("growth must be >= 1")
+        if not (0 < ratio < 1):
+            raise ValueError("ratio must be between 0 and 1")
+        self.redis_client = redis_client  # type: redis.asyncio.Redis
+        self.key = key
+        self.prefix = f"{{{key}}}" if cluster else key  # 脚本访问的key需要在同一个slot
+        self.meta_key = self.prefix + ":meta"
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        self.hash_type = hash_type
+        self.double_hashing = bool(double_hashing)
+        self.growth = growth
+        self.ratio = ratio
+        self.filters: List[RedisBloomFilter] = []
+        self._sync_stages(1)
+
+        self._add_many_script = register_script(self.redis_client, scripts.SCALABLE_ADD)
+        self._contains_many_script = register_script(
+            self.redis_client, scripts.SCALABLE_CONTAINS
+        )
+
+    def _sync_stages(self, stages: int) -> None:
+        """
+        按redis中的阶段数调整本地的阶段 多准备一个阶段，脚本切换阶段时需要它的偏移量
+        """
+        self.stages = stages  # 已知的阶段数 其他客户端切换阶段后会落后，脚本返回后再更新
+        del self.filters[stages + 1 :]
+        while len(self.filters) <= stages:
+            index = len(self.filters)
+            capacity, error_rate = scalable_stage(
+                self.initial_capacity, self.error_rate, self.growth, self.ratio, index
+            )
+            self.filters.append(
+                RedisBloomFilter(
+                    self.redis_client,
+                    f"{self.prefix}:{index}",
+                    capacity,
+                    error_rate,
+                    self.hash_type,
+                    self.double_hashing,
+                )
+            )
+
+    def _stage_capacity(self, index: int) -> int:
+        return scalable_stage(
+            self.initial_capacity, self.error_rate, self.growth, self.ratio, index
+        )[0]
+
+    def _pack(
+        self, items: List[str], batch_size: int, adding: bool
+    ) -> List[Tuple[List[str], List[int]]]:
+        """按当前已知的阶段数生成脚本调用 加入时需要额外带上下一个阶段的偏移量"""
+        filters = self.filters[: self.stages + 1 if adding else self.stages]
+        head = [self.stages]
+        if adding:
+            head += [
+                self._stage_capacity(self.stages - 1),
+                self._stage_capacity(self.stages),
+            ]
+        head += [bloom_filter.k for bloom_filter in filters]
+        offsets = np.hstack(
+            [bloom_filter._offsets_many(items) for bloom_filter in filters]
+        )
+        keys = [self.meta_key] + [bloom_filter.key for bloom_filter in filters]
+        return [
+            (keys, args) for args in scripts.pack_flat_args(head, offsets, batch_size)
+        ]
+
+    async def _run(
+        self, script, items: Iterable[Any], batch_size: int, adding: bool
+    ) -> np.ndarray:
+        """
+        执行脚本 阶段数变化导致没有处理完的元素，刷新阶段数后重发
+        """
+        items = stringify(items)
+        result = np.zeros(len(items), dtype=bool)
+        start = 0
+        while start < len(items):
+            calls = self._pack(items[start:], batch_size, adding)
+            for response in await _execute_scripts(self.redis_client, script, calls):
+                size = min(batch_size, len(items) - start)
+                done = response[1:]
+                result[start : start + len(done)] = done
+                start += len(done)
+                if int(response[0]) != self.stages:
+                    self._sync_stages(int(response[0]))
+                if len(done) < size:
+                    break  # 之后的调用用的是过期的阶段数
+        return result
+
+    async def add(self, item: Any) -> bool:
+        """
+        加入元素
+        :param item: 一个可以变成str的对象
+        :return: bool 是否插入成功
+        """
+        return bool((await self.add_many([item]))[0])
+
+    async def clear(self) -> None:
+        """清空过滤器"""
+        stages = int(await self.redis_client.hget(self.meta_key, "stages") or 1)
+        await self.redis_client.delete(
+            self.meta_key,
+            *(f"{self.prefix}:{i}" for i in range(max(stages, self.stages))),
+        )
+        self._sync_stages(1)
+
+    def __len__(self) -> int:
+        raise NotImplementedError("use await self.size() instead")
+
+    async def size(self) -> int:
+        """redis中记录的所有阶段的元素个数 所有客户端共享"""
+        return int(await self.redis_client.hget(self.meta_key, "total") or 0)
+
+    async def _stage_bits(self) -> List[Tuple[int, int, int]]:
+        """每个阶段的(m, k, 置位的位数) 先读取阶段数，再在一个pipeline里BITCOUNT，两次往返"""
+        stages = int(await self.redis_client.hget(self.meta_key, "stages") or 1)
+        if stages != self.stages:
+            self._sync_stages(stages)
+        filters = self.filters[:stages]
+        pipe = self.redis_client.pipeline(transaction=False)
+        for bloom_filter in filters:
+            pipe.bitcount(bloom_filter.key)
+        return [
+            (bloom_filter.m, bloom_filter.k, bits)
+            for bloom_filter, bits in zip(filters, await pipe.execute())
+        ]
+
+    async def estimate_cardinality(self) -> float:
+        """
+        由每个阶段的BITCOUNT估计过滤器中的元素个数 两次往返
+        :return: 估计的元素个数
+        """
+        return sum(estimate_cardinality(*stage) for stage in await self._stage_bits())
+
+    async def _health(self) -> Tuple[float, float, int]:
+        return bloom_health(await self._stage_bits(), stages=True)
+
+    def __contains__(self, item: Any) -> bool:
+        raise NotImplementedError("use await self.contains() instead")
+
+    async def contains(self, item: Any) -> bool:
+        return bool((await self.contains_many([item]))[0])
+
+    async def add_many(
+        self, items: Iterable[Any], batch_size: int = 1000
+    ) -> np.ndarray:
+        """
+        批量加入元素 每batch_size个元素打包成一次脚本调用，所有调用一次往返
+        :param items: 可迭代对象，元素需可以变成str
+        :param batch_size: 每次脚本调用最多处理的元素个数
+        :return: 布尔数组 每个元素是否插入成功
+        """
+        return await self._run(self._add_many_script, items, batch_size, True)
+
+    async def contains_many(
+        self, items: Iterable[Any], batch_size: int = 1000
+    ) -> np.ndarray:
+        """
+        批量判断元素是否存在 一次脚本调用检查所有阶段
+        :param items: 可迭代对象，元素需可以变成str
+        :param batch_size: 每次脚本调用最多处理的元素个数
+        :return: 布尔数组
+        """
+        return await self._run(self._contains_many_script, items, batch_size, False)
+
+
+class CuckooRedisFilter(_HealthMixin, BaseCuckooFilter):
+    """
+    Cuckoo filter that uses Redis, capable of remove elements
+    桶按顺序保存在分片的string key:0, key:1...里，每个指纹占fingerprint_bits位
+    插入(包括踢出)、删除和判断都在lua脚本里原子地完成，每个元素只需要几个字节
+    """
+
+    def __init__(
+        self,
+        redis_client,
+        key: str,
+        capacity: int,
+        error_rate: Optional[float] = 0.001,
+        hash_type: Optional[Type[BaseHash]] = MMH3HashMap,
+        fingerprint_bits: Optional[Literal[8, 16, 32]] = None,
+        bucket_size: Optional[int] = 4,
+        max_kicks: Optional[int] = 500,
+        chunk_buckets: Optional[int] = 1 << 20,
+        cluster: Optional[bool] = False,
+    ):
+        """
+        :param key: redis中的键名前缀
+        :param capacity: 容量
+        :param error_rate: 错误率 fingerprint_bits为None时用来选择指纹位数
+        :param hash_type: hash函数类型 需要实现hash128
+        :param fingerprint_bits: 指纹位数 8/16/32
+        :param bucket_size: 每个桶的槽数
+        :param max_kicks: 插入时最多踢出多少次，超过就认为过滤器已满
+        :param chunk_buckets: 每个分片保存多少个桶 避免产生大key
+        :param cluster: redis cluster模式 踢出时可能访问任意一个分片，所有分片的key前缀是{key}，
+                        落在同一个slot上，与默认模式的key不兼容
+        """
+        self._init_cuckoo(
+            capacity, error_rate, hash_type, fingerprint_bits, bucket_size, max_kicks
+        )
+        if self.num_buckets > 1 << 32:
+            raise ValueError("Capacity is too large")  # lua脚本只计算哈希的低32位
+        if not chunk_buckets > 0:
+            raise ValueError("chunk_buckets must be > 0")
+        self.redis_client = redis_client  # type: redis.asyncio.Redis
+        self.key = key
+        # redis string 最大 512MB，即 2^32 位
+        chunk_buckets = min(
+            chunk_buckets, (1 << 32) // (self.bucket_size * self.fingerprint_bits)
+        )
+        self.chunk_buckets = chunk_buckets
+        prefix = f"{{{key}}}" if cluster else key
+        self.chunk_keys = [
+            f"{prefix}:{i}" for i in range(-(-self.num_buckets // chunk_buckets))
+        ]
+        # 已插入的元素个数 作为脚本的最后一个key，由加入和删除的脚本原子地更新
+        self.count_key = prefix + ":count"
+
+        self._add_many_script = register_script(self.redis_client, scripts.CUCKOO_ADD)
+        self._remove_many_script = register_script(
+            self.redis_client, scripts.CUCKOO_REMOVE
+        )
+        self._contains_many_script = register_script(
+            self.redis_client, scripts.CUCKOO_CONTAINS
+        )
+
+    def _pack(
+        self, items: List[str], batch_size: int
+    ) -> List[Tuple[List[str], List[int]]]:
+        """生成每次脚本调用的keys和args 每个元素3个参数: 候选桶1, 候选桶2, 指纹"""
+        head = [
+            self.chunk_buckets,
+            self.bucket_size,
+            self.fingerprint_bits,
+            self.num_buckets,
+            self.max_kicks,
+        ]
+        rows = np.stack(self._locate_many(items), axis=1).astype(np.int64)
+        keys = self.chunk_keys + [self.count_key]
+        return [(keys, args) for args in scripts.pack_flat_args(head, rows, batch_size)]
+
+    async def add(self, item: Any) -> bool:
+        """
+        加入元素 一次往返
+        :param item: 一个可以变成str的对象
+        :return: bool 是否插入成功
+        :raises OverflowError: 过滤器已满
+        """
+        return bool((await self.add_many([item]))[0])
+
+    async def remove(self, item: Any) -> bool:
+        """
+        删除元素 只能删除加入过的元素，否则可能删掉指纹相同的其他元素
+        :param item:
+        :return: 是否删除
+        """
+        return bool((await self.remove_many([item]))[0])
+
+    async def clear(self) -> None:
+        """清空过滤器"""
+        await self.redis_client.delete(*self.chunk_keys, self.count_key)
+
+    def __len__(self) -> int:
+        raise NotImplementedError("use await self.size() instead")
+
+    async def size(self) -> int:
+        """redis中记录的元素个数 所有客户端共享"""
+        return int(await self.redis_client.get(self.count_key) or 0)
+
+    async def _health(self) -> Tuple[float, float, int]:
+        # 计数由脚本原子地更新，等于占用的槽数
+        return self._cuckoo_health(await self.size())
+
+    def __contains__(self, item: Any) -> bool:
+        raise NotImplementedError("use await self.contains() instead")
+
+    async def contains(self, item: Any) -> bool:
+        return bool((await self.contains_many([item]))[0])
+
+    async def add_many(
+        self, items: Iterable[Any], batch_size: int = 1000
+    ) -> np.ndarray:
+        """
+        批量加入元素 每batch_size个元素打包成一次脚本调用，所有调用一次往返
+        :param items: 可迭代对象，元素需可以变成str
+        :param batch_size: 每次脚本调用最多处理的元素个数
+        :return: 布尔数组 每个元素是否插入成功
+        :raises OverflowError: 过滤器已满 之前的元素已经插入
+        """
+        calls = self._pack(stringify(items), batch_size)
+        results = await _execute_scripts(
+            self.redis_client, self._add_many_script, calls
+        )
+        status = np.array(list(chain.from_iterable(results)), dtype=np.int64)
+        if (status < 0).any():
+            raise OverflowError("CuckooRedisFilter is full")
+        return status == 1
+
+    async def remove_many(
+        self, items: Iterable[Any], batch_size: int = 1000
+    ) -> np.ndarray:
+        """
+        批量删除元素
+        :param items: 可迭代对象，元素需可以变成str
+        :param batch_size: 每次脚本调用最多处理的元素个数
+        :return: 布尔数组 每个元素是否删除
+        """
+        calls = self._pack(stringify(items), batch_size)
+        return await _execute_batches(
+            self.redis_client, self._remove_many_script, calls
+        )
+
+    async def contains_many(
+        self, items: Iterable[Any], batch_size: int = 1000
+    ) -> np.ndarray:
+        """
+        批量判断元素是否存在 每个元素只访问两个桶
+        :param items: 可迭代对象，元素需可以变成str
+        :param batch_size: 每次脚本调用最多处理的元素个数
+        :return: 布尔数组
+        """
+        calls = self._pack(stringify(items), batch_size)
+        return await _execute_batches(
+            self.redis_client, self._contains_many_script, calls
+        )
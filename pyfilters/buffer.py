@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+import threading
+from itertools import compress
+from typing import Any, Iterable, List, Optional
+
+import numpy as np
+
+from pyfilters.abc import BaseBloomFilter
+from pyfilters.memory_storage import MemoryBloomFilter
+from pyfilters.utils import stringify
+
+
+class BufferedFilter:
+    """
+    写回缓冲 add只写入本地的影子过滤器和待发送的缓冲区，不访问网络
+    缓冲区攒够max_pending个或者每隔flush_interval秒，由后台线程通过过滤器的add_many批量写入redis
+    redis不可用时元素留在缓冲区里重试，最多缓冲max_buffered个(包括正在发送的)，超出时按overflow处理
+    判断时先查影子过滤器，没有再查redis，所以本进程加入的元素立即可见
+    影子过滤器有自己的误判，总的误判率约为两者之和
+    """
+
+    def __init__(
+        self,
+        bloom_filter: BaseBloomFilter,
+        max_pending: int = 10000,
+        flush_interval: float = 0.1,
+        shadow_capacity: int = 100000,
+        shadow_error_rate: float = 0.0001,
+        max_buffered: Optional[int] = None,
+        overflow: str = "block",
+    ):
+        """
+        :param bloom_filter: redis过滤器，需要有add_many/contains_many
+        :param max_pending: 缓冲区攒够多少个元素立即发送
+        :param flush_interval: 最多间隔多少秒发送一次
+        :param shadow_capacity: 影子过滤器的容量 超过后重建，只保留还没有写入redis的元素
+        :param shadow_error_rate: 影子过滤器的错误率
+        :param max_buffered: 最多缓冲多少个还没有写入redis的元素 不能超过shadow_capacity，
+            默认是它的一半，给已经写入redis的元素留出空间，不用频繁重建影子过滤器
+        :param overflow: 缓冲区满时的处理 "block"等待发送腾出空间，
+            "drop_oldest"丢弃最早的元素(不会写入redis，个数记在dropped)，
+            "raise"抛出OverflowError，这一批元素都不加入
+        """
+        if not max_pending > 0:
+            raise ValueError("max_pending must be > 0")
+        if not flush_interval > 0:
+            raise ValueError("flush_interval must be > 0")
+        if max_buffered is None:
+            max_buffered = max(shadow_capacity // 2, 1)
+        if not 0 < max_buffered <= shadow_capacity:
+            raise ValueError("max_buffered must be > 0 and <= shadow_capacity")
+        if overflow not in ("block", "drop_oldest", "raise"):
+            raise ValueError('overflow must be "block", "drop_oldest" or "raise"')
+        self.bloom_filter = bloom_filter
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self.shadow_capacity = shadow_capacity
+        self.max_buffered = max_buffered
+        self.overflow = overflow
+        self.shadow = MemoryBloomFilter(shadow_capacity, shadow_error_rate)
+        # 后台线程最近一次发送失败的异常
+        self.last_error: Optional[BaseException] = None
+        self.dropped = 0  # overflow="drop_oldest"时丢弃的元素个数
+        self._pending: List[str] = []
+        self._sending: List[str] = []  # 正在发送的批次
+        self._lock = threading.Lock()  # 保护影子过滤器和缓冲区
+        self._not_full = threading.Condition(self._lock)
+        self._flush_lock = threading.Lock()  # 同一时间只有一个批次在发送
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add(self, item: Any) -> bool:
+        """
+        加入元素 只写入本地
+        :param item: 一个可以变成str的对象
+        :return: bool 影子过滤器中原来是否没有，不代表redis中原来没有
+        """
+        return bool(self.add_many([item])[0])
+
+    def add_many(self, items: Iterable[Any]) -> np.ndarray:
+        """
+        批量加入元素 只写入本地
+        :param items: 可迭代对象，元素需可以变成str
+        :return: 布尔数组 每个元素在影子过滤器中原来是否没有
+        :raises: overflow="raise"时缓冲区放不下这一批元素抛出OverflowError
+        """
+        if self._closed:
+            raise RuntimeError("BufferedFilter is closed")
+        items = stringify(items)
+        results = []
+        # 很大的批次分成max_buffered个一组加入，影子过滤器和缓冲区都不会超出限制
+        step = max(len(items), 1) if self.overflow == "raise" else self.max_buffered
+        for start in range(0, len(items), step):
+            chunk = items[start : start + step]
+            with self._lock:
+                self._make_room(len(chunk))
+                results.append(self.shadow.add_many(chunk))
+                self._pending.extend(chunk)
+                if self.overflow == "drop_oldest":
+                    self._drop_oldest()
+                self._bound_shadow()
+                full = (
+                    len(self._pending) >= self.max_pending
+                    or self._buffered() >= self.max_buffered
+                )
+            if full:
+                self._wakeup.set()
+        return np.concatenate(results) if results else np.zeros(0, dtype=bool)
+
+    def _make_room(self, count: int) -> None:
+        """持有_lock时调用"""
+        if self.overflow == "drop_oldest":
+            return
+        while self._buffered() + count > self.max_buffered:
+            if self.overflow == "raise":
+                raise OverflowError("BufferedFilter is full")
+            self._wakeup.set()
+            self._not_full.wait()
+            if self._closed:
+                raise RuntimeError("BufferedFilter is closed")
+
+    def _drop_oldest(self) -> None:
+        """持有_lock时调用 正在发送的元素不会丢弃"""
+        excess = min(self._buffered() - self.max_buffered, len(self._pending))
+        if excess > 0:
+            del self._pending[:excess]
+            self.dropped += excess
+
+    def _buffered(self) -> int:
+        return len(self._pending) + len(self._sending)
+
+    def _bound_shadow(self) -> None:
+        """影子过滤器超过容量时重建 redis不可用时也不会装得过满"""
+        if self.shadow.count > self.shadow_capacity:
+            # 已经写入redis的元素不需要再留在本地，只保留还没有写入的
+            self.shadow.clear()
+            self.shadow.add_many(self._sending + self._pending)
+
+    def __contains__(self, item: Any) -> bool:
+        if not isinstance(item, str):
+            item = str(item)
+        with self._lock:
+            if item in self.shadow:
+                return True
+        return item in self.bloom_filter
+
+    def contains_many(self, items: Iterable[Any], batch_size: int = 1000) -> np.ndarray:
+        """
+        批量判断元素是否存在 只有影子过滤器中没有的元素需要访问redis
+        :param items: 可迭代对象，元素需可以变成str
+        :param batch_size: 每次脚本调用最多处理的元素个数
+        :return: 布尔数组
+        """
+        items = stringify(items)
+        with self._lock:
+            result = self.shadow.contains_many(items)
+        missed = list(compress(items, ~result))
+        if missed:
+            result[~result] = self.bloom_filter.contains_many(missed, batch_size)
+        return result
+
+    def __len__(self) -> int:
+        return len(self.bloom_filter) + self._buffered()
+
+    def flush(self) -> None:
+        """
+        把缓冲区中的元素全部写入redis 返回时之前加入的元素都已经写入
+        :raises: 发送失败时抛出异常，元素留在缓冲区里，下次重试
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+                self._sending = batch
+            if not batch:
+                return
+            try:
+                self.bloom_filter.add_many(batch)
+            except BaseException:
+                with self._lock:
+                    self._pending[:0] = batch
+                    self._sending = []
+                    if self.overflow == "drop_oldest":
+                        self._drop_oldest()
+                raise
+            with self._lock:
+                self._sending = []
+                self._not_full.notify_all()
+                if self.shadow.count >= self.shadow_capacity:
+                    self.shadow.clear()
+                    self.shadow.add_many(self._pending)
+
+    def clear(self) -> None:
+        """清空过滤器 丢弃还没有发送的元素"""
+        with self._flush_lock:
+            with self._lock:
+                self._pending = []
+                self.shadow.clear()
+                self._not_full.notify_all()
+            self.bloom_filter.clear()
+
+    def close(self) -> None:
+        """停止后台线程，把剩余的元素写入redis，之后不再接受新的元素"""
+        if not self._closed:
+            self._closed = True
+            self._wakeup.set()
+            self._thread.join()
+            with self._lock:  # 等待的add_many抛出RuntimeError
+                self._not_full.notify_all()
+        self.flush()
+
+    def __enter__(self) -> "BufferedFilter":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def _run(self) -> None:
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:  # 元素留在缓冲区里，下次重试
+                self.last_error = e
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
+from typing import Any, Iterable, Iterator, Optional, Set, Tuple, Type, Union
+
+from pyfilters import serialization
+from pyfilters.abc import BaseBloomFilter, BaseHash
+from pyfilters.memory_storage import CountMemoryBloomFilter
+
+_FILE_CHUNK = 1 << 24  # 文件按16MB分块，每块一个任务
+
+# 工作进程里的状态 部分过滤器在第一个任务时创建，之后的任务都加入同一个
+_template: Optional[Tuple[type, Type[BaseHash], bytes, int]] = None
+_shm = None
+_partial: Optional[BaseBloomFilter] = None
+
+
+def _init_worker(
+    cls: type, hash_type: Type[BaseHash], header: bytes, size: int
+) -> None:
+    global _template
+    _template = (cls, hash_type, header, size)
+
+
+def _partial_filter() -> BaseBloomFilter:
+    """
+    这个进程的部分过滤器 放在自己新建的共享内存里，格式与to_bytes一样
+    没有分到任务的进程不会创建，主进程只需要合并返回过名字的共享内存
+    """
+    global _shm, _partial
+    if _partial is None:
+        from multiprocessing import shared_memory  # python3.8+
+
+        cls, hash_type, header, size = _template
+        # 新建的共享内存全是0，只需要写入头部
+        _shm = shared_memory.SharedMemory(create=True, size=size)
+        _shm.buf[: len(header)] = header
+        _partial = cls.from_bytes(_shm.buf, hash_type)
+    return _partial
+
+
+def _read_lines(
+    path: Union[str, "os.PathLike[str]"], start: int, end: int, encoding: str
+) -> Iterator[str]:
+    """文件中从[start, end)开始的行 跨过边界的行属于它开始的那一块，忽略空行"""
+    with open(path, "rb") as f:
+        if start:
+            # 上一个字节是换行符时readline只读到这个换行符，正好从start开始
+            f.seek(start - 1)
+            f.readline()
+        position = f.tell()
+        while position < end:
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+            line = line.rstrip(b"\r\n")
+            if line:
+                yield line.decode(encoding)
+
+
+def _build_chunk(task: Any, chunk_size: int) -> str:
+    """
+    把一个任务的元素加入这个进程的部分过滤器
+    :param task: 元素列表，或者(文件路径, 开始, 结束, 编码)
+    :param chunk_size: 每批加入的元素个数
+    :return: 部分过滤器所在共享内存的名字
+    """
+    partial = _partial_filter()
+    if isinstance(task, tuple):
+        lines = _read_lines(*task)
+        for batch in iter(lambda: list(islice(lines, chunk_size)), []):
+            partial.add_many(batch)
+    else:
+        partial.add_many(task)
+    # count写回头部，主进程用from_bytes加载时一起读出
+    serialization.COUNT.pack_into(_shm.buf, serialization.COUNT_OFFSET, partial.count)
+    return _shm.name
+
+
+def _tasks(
+    source: Union[str, "os.PathLike[str]", Iterable[Any]],
+    chunk_size: int,
+    encoding: str,
+) -> Iterator[Any]:
+    if isinstance(source, (str, os.PathLike)):
+        # 工作进程自己读文件，只传递范围
+        size = os.path.getsize(source)
+        for start in range(0, size, _FILE_CHUNK):
+            yield source, start, min(start + _FILE_CHUNK, size), encoding
+    else:
+        items = iter(source)
+        yield from iter(lambda: list(islice(items, chunk_size)), [])
+
+
+def _release(name: str, bloom_filter: Optional[BaseBloomFilter] = None) -> None:
+    """
+    释放一个工作进程的部分过滤器所在的共享内存
+    :param bloom_filter: 不为None时先把部分过滤器合并进来
+    """
+    from multiprocessing import shared_memory
+
+    shm = shared_memory.SharedMemory(name)
+    try:
+        if bloom_filter is not None:
+            hash_type = type(bloom_filter.hashmaps[0])
+            partial = type(bloom_filter).from_bytes(shm.buf, hash_type)
+            bloom_filter.merge(partial)
+            del partial  # 释放对共享内存的引用才能close
+    finally:
+        shm.unlink()
+    shm.close()
+
+
+def build_parallel(
+    bloom_filter: BaseBloomFilter,
+    source: Union[str, "os.PathLike[str]", Iterable[Any]],
+    workers: Optional[int] = None,
+    chunk_size: int = 100000,
+    encoding: str = "utf-8",
+) -> BaseBloomFilter:
+    """
+    用进程池批量加入大量元素 哈希的计算分散到多个核上
+    每个工作进程把分到的元素加入自己的部分过滤器，m, k, 种子和hash函数类型都与bloom_filter相同，
+    部分过滤器放在共享内存里，全部完成后在本进程按位或合并(计数过滤器是计数器相加)，不需要pickle位数组
+    每个工作进程额外占用一份与bloom_filter一样大的内存
+    count是各个部分过滤器的count之和，分到不同进程的重复元素会重复计数
+    :param bloom_filter: MemoryBloomFilter/BlockedMemoryBloomFilter/CountMemoryBloomFilter等 可以已经有数据
+    :param source: 可迭代对象，元素需可以变成str 或者文件路径，每行一个元素，忽略空行
+    :param workers: 进程数 默认为cpu个数
+    :param chunk_size: 每批加入的元素个数 可迭代对象按这个大小分块发给工作进程
+    :param encoding: 文件的编码
+    :return: bloom_filter
+    """
+    from multiprocessing import resource_tracker  # python3.8+
+
+    if not chunk_size > 0:
+        raise ValueError("chunk_size must be > 0")
+    workers = workers or os.cpu_count() or 1
+    header = serialization.pack_header(bloom_filter._header()._replace(count=0))
+    if isinstance(bloom_filter, CountMemoryBloomFilter):
+        size = len(header) + bloom_filter._counters().nbytes
+    else:
+        size = len(header) + (bloom_filter.m + 7) // 8
+    # 工作进程使用本进程的resource_tracker，它们退出时部分过滤器不会被释放掉
+    resource_tracker.ensure_running()
+    names: Set[str] = set()
+    try:
+        with ProcessPoolExecutor(
+            workers,
+            initializer=_init_worker,
+            initargs=(
+                type(bloom_filter),
+                type(bloom_filter.hashmaps[0]),
+                header,
+                size,
+            ),
+        ) as pool:
+            pending = set()
+            for task in _tasks(source, chunk_size, encoding):
+                if len(pending) >= 2 * workers:  # 不一次读完整个输入
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    names.update(future.result() for future in done)
+                pending.add(pool.submit(_build_chunk, task, chunk_size))
+            names.update(future.result() for future in wait(pending).done)
+    except BaseException:
+        for name in names:
+            _release(name)
+        raise
+    for name in names:
+        _release(name, bloom_filter)
+    return bloom_filter
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import sys
+import time
+from collections import OrderedDict
+from typing import Iterable, List, Optional
+
+import numpy as np
+
+_ENTRY_OVERHEAD = 100  # OrderedDict中每个元素的链表节点和哈希表槽位 大约的字节数
+
+
+class PositiveCache:
+    """
+    已知存在的元素的本地缓存，放在redis布隆过滤器前面
+    布隆过滤器在clear之前不会忘记已经存在的元素，所以缓存命中时可以直接返回，不需要往返redis
+    按LRU淘汰，容量按元素个数或者字节数限制，同步和asyncio版本的过滤器都可以使用
+
+    多个进程共享同一个过滤器时，clear会增加redis中的代数，
+    每隔check_interval秒检查一次代数，变化了就清空缓存，所以其他进程clear后最多有check_interval秒的误判
+    """
+
+    def __init__(
+        self,
+        max_entries: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        check_interval: float = 1.0,
+    ):
+        """
+        :param max_entries: 最多缓存的元素个数
+        :param max_bytes: 最多占用的字节数 按str对象的大小加上每个元素的固定开销估算
+        :param check_interval: 检查redis中代数的间隔秒数 为0时每次查询都检查
+        """
+        if max_entries is None and max_bytes is None:
+            raise ValueError("max_entries or max_bytes is required")
+        if max_entries is not None and not max_entries > 0:
+            raise ValueError("max_entries must be > 0")
+        if max_bytes is not None and not max_bytes > 0:
+            raise ValueError("max_bytes must be > 0")
+        if not check_interval >= 0:
+            raise ValueError("check_interval must be >= 0")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.check_interval = check_interval
+        self._items: "OrderedDict[str, int]" = OrderedDict()  # 元素: 估算的字节数
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        # 缓存对应的redis中的代数 None表示还没有检查过
+        self.generation: Optional[int] = None
+        self._checked_at = 0.0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def expired(self) -> bool:
+        """是否需要检查redis中的代数"""
+        return (
+            self.generation is None
+            or time.monotonic() - self._checked_at >= self.check_interval
+        )
+
+    def validate(self, generation: int) -> None:
+        """
+        用redis中的代数校验缓存 代数变化说明过滤器被clear过，清空缓存
+        :param generation: redis中的代数
+        """
+        if generation != self.generation:
+            self.clear()
+            self.generation = generation
+        self._checked_at = time.monotonic()
+
+    def get(self, item: str) -> bool:
+        """
+        元素是否在缓存里 命中时移到最近使用的位置
+        :param item: str
+        :return: bool
+        """
+        if item in self._items:
+            self._items.move_to_end(item)
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def get_many(self, items: List[str]) -> np.ndarray:
+        """
+        批量查询
+        :param items: str列表
+        :return: 布尔数组 每个元素是否命中
+        """
+        return np.fromiter(map(self.get, items), dtype=bool, count=len(items))
+
+    def put(self, item: str) -> None:
+        """
+        缓存一个已知存在的元素 超出容量时淘汰最久没有使用的元素
+        :param item: str
+        """
+        if item in self._items:
+            self._items.move_to_end(item)
+            return
+        size = sys.getsizeof(item) + _ENTRY_OVERHEAD
+        self._items[item] = size
+        self.nbytes += size
+        while (
+            self.max_entries is not None and len(self._items) > self.max_entries
+        ) or (self.max_bytes is not None and self.nbytes > self.max_bytes):
+            self.nbytes -= self._items.popitem(last=False)[1]
+
+    def put_many(self, items: Iterable[str]) -> None:
+        """批量缓存已知存在的元素"""
+        for item in items:
+            self.put(item)
+
+    def clear(self) -> None:
+        """清空缓存 计数不清零"""
+        self._items.clear()
+        self.nbytes = 0
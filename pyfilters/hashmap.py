@@ -1,11 +1,24 @@
 # -*- coding: utf-8 -*-
 import hashlib
 import struct
+from typing import Tuple
 
 import mmh3
 
 from pyfilters.abc import BaseHash
 
+_MASK64 = (1 << 64) - 1
+
+
+def _fmix64(value: int) -> int:
+    """murmurhash3的64位收尾混淆"""
+    value ^= value >> 33
+    value = (value * 0xFF51AFD7ED558CCD) & _MASK64
+    value ^= value >> 33
+    value = (value * 0xC4CEB9FE1A85EC53) & _MASK64
+    value ^= value >> 33
+    return value
+
 
 class PyHashMap(BaseHash):
     """
@@ -22,6 +35,14 @@ class PyHashMap(BaseHash):
             ret += self.seed * ret + ord(value[i])
         return ret % self.m
 
+    def hash128(self, value: str) -> Tuple[int, int]:
+        h1 = 0
+        h2 = 0
+        for i in range(len(value)):
+            h1 = (h1 + self.seed * h1 + ord(value[i])) & _MASK64
+            h2 = (h2 + (self.seed + 1) * h2 + ord(value[i])) & _MASK64
+        return _fmix64(h1), _fmix64(h2 ^ h1)
+
 
 class MMH3HashMap(BaseHash):
     """
@@ -36,6 +57,9 @@ class MMH3HashMap(BaseHash):
     def hash(self, value: str) -> int:
         return mmh3.hash(value, self.seed, signed=False) % self.m
 
+    def hash128(self, value: str) -> Tuple[int, int]:
+        return mmh3.hash64(value, self.seed, signed=False)
+
 
 class HashlibHashMap(BaseHash):
     """
@@ -52,3 +76,9 @@ class HashlibHashMap(BaseHash):
         m.update(value.encode())
         m.update(self.seed.to_bytes(4, byteorder="little"))
         return struct.unpack(">IIIIIIII", m.digest())[0] % self.m
+
+    def hash128(self, value: str) -> Tuple[int, int]:
+        m = hashlib.sha256()
+        m.update(value.encode())
+        m.update(self.seed.to_bytes(4, byteorder="little"))
+        return struct.unpack(">QQ", m.digest()[:16])
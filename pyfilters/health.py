@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import threading
+from typing import Any, Callable, Iterable, Optional
+
+import numpy as np
+
+from pyfilters.abc import BaseBloomFilter
+
+
+class HealthMonitor:
+    """
+    误判率阈值 每加入check_every个元素估计一次当前的误判率，超过max_fpr时调用callback(过滤器, 误判率)
+    callback返回新的过滤器时换成它(比如换一个更大的，或者按时间轮换)，返回None时继续使用原来的
+    超过阈值后只通知一次，误判率回到阈值以下(clear或者换了过滤器)之后再次超过才会通知
+    估计误判率需要统计整个位数组，redis过滤器要一次往返，check_every越大开销越小
+    """
+
+    def __init__(
+        self,
+        bloom_filter: BaseBloomFilter,
+        max_fpr: float,
+        callback: Callable[[BaseBloomFilter, float], Optional[BaseBloomFilter]],
+        check_every: int = 1000,
+    ):
+        """
+        :param bloom_filter: 有estimated_fpr的过滤器
+        :param max_fpr: 误判率的阈值 一般取构造时的error_rate，或者略小一点提前处理
+        :param callback: 超过阈值时调用
+        :param check_every: 每加入多少个元素检查一次
+        """
+        if not (0 < max_fpr < 1):
+            raise ValueError("max_fpr must be between 0 and 1")
+        if not check_every > 0:
+            raise ValueError("check_every must be > 0")
+        self.bloom_filter = bloom_filter
+        self.max_fpr = max_fpr
+        self.callback = callback
+        self.check_every = check_every
+        self._since_check = 0
+        self._fired = False
+        self._lock = threading.RLock()  # callback里可以再调用add
+
+    def check(self) -> float:
+        """
+        立即估计误判率，超过阈值时调用callback
+        :return: 估计的误判率 换了过滤器时是原来的过滤器的
+        """
+        with self._lock:
+            self._since_check = 0
+            fpr = self.bloom_filter.estimated_fpr()
+            if fpr < self.max_fpr:
+                self._fired = False
+            elif not self._fired:
+                self._fired = True
+                replacement = self.callback(self.bloom_filter, fpr)
+                if replacement is not None:
+                    self.bloom_filter = replacement
+                    self._fired = False
+            return fpr
+
+    def _added(self, count: int) -> None:
+        with self._lock:
+            self._since_check += count
+            due = self._since_check >= self.check_every
+            if due:  # 多个线程同时到期时只检查一次
+                self._since_check = 0
+        if due:
+            self.check()
+
+    def add(self, item: Any) -> bool:
+        added = self.bloom_filter.add(item)
+        self._added(1)
+        return added
+
+    def add_many(self, items: Iterable[Any], **kwargs) -> np.ndarray:
+        added = self.bloom_filter.add_many(items, **kwargs)
+        self._added(len(added))
+        return added
+
+    def __contains__(self, item: Any) -> bool:
+        return item in self.bloom_filter
+
+    def __len__(self) -> int:
+        return len(self.bloom_filter)
+
+    def __getattr__(self, name: str):
+        return getattr(self.bloom_filter, name)
@@ -1,13 +1,29 @@
 # -*- coding: utf-8 -*-
 import array
-from typing import Any, Optional, Type
+import contextlib
+import mmap
+import os
+import pickle
+import random
+import sys
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Type, Union
 
 import bitarray
+import numpy as np
 from typing_extensions import Literal
 
-from pyfilters.abc import BaseBloomFilter, BaseHash
+from pyfilters import serialization
+from pyfilters.abc import BaseBloomFilter, BaseCuckooFilter, BaseHash
 from pyfilters.hashmap import MMH3HashMap
-from pyfilters.utils import calculation_bloom_filter
+from pyfilters.metrics import timed_hash
+from pyfilters.utils import (
+    calculation_bloom_filter,
+    bloom_health,
+    calculation_xor_filter,
+    estimate_cardinality,
+    scalable_stage,
+)
 
 _IntTypeCode = Literal["b", "B", "h", "H", "i", "I", "l", "L", "q", "Q"]
 
@@ -17,20 +33,139 @@ _IntTypeCode = Literal["b", "B", "h", "H", "i", "I", "l", "L", "q", "Q"]
 # good implementation
 
 
-class MemoryBloomFilter(BaseBloomFilter):
-    """BloomFilter that uses memory"""
+def _prepare_batch(items: Iterable[Any]) -> Tuple[List[str], np.ndarray, np.ndarray]:
+    """
+    批量操作的预处理 转换成str并去重
+    :param items: 可迭代对象
+    :return: 去重后的str列表, 每个元素在去重列表中的位置, 是否第一次出现
+    """
+    unique: Dict[str, int] = {}
+    positions: List[int] = []
+    first: List[bool] = []
+    for item in items:
+        if not isinstance(item, str):
+            item = str(item)
+        size = len(unique)
+        position = unique.setdefault(item, size)
+        positions.append(position)
+        first.append(position == size)
+    return (
+        list(unique),
+        np.array(positions, dtype=np.int64),
+        np.array(first, dtype=bool),
+    )
+
+
+def _make_hashmaps(
+    hash_type: Type[BaseHash], m: int, seeds: List[int], double_hashing: bool
+) -> List[BaseHash]:
+    """double_hashing模式只需要一个hash函数"""
+    if double_hashing:
+        return [hash_type(m, seeds[0])]
+    return [hash_type(m, seed) for seed in seeds]
+
+
+class _StripedLocks:
+    """
+    分段锁 位数组或计数器数组按REGION个一段，第i段由第 i % stripes 把锁保护
+    一段是整数个字节，不同的锁保护的位/计数器不会在同一个字节里
+    """
+
+    REGION = 512  # 每段的位数或计数器个数 分块布隆过滤器的一个块正好是一段
+
+    def __init__(self, stripes: int):
+        if not stripes > 0:
+            raise ValueError("stripes must be > 0")
+        self.locks = [threading.Lock() for _ in range(stripes)]
+        self.count_lock = threading.Lock()
+
+    def hold(self, offsets=None) -> contextlib.ExitStack:
+        """
+        按锁的序号依次获取offsets涉及的锁 每把锁只获取一次，顺序固定所以不会死锁
+        :param offsets: 偏移量列表或numpy数组 为None时获取所有的锁和count的锁
+        """
+        stack = contextlib.ExitStack()
+        if offsets is None:
+            for lock in self.locks + [self.count_lock]:
+                stack.enter_context(lock)
+            return stack
+        if isinstance(offsets, np.ndarray):
+            stripes = np.unique(offsets // self.REGION % len(self.locks)).tolist()
+        else:
+            stripes = sorted(
+                {offset // self.REGION % len(self.locks) for offset in offsets}
+            )
+        for stripe in stripes:
+            stack.enter_context(self.locks[stripe])
+        return stack
+
+
+class _StripedMixin:
+    """分段锁的公共部分 _locks为None时不加锁"""
+
+    _locks: Optional[_StripedLocks] = None
+
+    def _hold(self, offsets=None):
+        if self._locks is None:
+            return contextlib.nullcontext()
+        return self._locks.hold(offsets)
+
+    def _add_count(self, delta: int) -> None:
+        """修改count 在分段锁里调用，不同的线程可能持有不相交的分段锁，count单独加锁"""
+        if self._locks is None:
+            self.count += delta
+        else:
+            with self._locks.count_lock:
+                self.count += delta
+
+
+def _check_compatible(bloom_filter: BaseBloomFilter, other: BaseBloomFilter) -> None:
+    """合并前检查 类型, m, k, 种子, hash函数类型和计数器类型都要相同，只有count可以不同"""
+    if not hasattr(other, "_header"):
+        raise TypeError(f"can not combine with {type(other).__name__}")
+    if bloom_filter._header()._replace(count=0) != other._header()._replace(count=0):
+        raise ValueError("filters are not compatible")
+
+
+def _estimated_count(m: int, k: int, bits: int) -> int:
+    """由置位的位数估计元素个数 全部置位时按差一位估计，保证count是整数"""
+    return round(estimate_cardinality(m, k, min(bits, m - 1)))
+
+
+def _restore(cls, hash_type: Type[BaseHash], header: bytes, data) -> BaseBloomFilter:
+    """
+    pickle加载时调用 data可能是带外传输的缓冲区，可写时直接引用不复制
+    只读的缓冲区(比如低版本protocol的bytes)复制一份，保证加载后可以修改
+    """
+    view = memoryview(data).cast("B")
+    return cls._from_buffer(
+        serialization.unpack_header(header)[0], hash_type, view, view.readonly
+    )
+
+
+class MemoryBloomFilter(_StripedMixin, BaseBloomFilter):
+    """
+    BloomFilter that uses memory
+    传入stripes时可以在多个线程间共享(包括free-threaded的python)，写入按分段锁互斥，判断不加锁
+    """
+
+    _kind = serialization.KIND_BITS  # 序列化时头部记录的类型
 
     def __init__(
         self,
         capacity: int,
         error_rate: Optional[float] = 0.001,
         hash_type: Optional[Type[BaseHash]] = MMH3HashMap,
+        double_hashing: Optional[bool] = False,
+        stripes: Optional[int] = None,
     ):
         """
 
         :param capacity: 容量
         :param error_rate: 错误率
         :param hash_type: hash函数类型
+        :param double_hashing: 只计算一次128位摘要推导出k个偏移量，与默认模式的数据不兼容
+        :param stripes: 分段锁的个数 为None时不加锁，只能在一个线程里写入
         """
         if not (0 < error_rate < 1):
             raise ValueError("Error_Rate must be between 0 and 1.")
@@ -41,9 +176,17 @@ class MemoryBloomFilter(BaseBloomFilter):
         self.m = m  # len of bitarray
         self.k = k  # number of hash functions
         self.seeds = self._seeds.copy()[0:k]
-        self.hashmaps = [hash_type(m, seed) for seed in self.seeds]
+        self.double_hashing = bool(double_hashing)
+        self._build_hashmaps(hash_type)
         self.bitarray = bitarray.bitarray(m, endian="little")
         self.bitarray.setall(False)
+        if stripes is not None:
+            self._locks = _StripedLocks(stripes)
+
+    def _build_hashmaps(self, hash_type: Type[BaseHash]) -> None:
+        self.hashmaps = _make_hashmaps(
+            hash_type, self.m, self.seeds, self.double_hashing
+        )
 
     def add(self, item: Any) -> bool:
         """
@@ -51,40 +194,229 @@ class MemoryBloomFilter(BaseBloomFilter):
         :param item: 一个可以变成str的对象
         :return: bool 是否插入成功
         """
-        if item not in self:
-            if not isinstance(item, str):
-                item = str(item)
-
-            for map_ in self.hashmaps:
-                value = map_.hash(item)
-                assert 0 <= value < self.m
-                self.bitarray[value] = True
-            self.count += 1
-            return True
-        return False
+        if not isinstance(item, str):
+            item = str(item)
+        offsets = list(self._offsets(item))  # 只hash一次 哈希不需要加锁
+        new = False
+        with self._hold(offsets):
+            for value in offsets:  # 边判断边置位
+                if not self.bitarray[value]:
+                    self.bitarray[value] = True
+                    new = True
+            if new:
+                self._add_count(1)
+        return new
 
     def clear(self) -> None:
         """清空过滤器"""
-        self.bitarray.setall(False)
-        self.count = 0
+        with self._hold():
+            self.bitarray.setall(False)
+            self.count = 0
 
     def __len__(self) -> int:
         return self.count
 
+    def _health(self) -> Tuple[float, float, int]:
+        # bitarray.count按字节popcount 共享内存和mmap中其他进程写入的位也会算进来
+        return bloom_health([(self.m, self.k, self.bitarray.count())])
+
     def __contains__(self, item: Any) -> bool:
         if not isinstance(item, str):
             item = str(item)
+        return all(self.bitarray[value] for value in self._offsets(item))
+
+    def _test_bits(self, offsets: np.ndarray) -> np.ndarray:
+        """对每一行偏移量检查是否全部置位"""
+        buffer = np.frombuffer(self.bitarray, dtype=np.uint8)
+        masks = np.left_shift(1, offsets & 7).astype(np.uint8)
+        return (buffer[offsets >> 3] & masks).astype(bool).all(axis=1)
 
-        def _m(x):
-            value = x.hash(item)
-            assert 0 <= value < self.m
-            return self.bitarray[value]
+    def add_many(self, items: Iterable[Any]) -> np.ndarray:
+        """
+        批量加入元素 一次性计算整批的偏移量，用numpy在bitarray的缓冲区上置位
+        同一批次中重复的元素只有第一次出现时算插入成功 每把分段锁每批只获取一次
+        :param items: 可迭代对象，元素需可以变成str
+        :return: 布尔数组 每个元素是否插入成功
+        """
+        unique, index, first = _prepare_batch(items)
+        offsets = self._offsets_many(unique)
+        with self._hold(offsets):
+            added = self._set_bits(offsets)
+        return added[index] & first
+
+    def _set_bits(self, offsets: np.ndarray) -> np.ndarray:
+        """
+        对每一行偏移量置位并更新count
+        :return: 布尔数组 每一行原来是否有没置位的位
+        """
+        added = ~self._test_bits(offsets)
+        if added.any():
+            new_offsets = offsets[added].ravel()
+            buffer = np.frombuffer(self.bitarray, dtype=np.uint8)
+            masks = np.left_shift(1, new_offsets & 7).astype(np.uint8)
+            np.bitwise_or.at(buffer, new_offsets >> 3, masks)
+            self._add_count(int(added.sum()))
+        return added
+
+    def contains_many(self, items: Iterable[Any]) -> np.ndarray:
+        """
+        批量判断元素是否存在
+        :param items: 可迭代对象，元素需可以变成str
+        :return: 布尔数组
+        """
+        unique, index, _ = _prepare_batch(items)
+        return self._test_bits(self._offsets_many(unique))[index]
 
-        return all(map(_m, self.hashmaps))
+    def _combine(self, other: "MemoryBloomFilter", operation, estimate: bool) -> None:
+        """
+        与另一个参数相同的过滤器按位运算，结果写入self
+        :param operation: np.bitwise_or/np.bitwise_and
+        :param estimate: count按置位的位数重新估计，为False时直接相加
+        """
+        _check_compatible(self, other)
+        others = np.frombuffer(other.bitarray, dtype=np.uint8)
+        with self._hold():
+            # 从缓冲区加载的位数组长度会补齐到整字节，按字节计算
+            buffer = np.frombuffer(self.bitarray, dtype=np.uint8)
+            operation(buffer, others, out=buffer)
+            if estimate:
+                self.count = _estimated_count(self.m, self.k, self.bitarray.count())
+            else:
+                self.count += other.count
 
+    def _copy(self) -> "MemoryBloomFilter":
+        """复制位数组 得到不带锁的过滤器"""
+        return type(self)._from_buffer(
+            self._header(), type(self.hashmaps[0]), memoryview(self.bitarray), True
+        )
 
-class CountMemoryBloomFilter(BaseBloomFilter):
-    """可以删除数据的过滤器 消耗大量内存"""
+    def merge(self, other: "MemoryBloomFilter") -> None:
+        """
+        按位或合并另一个参数相同的过滤器 合并后other中的元素都能判断为存在
+        count直接相加，适合合并元素没有交集的分片，两边都有的元素会重复计数
+        :param other: m, k, 种子和hash函数类型都相同的过滤器
+        """
+        self._combine(other, np.bitwise_or, False)
+
+    def union(self, *others: "MemoryBloomFilter") -> "MemoryBloomFilter":
+        """
+        并集 返回新的过滤器，所有过滤器中的元素都判断为存在
+        整个位数组按位或，count按置位的位数估计
+        :param others: m, k, 种子和hash函数类型都相同的过滤器
+        :return: 新的过滤器
+        """
+        result = self._copy()
+        for other in others:
+            result |= other
+        return result
+
+    def intersection(self, *others: "MemoryBloomFilter") -> "MemoryBloomFilter":
+        """
+        交集 返回新的过滤器，同时在所有过滤器中的元素都判断为存在
+        整个位数组按位与，误判率比直接用交集的元素构建的过滤器高，count按置位的位数估计
+        :param others: m, k, 种子和hash函数类型都相同的过滤器
+        :return: 新的过滤器
+        """
+        result = self._copy()
+        for other in others:
+            result &= other
+        return result
+
+    def __or__(self, other: "MemoryBloomFilter") -> "MemoryBloomFilter":
+        return self.union(other)
+
+    def __and__(self, other: "MemoryBloomFilter") -> "MemoryBloomFilter":
+        return self.intersection(other)
+
+    def __ior__(self, other: "MemoryBloomFilter") -> "MemoryBloomFilter":
+        self._combine(other, np.bitwise_or, True)
+        return self
+
+    def __iand__(self, other: "MemoryBloomFilter") -> "MemoryBloomFilter":
+        self._combine(other, np.bitwise_and, True)
+        return self
+
+    def _header(self) -> serialization.FilterHeader:
+        return serialization.FilterHeader(
+            self._kind,
+            self.m,
+            self.k,
+            tuple(self.seeds),
+            type(self.hashmaps[0]).__name__,
+            self.count,
+            self.double_hashing,
+        )
+
+    def to_bytes(self) -> bytes:
+        """
+        序列化成 头部+原始位数组 的紧凑二进制格式
+        头部记录了m, k, 种子, hash函数类型和count
+        """
+        return serialization.pack_header(self._header()) + self.bitarray.tobytes()
+
+    @classmethod
+    def from_bytes(
+        cls,
+        data,
+        hash_type: Optional[Type[BaseHash]] = None,
+        copy: Optional[bool] = False,
+    ) -> "MemoryBloomFilter":
+        """
+        从to_bytes的结果加载 默认不复制数据，位数组直接引用传入的缓冲区
+        传入只读的缓冲区(比如bytes)时得到的过滤器也是只读的，需要修改时传入copy=True
+        :param data: 支持buffer协议的对象 bytes/bytearray/memoryview/mmap等
+        :param hash_type: hash函数类型 默认使用头部记录的类型
+        :param copy: 是否复制数据
+        :return: MemoryBloomFilter
+        """
+        view = memoryview(data).cast("B")
+        header, offset = serialization.unpack_header(view)
+        hash_type = serialization.check_header(header, cls._kind, hash_type)
+        return cls._from_buffer(header, hash_type, view[offset:], copy)
+
+    @classmethod
+    def _from_buffer(
+        cls,
+        header: serialization.FilterHeader,
+        hash_type: Type[BaseHash],
+        buffer: memoryview,
+        copy: Optional[bool] = False,
+    ) -> "MemoryBloomFilter":
+        nbytes = (header.m + 7) // 8
+        if len(buffer) < nbytes:
+            raise ValueError("buffer too small for the filter")
+        self = cls.__new__(cls)
+        self.count = header.count
+        self.m = header.m
+        self.k = header.k
+        self.seeds = list(header.seeds)
+        self.double_hashing = header.double_hashing
+        self._build_hashmaps(hash_type)
+        self.bitarray = bitarray.bitarray(buffer=buffer[:nbytes], endian="little")
+        if copy:
+            self.bitarray = self.bitarray[: self.m]
+        return self
+
+    def __reduce_ex__(self, protocol):
+        # protocol 5 用PickleBuffer传递位数组，可以带外传输，避免额外的复制
+        if protocol >= 5:
+            data = pickle.PickleBuffer(self.bitarray)
+        else:
+            data = self.bitarray.tobytes()
+        return _restore, (
+            type(self),
+            type(self.hashmaps[0]),
+            serialization.pack_header(self._header()),
+            data,
+        )
+
+
+class CountMemoryBloomFilter(_StripedMixin, BaseBloomFilter):
+    """
+    可以删除数据的过滤器
+    默认每个计数器是一个array.array元素，counter_bits=4/8时使用紧凑的饱和计数器
+    传入stripes时可以在多个线程间共享，一个元素的判断和增减在它涉及的所有分段锁里完成
+    """
 
     def __init__(
         self,
@@ -92,25 +424,74 @@ class CountMemoryBloomFilter(BaseBloomFilter):
         error_rate: Optional[float] = 0.001,
         hash_type: Optional[Type[BaseHash]] = MMH3HashMap,
         array_type: Optional[_IntTypeCode] = "L",
+        double_hashing: Optional[bool] = False,
+        counter_bits: Optional[Literal[4, 8]] = None,
+        stripes: Optional[int] = None,
     ):
         """
 
         :param capacity: 容量
         :param error_rate: 错误率
         :param hash_type: hash函数类型
-        :param array_type: array.array类型标志
+        :param array_type: array.array类型标志 counter_bits为None时有效
+        :param double_hashing: 只计算一次128位摘要推导出k个偏移量，与默认模式的数据不兼容
+        :param counter_bits: 4: 每个计数器半个字节，8: 每个计数器一个字节
+                             计数器达到上限后饱和，不再增减
+        :param stripes: 分段锁的个数 为None时不加锁，只能在一个线程里写入
         """
         if not (0 < error_rate < 1):
             raise ValueError("Error_Rate must be between 0 and 1.")
         if not capacity > 0:
             raise ValueError("Capacity must be > 0")
+        if counter_bits not in (None, 4, 8):
+            raise ValueError("counter_bits must be 4 or 8")
         m, k, *_ = calculation_bloom_filter(capacity, error_rate)
         self.count = 0
         self.m = m  # len of array
         self.k = k  # number of hash functions
         self.seeds = self._seeds.copy()[0:k]
-        self.hashmaps = [hash_type(m, seed) for seed in self.seeds]
-        self.array = array.array(array_type, [0] * m)
+        self.double_hashing = bool(double_hashing)
+        self.hashmaps = _make_hashmaps(hash_type, m, self.seeds, self.double_hashing)
+        self._init_counters(array_type if counter_bits is None else str(counter_bits))
+        if counter_bits is None:
+            self.array = array.array(array_type, [0]) * m  # 不创建中间的list
+        else:
+            self.array = bytearray((m * counter_bits + 7) // 8)
+        if stripes is not None:
+            self._locks = _StripedLocks(stripes)
+
+    def _init_counters(self, typecode: str) -> None:
+        """
+        :param typecode: array.array类型标志，或者"4"/"8"表示紧凑的饱和计数器
+        """
+        self.typecode = typecode
+        if typecode in ("4", "8"):
+            self.counter_bits = int(typecode)
+            self._dtype = np.dtype(np.uint8)
+            self._max = (1 << self.counter_bits) - 1
+        else:
+            self.counter_bits = None
+            self._dtype = np.dtype(typecode)
+            # 保证批量计算时int64不会溢出
+            self._max = min(int(np.iinfo(self._dtype).max), 1 << 62)
+
+    def _get(self, offset: int) -> int:
+        if self.counter_bits == 4:
+            return (self.array[offset >> 1] >> ((offset & 1) << 2)) & 15
+        return self.array[offset]
+
+    def _change(self, offset: int, delta: int) -> None:
+        """修改单个计数器 最小为0，饱和的计数器不再变化"""
+        current = int(self._get(offset))
+        if current == self._max:
+            return
+        value = min(max(current + delta, 0), self._max)
+        if self.counter_bits == 4:
+            shift = (offset & 1) << 2
+            byte = self.array[offset >> 1] & (0xFF ^ (15 << shift))
+            self.array[offset >> 1] = byte | (value << shift)
+        else:
+            self.array[offset] = value
 
     def add(self, item: Any) -> bool:
         """
@@ -118,17 +499,16 @@ class CountMemoryBloomFilter(BaseBloomFilter):
         :param item: 一个可以变成str的对象
         :return: bool 是否插入成功
         """
-        if item not in self:
-            if not isinstance(item, str):
-                item = str(item)
-
-            for map_ in self.hashmaps:
-                value = map_.hash(item)
-                assert 0 <= value < self.m
-                self.array[value] += 1
-            self.count += 1
-            return True
-        return False
+        if not isinstance(item, str):
+            item = str(item)
+        offsets = list(self._offsets(item))
+        with self._hold(offsets):
+            if all(self._get(value) > 0 for value in offsets):
+                return False
+            for value in offsets:
+                self._change(value, 1)
+            self._add_count(1)
+        return True
 
     def remove(self, item: Any) -> bool:
         """
@@ -136,34 +516,1327 @@ class CountMemoryBloomFilter(BaseBloomFilter):
         :param item:
         :return: 是否删除
         """
-        if item in self:
-            if not isinstance(item, str):
-                item = str(item)
+        if not isinstance(item, str):
+            item = str(item)
+        offsets = list(self._offsets(item))
+        with self._hold(offsets):
+            if not all(self._get(value) > 0 for value in offsets):
+                return False
+            for value in offsets:
+                self._change(value, -1)
+            self._add_count(-1)
+        return True
+
+    def clear(self) -> None:
+        """清空过滤器 整块缓冲区置零"""
+        with self._hold():
+            self._counters().fill(0)
+            self.count = 0
+
+    def __contains__(self, item: Any) -> bool:
+        if not isinstance(item, str):
+            item = str(item)
+        return all(self._get(value) > 0 for value in self._offsets(item))
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _usage(self) -> Tuple[int, int]:
+        """(非0的计数器个数, 达到上限的计数器个数)"""
+        counters = self._counters()
+        if self.counter_bits == 4:
+            nibbles = (counters & 15, counters >> 4)
+        else:
+            nibbles = (counters,)
+        return (
+            sum(int(np.count_nonzero(part)) for part in nibbles),
+            sum(int(np.count_nonzero(part == self._max)) for part in nibbles),
+        )
+
+    def _health(self) -> Tuple[float, float, int]:
+        return bloom_health([(self.m, self.k, self._usage()[0])])
+
+    def saturation(self) -> float:
+        """
+        达到上限的计数器占所有计数器的比例 饱和的计数器不再增减，
+        删除元素后可能留下误判，比例变大时应该换更宽的计数器
+        """
+        return self._usage()[1] / self.m
+
+    def _counters(self) -> np.ndarray:
+        """self.array的numpy视图 不复制数据"""
+        return np.frombuffer(self.array, dtype=self._dtype)
+
+    def _read_many(self, offsets: np.ndarray) -> np.ndarray:
+        """批量读取计数器 返回与offsets形状相同的数组"""
+        counters = self._counters()
+        if self.counter_bits == 4:
+            return (counters[offsets >> 1] >> ((offsets & 1) << 2)) & 15
+        return counters[offsets]
+
+    def _change_many(self, offsets: np.ndarray, delta: int) -> None:
+        """批量修改计数器 offsets可以重复，最小为0，饱和的计数器不再变化"""
+        targets, times = np.unique(offsets, return_counts=True)
+        current = self._read_many(targets).astype(np.int64)
+        values = np.clip(current + delta * times, 0, self._max)
+        values[current == self._max] = self._max
+        counters = self._counters()
+        if self.counter_bits == 4:
+            # 同一个字节的两个计数器可能同时修改，用ufunc.at逐个生效
+            shifts = ((targets & 1) << 2).astype(np.uint8)
+            np.bitwise_and.at(counters, targets >> 1, ~(np.uint8(15) << shifts))
+            np.bitwise_or.at(counters, targets >> 1, values.astype(np.uint8) << shifts)
+        else:
+            counters[targets] = values
+
+    def _header(self) -> serialization.FilterHeader:
+        return serialization.FilterHeader(
+            serialization.KIND_COUNTERS,
+            self.m,
+            self.k,
+            tuple(self.seeds),
+            type(self.hashmaps[0]).__name__,
+            self.count,
+            self.double_hashing,
+            self.typecode,
+        )
+
+    def to_bytes(self) -> bytes:
+        """
+        序列化成 头部+原始计数器数组 的紧凑二进制格式 计数器是本机字节序
+        头部记录了m, k, 种子, hash函数类型, count和计数器类型
+        """
+        return serialization.pack_header(self._header()) + self._counters().tobytes()
+
+    @classmethod
+    def from_bytes(
+        cls,
+        data,
+        hash_type: Optional[Type[BaseHash]] = None,
+        copy: Optional[bool] = False,
+    ) -> "CountMemoryBloomFilter":
+        """
+        从to_bytes的结果加载 默认不复制数据，计数器是引用传入缓冲区的numpy数组
+        传入只读的缓冲区(比如bytes)时得到的过滤器也是只读的，需要修改时传入copy=True
+        :param data: 支持buffer协议的对象 bytes/bytearray/memoryview/mmap等
+        :param hash_type: hash函数类型 默认使用头部记录的类型
+        :param copy: 是否复制数据
+        :return: CountMemoryBloomFilter
+        """
+        view = memoryview(data).cast("B")
+        header, offset = serialization.unpack_header(view)
+        hash_type = serialization.check_header(
+            header, serialization.KIND_COUNTERS, hash_type
+        )
+        return cls._from_buffer(header, hash_type, view[offset:], copy)
+
+    @classmethod
+    def _from_buffer(
+        cls,
+        header: serialization.FilterHeader,
+        hash_type: Type[BaseHash],
+        buffer: memoryview,
+        copy: Optional[bool] = False,
+    ) -> "CountMemoryBloomFilter":
+        self = cls.__new__(cls)
+        self.count = header.count
+        self.m = header.m
+        self.k = header.k
+        self.seeds = list(header.seeds)
+        self.double_hashing = header.double_hashing
+        self.hashmaps = _make_hashmaps(
+            hash_type, self.m, self.seeds, self.double_hashing
+        )
+        self._init_counters(header.typecode)
+        if self.counter_bits is None:
+            size = header.m
+        else:
+            size = (header.m * self.counter_bits + 7) // 8
+        counters = np.frombuffer(buffer, dtype=self._dtype, count=size)
+        if not copy:
+            self.array = counters
+        elif self.counter_bits is None:
+            self.array = array.array(header.typecode, counters.tobytes())
+        else:
+            self.array = bytearray(counters.tobytes())
+        return self
+
+    def __reduce_ex__(self, protocol):
+        # protocol 5 用PickleBuffer传递计数器数组，可以带外传输，避免额外的复制
+        if protocol >= 5:
+            data = pickle.PickleBuffer(self.array)
+        else:
+            data = self._counters().tobytes()
+        return _restore, (
+            type(self),
+            type(self.hashmaps[0]),
+            serialization.pack_header(self._header()),
+            data,
+        )
+
+    def add_many(self, items: Iterable[Any]) -> np.ndarray:
+        """
+        批量加入元素 计数器用numpy批量递增
+        同一批次中重复的元素只有第一次出现时算插入成功
+        :param items: 可迭代对象，元素需可以变成str
+        :return: 布尔数组 每个元素是否插入成功
+        """
+        unique, index, first = _prepare_batch(items)
+        offsets = self._offsets_many(unique)
+        with self._hold(offsets):
+            added = ~(self._read_many(offsets) > 0).all(axis=1)
+            if added.any():
+                self._change_many(offsets[added].ravel(), 1)
+                self._add_count(int(added.sum()))
+        return added[index] & first
+
+    def remove_many(self, items: Iterable[Any]) -> np.ndarray:
+        """
+        批量删除元素 是否存在以批次开始时的状态为准
+        计数器最多减到0
+        :param items: 可迭代对象，元素需可以变成str
+        :return: 布尔数组 每个元素是否删除
+        """
+        unique, index, first = _prepare_batch(items)
+        offsets = self._offsets_many(unique)
+        with self._hold(offsets):
+            removed = (self._read_many(offsets) > 0).all(axis=1)
+            if removed.any():
+                self._change_many(offsets[removed].ravel(), -1)
+                self._add_count(-int(removed.sum()))
+        return removed[index] & first
+
+    def contains_many(self, items: Iterable[Any]) -> np.ndarray:
+        """
+        批量判断元素是否存在
+        :param items: 可迭代对象，元素需可以变成str
+        :return: 布尔数组
+        """
+        unique, index, _ = _prepare_batch(items)
+        offsets = self._offsets_many(unique)
+        return (self._read_many(offsets) > 0).all(axis=1)[index]
+
+    def _saturating_add(self, counters: np.ndarray, others: np.ndarray) -> np.ndarray:
+        """计数器逐个相加，超过上限的饱和 先截断others，相加不会溢出"""
+        return counters + np.minimum(others, self._max - counters)
+
+    def _combine(
+        self, other: "CountMemoryBloomFilter", operation, estimate: bool
+    ) -> None:
+        """
+        与另一个参数相同的过滤器逐个计数器运算，结果写入self
+        :param operation: 两个计数器数组的运算 self._saturating_add/np.minimum
+        :param estimate: count按非0的计数器个数重新估计，为False时直接相加
+        """
+        _check_compatible(self, other)
+        others = other._counters()
+        with self._hold():
+            counters = self._counters()
+            if self.counter_bits == 4:
+                low = operation(counters & 15, others & 15)
+                high = operation(counters >> 4, others >> 4)
+                counters[:] = low | (high << 4)
+                nonzero = np.count_nonzero(low) + np.count_nonzero(high)
+            else:
+                counters[:] = operation(counters, others)
+                nonzero = np.count_nonzero(counters)
+            if estimate:
+                self.count = _estimated_count(self.m, self.k, nonzero)
+            else:
+                self.count += other.count
+
+    def _copy(self) -> "CountMemoryBloomFilter":
+        """复制计数器数组 得到不带锁的过滤器"""
+        return self._from_buffer(
+            self._header(),
+            type(self.hashmaps[0]),
+            memoryview(self._counters()).cast("B"),
+            True,
+        )
+
+    def merge(self, other: "CountMemoryBloomFilter") -> None:
+        """
+        合并另一个参数相同的过滤器 计数器逐个相加，超过上限的饱和
+        count直接相加，适合合并元素没有交集的分片，两边都有的元素会重复计数
+        :param other: m, k, 种子, hash函数类型和计数器类型都相同的过滤器
+        """
+        self._combine(other, self._saturating_add, False)
+
+    def union(self, *others: "CountMemoryBloomFilter") -> "CountMemoryBloomFilter":
+        """
+        并集 返回新的过滤器，计数器逐个相加，超过上限的饱和
+        两边都有的元素要删除两次，count按非0的计数器个数估计
+        :param others: m, k, 种子, hash函数类型和计数器类型都相同的过滤器
+        :return: 新的过滤器
+        """
+        result = self._copy()
+        for other in others:
+            result |= other
+        return result
+
+    def intersection(
+        self, *others: "CountMemoryBloomFilter"
+    ) -> "CountMemoryBloomFilter":
+        """
+        交集 返回新的过滤器，计数器逐个取最小值，count按非0的计数器个数估计
+        :param others: m, k, 种子, hash函数类型和计数器类型都相同的过滤器
+        :return: 新的过滤器
+        """
+        result = self._copy()
+        for other in others:
+            result &= other
+        return result
+
+    def __or__(self, other: "CountMemoryBloomFilter") -> "CountMemoryBloomFilter":
+        return self.union(other)
+
+    def __and__(self, other: "CountMemoryBloomFilter") -> "CountMemoryBloomFilter":
+        return self.intersection(other)
+
+    def __ior__(self, other: "CountMemoryBloomFilter") -> "CountMemoryBloomFilter":
+        self._combine(other, self._saturating_add, True)
+        return self
+
+    def __iand__(self, other: "CountMemoryBloomFilter") -> "CountMemoryBloomFilter":
+        self._combine(other, np.minimum, True)
+        return self
+
+
+class MmapMemoryBloomFilter(MemoryBloomFilter):
+    """
+    BloomFilter backed by a memory-mapped file
+    位数组直接映射到文件，打开时不需要重建，由操作系统按需换页，重启后数据还在
+    多个进程可以同时以只读方式打开同一个文件
+    """
+
+    def __init__(
+        self,
+        path: Union[str, "os.PathLike[str]"],
+        capacity: Optional[int] = None,
+        error_rate: Optional[float] = 0.001,
+        hash_type: Optional[Type[BaseHash]] = None,
+        double_hashing: Optional[bool] = False,
+        readonly: Optional[bool] = False,
+    ):
+        """
 
-            for map_ in self.hashmaps:
-                value = map_.hash(item)
-                assert 0 <= value < self.m
-                self.array[value] -= 1
+        :param path: 文件路径 不存在时新建
+        :param capacity: 容量 为None时按文件头里的参数打开已有文件
+        :param error_rate: 错误率
+        :param hash_type: hash函数类型 新建时默认MMH3HashMap，打开时默认使用文件头记录的类型
+        :param double_hashing: 只计算一次128位摘要推导出k个偏移量，与默认模式的数据不兼容
+        :param readonly: 只读打开 可以多个进程共享
+        """
+        if capacity is not None:
+            if not (0 < error_rate < 1):
+                raise ValueError("Error_Rate must be between 0 and 1.")
+            if not capacity > 0:
+                raise ValueError("Capacity must be > 0")
+        self.path = os.fspath(path)
+        self.readonly = bool(readonly)
+        if not os.path.exists(self.path):
+            if capacity is None:
+                raise FileNotFoundError(self.path)
+            if self.readonly:
+                raise ValueError("can not create a filter in readonly mode")
+            m, k, *_ = calculation_bloom_filter(capacity, error_rate)
+            header = serialization.FilterHeader(
+                serialization.KIND_BITS,
+                m,
+                k,
+                tuple(self._seeds[0:k]),
+                (hash_type or MMH3HashMap).__name__,
+                0,
+                bool(double_hashing),
+            )
+            data = serialization.pack_header(header)
+            with open(self.path, "wb") as f:
+                f.write(data)
+                f.truncate(len(data) + (m + 7) // 8)
+
+        self._file = open(self.path, "rb" if self.readonly else "r+b")
+        self._mmap = mmap.mmap(
+            self._file.fileno(),
+            0,
+            access=mmap.ACCESS_READ if self.readonly else mmap.ACCESS_WRITE,
+        )
+        try:
+            header, offset = serialization.unpack_header(self._mmap)
+            if capacity is None:
+                hash_type = serialization.check_header(
+                    header, serialization.KIND_BITS, hash_type
+                )
+            else:
+                m, k, *_ = calculation_bloom_filter(capacity, error_rate)
+                hash_type = serialization.check_header(
+                    header, serialization.KIND_BITS, hash_type, m, k, double_hashing
+                )
+        except Exception:
+            self.close()
+            raise
+        self.m = header.m  # len of bitarray
+        self.k = header.k  # number of hash functions
+        self.seeds = list(header.seeds)
+        self.double_hashing = header.double_hashing
+        self._build_hashmaps(hash_type)
+        self._view = memoryview(self._mmap)[offset : offset + (self.m + 7) // 8]
+        self.bitarray = bitarray.bitarray(buffer=self._view, endian="little")
+
+    @property
+    def count(self) -> int:
+        """已插入的元素个数 保存在文件头里，其他进程的写入也能看到"""
+        (count,) = serialization.COUNT.unpack_from(
+            self._mmap, serialization.COUNT_OFFSET
+        )
+        return count
+
+    @count.setter
+    def count(self, value: int) -> None:
+        serialization.COUNT.pack_into(self._mmap, serialization.COUNT_OFFSET, value)
+
+    def flush(self) -> None:
+        """把修改写回文件"""
+        if not self.readonly:
+            self._mmap.flush()
+
+    def close(self) -> None:
+        """写回并关闭文件"""
+        if getattr(self, "bitarray", None) is not None:
+            self.flush()
+            self.bitarray = None
+            self._view.release()
+        self._mmap.close()
+        self._file.close()
+
+    @classmethod
+    def _from_buffer(cls, *args, **kwargs) -> MemoryBloomFilter:
+        # 从缓冲区加载得到的是普通的MemoryBloomFilter
+        return MemoryBloomFilter._from_buffer(*args, **kwargs)
+
+    def __reduce_ex__(self, protocol):
+        # 只传递路径 在另一个进程里重新映射同一个文件
+        self.flush()
+        return type(self), (
+            self.path,
+            None,
+            None,
+            type(self.hashmaps[0]),
+            None,
+            self.readonly,
+        )
+
+    def __enter__(self) -> "MmapMemoryBloomFilter":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+
+_attach_lock = threading.Lock()
+
+
+def _attach_shared_memory(name: str):
+    """
+    按名字连接共享内存，不注册到resource_tracker 只有新建的进程负责释放
+    python3.13以前连接时也会注册，这个进程的resource_tracker在它退出时会unlink，其他进程随之失去过滤器
+    不能注册之后再unregister: 与新建的进程共用同一个resource_tracker时(同一个进程，或者multiprocessing的子进程)，
+    会把新建时的注册一起删掉，新建的进程unlink时resource_tracker报错
+    连接的一瞬间其他线程新建的共享内存也不会注册，只影响进程崩溃时的自动释放
+    """
+    from multiprocessing import shared_memory
+
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name, track=False)
+    tracker = shared_memory.resource_tracker
+    with _attach_lock:
+        shared_memory.resource_tracker = _UntrackedRegister(tracker)
+        try:
+            return shared_memory.SharedMemory(name)
+        finally:
+            shared_memory.resource_tracker = tracker
+
+
+class _UntrackedRegister:
+    """连接时替换shared_memory模块里的resource_tracker 只跳过register"""
+
+    def __init__(self, tracker):
+        self._tracker = tracker
+
+    def register(self, name: str, rtype: str) -> None:
+        pass
+
+    def __getattr__(self, name: str):
+        return getattr(self._tracker, name)
+
+
+class SharedMemoryBloomFilter(MemoryBloomFilter):
+    """
+    BloomFilter backed by multiprocessing.shared_memory
+    头部和位数组放在一块有名字的共享内存里，一个进程新建，其他进程按名字连接，不复制数据，
+    整个进程池只占一份内存。格式与to_bytes一样，count保存在头部里
+
+    并发的保证:
+    - 判断不加锁 add返回之后所有进程都能看到这个元素，正在进行的add可能暂时看不到
+    - 置位是按字节的读-改-写，不是原子操作，多个进程同时写入同一个字节会丢失置位，造成误判为不存在，
+      所以多个进程写入时需要传入lock，置位和count的更新都在锁里进行，哈希在锁外计算
+    - 不传lock时只能有一个进程写入，其他进程只读
+    """
+
+    def __init__(
+        self,
+        name: Optional[str] = None,
+        capacity: Optional[int] = None,
+        error_rate: Optional[float] = 0.001,
+        hash_type: Optional[Type[BaseHash]] = None,
+        double_hashing: Optional[bool] = False,
+        lock=None,
+    ):
+        """
+
+        :param name: 共享内存的名字 新建时为None则自动生成
+        :param capacity: 容量 不为None时新建共享内存，为None时按名字连接已有的，参数从头部读取
+        :param error_rate: 错误率
+        :param hash_type: hash函数类型 新建时默认MMH3HashMap，连接时默认使用头部记录的类型
+        :param double_hashing: 只计算一次128位摘要推导出k个偏移量，与默认模式的数据不兼容
+        :param lock: 进程间的锁 比如multiprocessing.Lock()，需要在创建进程时传给子进程
+        """
+        from multiprocessing import shared_memory  # python3.8+
+
+        if capacity is not None:
+            if not (0 < error_rate < 1):
+                raise ValueError("Error_Rate must be between 0 and 1.")
+            if not capacity > 0:
+                raise ValueError("Capacity must be > 0")
+            m, k, *_ = calculation_bloom_filter(capacity, error_rate)
+            header = serialization.pack_header(
+                serialization.FilterHeader(
+                    serialization.KIND_BITS,
+                    m,
+                    k,
+                    tuple(self._seeds[0:k]),
+                    (hash_type or MMH3HashMap).__name__,
+                    0,
+                    bool(double_hashing),
+                )
+            )
+            # 新建的共享内存全是0，只需要写入头部
+            self._shm = shared_memory.SharedMemory(
+                name, create=True, size=len(header) + (m + 7) // 8
+            )
+            self._shm.buf[: len(header)] = header
+        elif name is None:
+            raise ValueError("name is required to attach a shared filter")
+        else:
+            # 只有新建的进程负责释放，连接的进程退出时不能被resource_tracker释放掉
+            self._shm = _attach_shared_memory(name)
+        self.owner = capacity is not None  # 是否由这个进程新建 负责unlink
+        try:
+            header, offset = serialization.unpack_header(self._shm.buf)
+            hash_type = serialization.check_header(
+                header, serialization.KIND_BITS, hash_type
+            )
+        except Exception:
+            self._shm.close()
+            raise
+        self.name = self._shm.name
+        self.lock = lock
+        self.m = header.m  # len of bitarray
+        self.k = header.k  # number of hash functions
+        self.seeds = list(header.seeds)
+        self.double_hashing = header.double_hashing
+        self._build_hashmaps(hash_type)
+        self._view = self._shm.buf[offset : offset + (self.m + 7) // 8]
+        self.bitarray = bitarray.bitarray(buffer=self._view, endian="little")
+
+    @property
+    def count(self) -> int:
+        """已插入的元素个数 保存在共享内存的头部里，所有进程共享"""
+        (count,) = serialization.COUNT.unpack_from(
+            self._shm.buf, serialization.COUNT_OFFSET
+        )
+        return count
+
+    @count.setter
+    def count(self, value: int) -> None:
+        serialization.COUNT.pack_into(self._shm.buf, serialization.COUNT_OFFSET, value)
+
+    def _locked(self):
+        return self.lock if self.lock is not None else contextlib.nullcontext()
+
+    def add(self, item: Any) -> bool:
+        """
+        加入元素
+        :param item: 一个可以变成str的对象
+        :return: bool 是否插入成功
+        """
+        return bool(self.add_many([item])[0])
+
+    def add_many(self, items: Iterable[Any]) -> np.ndarray:
+        """
+        批量加入元素 每批只加一次锁
+        :param items: 可迭代对象，元素需可以变成str
+        :return: 布尔数组 每个元素是否插入成功
+        """
+        unique, index, first = _prepare_batch(items)
+        offsets = self._offsets_many(unique)  # 计算哈希不需要加锁
+        with self._locked():
+            added = self._set_bits(offsets)
+        return added[index] & first
+
+    def clear(self) -> None:
+        """清空过滤器"""
+        with self._locked():
+            super().clear()
+
+    def _combine(self, other: MemoryBloomFilter, operation, estimate: bool) -> None:
+        with self._locked():
+            super()._combine(other, operation, estimate)
+
+    def close(self) -> None:
+        """断开这个进程与共享内存的连接 其他进程不受影响"""
+        if getattr(self, "bitarray", None) is not None:
+            self.bitarray = None
+            self._view.release()
+        self._shm.close()
+
+    def unlink(self) -> None:
+        """释放共享内存 所有进程都close之后内存才会真正释放，通常由新建的进程调用"""
+        if not self.owner and sys.version_info < (3, 13):
+            from multiprocessing import resource_tracker
+
+            # 连接时没有注册，unlink会unregister，先补上注册
+            resource_tracker.register(self._shm._name, "shared_memory")
+        self._shm.unlink()
+
+    @classmethod
+    def _from_buffer(cls, *args, **kwargs) -> MemoryBloomFilter:
+        # 从缓冲区加载得到的是普通的MemoryBloomFilter
+        return MemoryBloomFilter._from_buffer(*args, **kwargs)
+
+    def __reduce_ex__(self, protocol):
+        # 只传递名字 在另一个进程里连接同一块共享内存
+        return type(self), (
+            self.name,
+            None,
+            None,
+            type(self.hashmaps[0]),
+            None,
+            self.lock,
+        )
+
+    def __enter__(self) -> "SharedMemoryBloomFilter":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+        if self.owner:
+            self.unlink()
+
+
+BLOCK_BITS = 512  # 64字节 一个缓存行
+# 块内偏移先对这个质数取模再对BLOCK_BITS取模，避免hash函数的低位不够随机(比如PyHashMap)
+_BLOCK_HASH_RANGE = 4294967291
+
+
+def _aligned_bitarray(m: int, alignment: int = 64) -> bitarray.bitarray:
+    """按alignment字节对齐的全0位数组"""
+    nbytes = (m + 7) // 8
+    raw = np.zeros(nbytes + alignment, dtype=np.uint8)
+    start = -raw.ctypes.data % alignment
+    return bitarray.bitarray(buffer=raw[start : start + nbytes], endian="little")
+
+
+class BlockedMemoryBloomFilter(MemoryBloomFilter):
+    """
+    Cache-line blocked BloomFilter that uses memory
+    每个元素先选定一个64字节的块，k个位都落在这个块里，一次查询大约只有一次cache miss
+    块内元素个数不均匀，相同错误率下需要的内存略多一些
+    一个块正好是一段，多线程写入时每个元素只需要获取一把分段锁
+    """
+
+    _kind = serialization.KIND_BLOCKED_BITS
+
+    def __init__(
+        self,
+        capacity: int,
+        error_rate: Optional[float] = 0.001,
+        hash_type: Optional[Type[BaseHash]] = MMH3HashMap,
+        double_hashing: Optional[bool] = False,
+        stripes: Optional[int] = None,
+    ):
+        """
+
+        :param capacity: 容量
+        :param error_rate: 错误率
+        :param hash_type: hash函数类型
+        :param double_hashing: 只计算一次128位摘要，h1选块，h2推导出块内的k个位
+        :param stripes: 分段锁的个数 为None时不加锁，只能在一个线程里写入
+        """
+        if not (0 < error_rate < 1):
+            raise ValueError("Error_Rate must be between 0 and 1.")
+        if not capacity > 0:
+            raise ValueError("Capacity must be > 0")
+        m, k, *_ = calculation_bloom_filter(capacity, error_rate, BLOCK_BITS)
+        self.count = 0
+        self.m = m  # len of bitarray 是BLOCK_BITS的整数倍
+        self.k = k  # number of hash functions
+        self.seeds = self._seeds.copy()[0 : k + 1]  # 第一个种子用来选块
+        self.double_hashing = bool(double_hashing)
+        self._build_hashmaps(hash_type)
+        self.bitarray = _aligned_bitarray(m)
+        if stripes is not None:
+            self._locks = _StripedLocks(stripes)
+
+    def _build_hashmaps(self, hash_type: Type[BaseHash]) -> None:
+        self.blocks = self.m // BLOCK_BITS
+        if self.double_hashing:
+            self.hashmaps = [hash_type(self.m, self.seeds[0])]
+        else:
+            self.hashmaps = [hash_type(self.blocks, self.seeds[0])] + [
+                hash_type(_BLOCK_HASH_RANGE, seed) for seed in self.seeds[1:]
+            ]
+
+    @timed_hash
+    def _offsets(self, item: str) -> List[int]:
+        if self.double_hashing:
+            h1, h2 = self.hashmaps[0].hash128(item)
+            base = (h1 % self.blocks) * BLOCK_BITS
+            # 块只有512位，普通的双重哈希冲突较多，加上三次项(enhanced double hashing)
+            step = h2 >> 32
+            return [
+                base + (h2 + i * step + (i**3 - i) // 6) % BLOCK_BITS
+                for i in range(self.k)
+            ]
+        base = self.hashmaps[0].hash(item) * BLOCK_BITS
+        return [base + map_.hash(item) % BLOCK_BITS for map_ in self.hashmaps[1:]]
+
+    @timed_hash
+    def _offsets_many(self, items: List[str]) -> np.ndarray:
+        if self.double_hashing:
+            digests = np.array(
+                [self.hashmaps[0].hash128(item) for item in items], dtype=np.uint64
+            ).reshape(len(items), 2)
+            base = (digests[:, 0] % np.uint64(self.blocks)) * np.uint64(BLOCK_BITS)
+            step = digests[:, 1] >> np.uint64(32)
+            steps = np.arange(self.k, dtype=np.uint64)
+            cubic = (steps**3 - steps) // np.uint64(6)
+            # uint64溢出回绕不影响对BLOCK_BITS取模的结果
+            inner = (
+                digests[:, 1][:, None] + steps[None, :] * step[:, None] + cubic
+            ) % np.uint64(BLOCK_BITS)
+            return (base[:, None] + inner).astype(np.int64)
+        hashes = np.array(
+            [[map_.hash(item) for map_ in self.hashmaps] for item in items],
+            dtype=np.int64,
+        ).reshape(len(items), len(self.hashmaps))
+        return hashes[:, :1] * BLOCK_BITS + hashes[:, 1:] % BLOCK_BITS
+
+
+class ScalableMemoryBloomFilter(BaseBloomFilter):
+    """
+    Scalable BloomFilter that uses memory (Almeida et al.)
+    由多个MemoryBloomFilter串联而成，当前的过滤器装满后新建一个容量按growth倍增长、
+    错误率按ratio倍收紧的过滤器。第i个的错误率是 error_rate*(1-ratio)*ratio**i，
+    总的错误率不超过error_rate，内存随实际的元素个数增长
+    """
+
+    def __init__(
+        self,
+        initial_capacity: int,
+        error_rate: Optional[float] = 0.001,
+        hash_type: Optional[Type[BaseHash]] = MMH3HashMap,
+        double_hashing: Optional[bool] = False,
+        growth: Optional[int] = 2,
+        ratio: Optional[float] = 0.9,
+    ):
+        """
+
+        :param initial_capacity: 第一个过滤器的容量
+        :param error_rate: 总的错误率
+        :param hash_type: hash函数类型
+        :param double_hashing: 是否只计算一次128位摘要推导出k个偏移量
+        :param growth: 每个新过滤器的容量是上一个的多少倍
+        :param ratio: 每个新过滤器的错误率是上一个的多少倍
+        """
+        if not (0 < error_rate < 1):
+            raise ValueError("Error_Rate must be between 0 and 1.")
+        if not initial_capacity > 0:
+            raise ValueError("Capacity must be > 0")
+        if not growth >= 1:
+            raise ValueError("growth must be >= 1")
+        if not (0 < ratio < 1):
+            raise ValueError("ratio must be between 0 and 1")
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        self.hash_type = hash_type
+        self.double_hashing = bool(double_hashing)
+        self.growth = growth
+        self.ratio = ratio
+        self.filters: List[MemoryBloomFilter] = []
+        self._add_filter()
+
+    def _stage_capacity(self, index: int) -> int:
+        return scalable_stage(
+            self.initial_capacity, self.error_rate, self.growth, self.ratio, index
+        )[0]
+
+    def _add_filter(self) -> MemoryBloomFilter:
+        capacity, error_rate = scalable_stage(
+            self.initial_capacity,
+            self.error_rate,
+            self.growth,
+            self.ratio,
+            len(self.filters),
+        )
+        bloom_filter = MemoryBloomFilter(
+            capacity,
+            error_rate,
+            self.hash_type,
+            self.double_hashing,
+        )
+        self.filters.append(bloom_filter)
+        return bloom_filter
+
+    def _current_filter(self) -> MemoryBloomFilter:
+        """最新的过滤器 装满了就新建一个"""
+        bloom_filter = self.filters[-1]
+        if len(bloom_filter) >= self._stage_capacity(len(self.filters) - 1):
+            bloom_filter = self._add_filter()
+        return bloom_filter
+
+    @property
+    def capacity(self) -> int:
+        """当前所有过滤器的容量之和"""
+        return sum(self._stage_capacity(i) for i in range(len(self.filters)))
+
+    def add(self, item: Any) -> bool:
+        """
+        加入元素
+        :param item: 一个可以变成str的对象
+        :return: bool 是否插入成功
+        """
+        if not isinstance(item, str):
+            item = str(item)
+        if item in self:  # 已经存在的元素不占用容量，不会新建过滤器
+            return False
+        return self._current_filter().add(item)
+
+    def clear(self) -> None:
+        """清空过滤器 只保留第一个"""
+        del self.filters[1:]
+        self.filters[0].clear()
+
+    def __len__(self) -> int:
+        return sum(len(bloom_filter) for bloom_filter in self.filters)
+
+    def _health(self) -> Tuple[float, float, int]:
+        # 填充率是所有阶段合计的，误判率是任意一个阶段误判的概率
+        return bloom_health(
+            [(f.m, f.k, f.bitarray.count()) for f in self.filters], stages=True
+        )
+
+    def __contains__(self, item: Any) -> bool:
+        if not isinstance(item, str):
+            item = str(item)
+        # 新的过滤器元素更多，先查
+        return any(item in bloom_filter for bloom_filter in reversed(self.filters))
+
+    def _contains_unique(self, unique: List[str]) -> np.ndarray:
+        found = np.zeros(len(unique), dtype=bool)
+        for bloom_filter in reversed(self.filters):
+            rest = np.flatnonzero(~found)
+            if not len(rest):
+                break
+            found[rest] = bloom_filter.contains_many([unique[i] for i in rest])
+        return found
+
+    def add_many(self, items: Iterable[Any]) -> np.ndarray:
+        """
+        批量加入元素 按当前过滤器的剩余容量分段写入，装满后新建过滤器
+        :param items: 可迭代对象，元素需可以变成str
+        :return: 布尔数组 每个元素是否插入成功
+        """
+        unique, index, first = _prepare_batch(items)
+        added = ~self._contains_unique(unique)
+        pending = np.flatnonzero(added)
+        while len(pending):
+            bloom_filter = self._current_filter()
+            room = self._stage_capacity(len(self.filters) - 1) - len(bloom_filter)
+            chunk, pending = pending[:room], pending[room:]
+            added[chunk] = bloom_filter.add_many([unique[i] for i in chunk])
+        return added[index] & first
+
+    def contains_many(self, items: Iterable[Any]) -> np.ndarray:
+        """
+        批量判断元素是否存在
+        :param items: 可迭代对象，元素需可以变成str
+        :return: 布尔数组
+        """
+        unique, index, _ = _prepare_batch(items)
+        return self._contains_unique(unique)[index]
+
+
+class CuckooMemoryFilter(BaseCuckooFilter):
+    """
+    Cuckoo filter that uses memory (Fan et al.)
+    指纹保存在shape为(桶数, bucket_size)的numpy数组里，0表示空槽
+    """
+
+    def __init__(
+        self,
+        capacity: int,
+        error_rate: Optional[float] = 0.001,
+        hash_type: Optional[Type[BaseHash]] = MMH3HashMap,
+        fingerprint_bits: Optional[Literal[8, 16, 32]] = None,
+        bucket_size: Optional[int] = 4,
+        max_kicks: Optional[int] = 500,
+    ):
+        """
+
+        :param capacity: 容量
+        :param error_rate: 错误率 fingerprint_bits为None时用来选择指纹位数
+        :param hash_type: hash函数类型 需要实现hash128
+        :param fingerprint_bits: 指纹位数 8/16/32
+        :param bucket_size: 每个桶的槽数
+        :param max_kicks: 插入时最多踢出多少次，超过就认为过滤器已满
+        """
+        self._init_cuckoo(
+            capacity, error_rate, hash_type, fingerprint_bits, bucket_size, max_kicks
+        )
+        self.table = np.zeros(
+            (self.num_buckets, self.bucket_size), dtype=self._fingerprint_dtype
+        )
+
+    def _lookup(self, i1: int, i2: int, fingerprint: int) -> bool:
+        return bool((self.table[i1] == fingerprint).any()) or bool(
+            (self.table[i2] == fingerprint).any()
+        )
+
+    def _put(self, index: int, fingerprint: int) -> bool:
+        """放进桶里的空槽 没有空槽返回False"""
+        empty = np.flatnonzero(self.table[index] == 0)
+        if not len(empty):
+            return False
+        self.table[index, empty[0]] = fingerprint
+        return True
+
+    def _insert(self, i1: int, i2: int, fingerprint: int) -> None:
+        """
+        两个候选桶都满时随机踢出一个指纹，把它放到它的另一个候选桶，最多max_kicks次
+        失败时按原路径换回，过滤器保持插入前的状态
+        """
+        if self._put(i1, fingerprint) or self._put(i2, fingerprint):
+            return
+        index = random.choice((i1, i2))
+        path: List[Tuple[int, int]] = []
+        for _ in range(self.max_kicks):
+            slot = random.randrange(self.bucket_size)
+            victim = int(self.table[index, slot])
+            self.table[index, slot] = fingerprint
+            fingerprint = victim
+            path.append((index, slot))
+            index = self._alt_index(index, fingerprint)
+            if self._put(index, fingerprint):
+                return
+        for index, slot in reversed(path):
+            victim = int(self.table[index, slot])
+            self.table[index, slot] = fingerprint
+            fingerprint = victim
+        raise OverflowError("CuckooMemoryFilter is full")
+
+    def _delete(self, i1: int, i2: int, fingerprint: int) -> bool:
+        for index in (i1, i2):
+            found = np.flatnonzero(self.table[index] == fingerprint)
+            if len(found):
+                self.table[index, found[0]] = 0
+                return True
+        return False
+
+    def add(self, item: Any) -> bool:
+        """
+        加入元素
+        :param item: 一个可以变成str的对象
+        :return: bool 是否插入成功
+        :raises OverflowError: 过滤器已满
+        """
+        if not isinstance(item, str):
+            item = str(item)
+        i1, i2, fingerprint = self._locate(item)
+        if self._lookup(i1, i2, fingerprint):
+            return False
+        self._insert(i1, i2, fingerprint)
+        self.count += 1
+        return True
+
+    def remove(self, item: Any) -> bool:
+        """
+        删除元素 只能删除加入过的元素，否则可能删掉指纹相同的其他元素
+        :param item:
+        :return: 是否删除
+        """
+        if not isinstance(item, str):
+            item = str(item)
+        if self._delete(*self._locate(item)):
             self.count -= 1
             return True
         return False
 
     def clear(self) -> None:
         """清空过滤器"""
-        for i in range(len(self.array)):
-            self.array[i] = 0
+        self.table.fill(0)
         self.count = 0
 
+    def __len__(self) -> int:
+        return self.count
+
+    def _health(self) -> Tuple[float, float, int]:
+        return self._cuckoo_health(self.count)
+
     def __contains__(self, item: Any) -> bool:
         if not isinstance(item, str):
             item = str(item)
+        return self._lookup(*self._locate(item))
+
+    def _lookup_many(
+        self, i1: np.ndarray, i2: np.ndarray, fingerprints: np.ndarray
+    ) -> np.ndarray:
+        fingerprints = fingerprints[:, None]
+        return (self.table[i1] == fingerprints).any(axis=1) | (
+            self.table[i2] == fingerprints
+        ).any(axis=1)
+
+    def add_many(self, items: Iterable[Any]) -> np.ndarray:
+        """
+        批量加入元素 一次性计算整批的指纹，按顺序逐个插入
+        同一批次中重复的元素只有第一次出现时算插入成功
+        :param items: 可迭代对象，元素需可以变成str
+        :return: 布尔数组 每个元素是否插入成功
+        :raises OverflowError: 过滤器已满 之前的元素已经插入
+        """
+        unique, index, first = _prepare_batch(items)
+        i1, i2, fingerprints = self._locate_many(unique)
+        added = ~self._lookup_many(i1, i2, fingerprints)
+        for j in np.flatnonzero(added):
+            bucket, alt, fingerprint = int(i1[j]), int(i2[j]), int(fingerprints[j])
+            # 同一批次里前面的元素可能有相同的指纹
+            if self._lookup(bucket, alt, fingerprint):
+                added[j] = False
+                continue
+            self._insert(bucket, alt, fingerprint)
+            self.count += 1
+        return added[index] & first
+
+    def remove_many(self, items: Iterable[Any]) -> np.ndarray:
+        """
+        批量删除元素
+        :param items: 可迭代对象，元素需可以变成str
+        :return: 布尔数组 每个元素是否删除
+        """
+        unique, index, first = _prepare_batch(items)
+        i1, i2, fingerprints = self._locate_many(unique)
+        removed = np.zeros(len(unique), dtype=bool)
+        for j in range(len(unique)):
+            removed[j] = self._delete(int(i1[j]), int(i2[j]), int(fingerprints[j]))
+        self.count -= int(removed.sum())
+        return removed[index] & first
+
+    def contains_many(self, items: Iterable[Any]) -> np.ndarray:
+        """
+        批量判断元素是否存在 每个元素只访问两个桶
+        :param items: 可迭代对象，元素需可以变成str
+        :return: 布尔数组
+        """
+        unique, index, _ = _prepare_batch(items)
+        return self._lookup_many(*self._locate_many(unique))[index]
+
+
+class XorFilter(BaseBloomFilter):
+    """
+    Static xor filter built from a known key set (Graf & Lemire)
+    只读，构造时给出全部元素。每个元素对应3个槽(3段中各一个)，
+    3个槽里的指纹异或起来等于元素的指纹，查询只访问3个槽
+    指纹取ceil(log2(1/p))位，按位紧凑存放，每个元素约占1.23*ceil(log2(1/p))位，
+    同样误报率的布隆过滤器约1.44*log2(1/p)位，比如p=0.001时是12.3位对14.4位
+    """
+
+    _MIX = 0x9E3779B97F4A7C15  # 把摘要的两半混合，避免某一半退化
+
+    def __init__(
+        self,
+        items: Iterable[Any],
+        error_rate: Optional[float] = 0.001,
+        hash_type: Optional[Type[BaseHash]] = MMH3HashMap,
+        fingerprint_bits: Optional[int] = None,
+    ):
+        """
+
+        :param items: 全部元素 可迭代对象，元素需可以变成str
+        :param error_rate: 错误率 fingerprint_bits为None时用来选择指纹位数
+        :param hash_type: hash函数类型 需要实现hash128
+        :param fingerprint_bits: 指纹位数 1到32
+        """
+        if not (0 < error_rate < 1):
+            raise ValueError("Error_Rate must be between 0 and 1.")
+        if fingerprint_bits is not None and not 1 <= fingerprint_bits <= 32:
+            raise ValueError("fingerprint_bits must be between 1 and 32")
+        unique, *_ = _prepare_batch(items)
+        size, bits = calculation_xor_filter(
+            len(unique), error_rate, fingerprint_bits or 0
+        )
+        self.count = len(unique)
+        self.m = size  # 槽数
+        self.k = 3
+        self.fingerprint_bits = bits
+        # 有环时换一个种子重新构造
+        for seed in self._seeds:
+            self.seeds = [seed]
+            self.hashmaps = [hash_type(size, seed)]
+            table = self._build(unique)
+            if table is not None:
+                self.fingerprints = self._pack(table)
+                return
+        raise ValueError("failed to build the XorFilter, are there duplicate hashes?")
+
+    def _pack(self, table: np.ndarray) -> np.ndarray:
+        """
+        把每个槽的指纹按fingerprint_bits位紧凑地排列 低位在前，第i个指纹从第i*fingerprint_bits位开始
+        指纹是8/16/32位时与对应的小端序整数数组完全一样
+        :return: uint8数组
+        """
+        shifts = np.arange(self.fingerprint_bits, dtype=np.uint64)
+        chunk = 1 << 16  # 8的倍数 每块正好占整数个字节，可以分块打包再拼接
+        return np.concatenate(
+            [
+                np.packbits(
+                    ((table[i : i + chunk, None] >> shifts) & 1).astype(np.uint8),
+                    axis=None,
+                    bitorder="little",
+                )
+                for i in range(0, len(table), chunk)
+            ]
+        )
+
+    def _read(self, slots: np.ndarray) -> np.ndarray:
+        """
+        批量读取槽里的指纹 每个指纹最多跨5个字节
+        :param slots: 任意形状的槽下标
+        :return: 形状相同的uint64数组
+        """
+        bits = slots.astype(np.int64) * self.fingerprint_bits
+        data = self.fingerprints
+        # 超出末尾的字节换成最后一个字节，它们只落在指纹之上的高位，会被掩掉
+        window = np.minimum((bits >> 3)[..., None] + np.arange(5), len(data) - 1)
+        values = np.bitwise_or.reduce(
+            data[window].astype(np.uint64) << (np.arange(5, dtype=np.uint64) * 8),
+            axis=-1,
+        )
+        mask = np.uint64((1 << self.fingerprint_bits) - 1)
+        return (values >> (bits & 7).astype(np.uint64)) & mask
+
+    def _read_one(self, slot: int) -> int:
+        bit = slot * self.fingerprint_bits
+        start = bit >> 3
+        value = int.from_bytes(self.fingerprints[start : start + 5].tobytes(), "little")
+        return (value >> (bit & 7)) & ((1 << self.fingerprint_bits) - 1)
+
+    @timed_hash
+    def _locate(self, item: str) -> Tuple[int, int, int, int]:
+        """
+        :return: 3个槽, 指纹
+        """
+        h1, h2 = self.hashmaps[0].hash128(item)
+        mixed = ((h1 ^ h2) * self._MIX) & 0xFFFFFFFFFFFFFFFF
+        segment = self.m // 3
+        return (
+            (h1 & 0xFFFFFFFF) % segment,
+            segment + (h1 >> 32) % segment,
+            2 * segment + (mixed & 0xFFFFFFFF) % segment,
+            (mixed >> 32) & ((1 << self.fingerprint_bits) - 1),
+        )
 
-        def _m(x):
-            value = x.hash(item)
-            assert 0 <= value < self.m
-            return self.array[value] > 0
+    @timed_hash
+    def _locate_many(self, items: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        批量计算 与_locate的结果一致
+        :return: shape为(n, 3)的槽, 指纹
+        """
+        digests = np.array(
+            [self.hashmaps[0].hash128(item) for item in items], dtype=np.uint64
+        ).reshape(len(items), 2)
+        low = np.uint64(0xFFFFFFFF)
+        shift = np.uint64(32)
+        segment = np.uint64(self.m // 3)
+        h1, h2 = digests[:, 0], digests[:, 1]
+        mixed = (h1 ^ h2) * np.uint64(self._MIX)  # uint64乘法溢出时回绕
+        slots = np.stack(
+            [
+                (h1 & low) % segment,
+                segment + (h1 >> shift) % segment,
+                np.uint64(2) * segment + (mixed & low) % segment,
+            ],
+            axis=1,
+        ).astype(np.int64)
+        fingerprints = (mixed >> shift) & np.uint64((1 << self.fingerprint_bits) - 1)
+        return slots, fingerprints
+
+    def _build(self, items: List[str]) -> Optional[np.ndarray]:
+        """
+        剥离: 反复找出只被一个元素使用的槽，把这个元素分配给它并从图中移除
+        每一轮同时剥离所有这样的槽，同一轮的元素互不影响，可以用numpy批量处理
+        再按相反的顺序逐轮给槽赋值
+        :return: 每个槽一个uint64的指纹数组 有环无法剥离完时返回None
+        """
+        slots, fingerprints = self._locate_many(items)
+        n = len(items)
+        counts = np.bincount(slots.ravel(), minlength=self.m)
+        owners = np.zeros(self.m, dtype=np.int64)  # 使用这个槽的元素下标的异或
+        np.bitwise_xor.at(owners, slots.ravel(), np.repeat(np.arange(n), 3))
+        rounds = []
+        peeled = 0
+        queue = np.flatnonzero(counts == 1)
+        while len(queue):
+            # 一个元素可能同时有几个槽只被它使用，只取一个
+            keys, first = np.unique(owners[queue], return_index=True)
+            rounds.append((keys, queue[first]))
+            peeled += len(keys)
+            used = slots[keys].ravel()
+            np.subtract.at(counts, used, 1)
+            np.bitwise_xor.at(owners, used, np.repeat(keys, 3))
+            queue = np.flatnonzero(counts == 1)
+        if peeled < n:
+            return None
+        table = np.zeros(self.m, dtype=np.uint64)
+        for keys, targets in reversed(rounds):
+            used = slots[keys]
+            # 目标槽还没赋值，是0，不影响异或的结果
+            found = table[used[:, 0]] ^ table[used[:, 1]] ^ table[used[:, 2]]
+            table[targets] = fingerprints[keys] ^ found
+        return table
 
-        return all(map(_m, self.hashmaps))
+    def add(self, item: Any) -> bool:
+        raise NotImplementedError("XorFilter is read-only, build a new one instead")
+
+    def clear(self) -> None:
+        raise NotImplementedError("XorFilter is read-only, build a new one instead")
 
     def __len__(self) -> int:
         return self.count
+
+    def _health(self) -> Tuple[float, float, int]:
+        # 只读的过滤器 误判率只由指纹位数决定
+        return self.count / self.m, 2.0**-self.fingerprint_bits, self.count
+
+    def __contains__(self, item: Any) -> bool:
+        if not isinstance(item, str):
+            item = str(item)
+        a, b, c, fingerprint = self._locate(item)
+        found = self._read_one(a) ^ self._read_one(b) ^ self._read_one(c)
+        return found == fingerprint
+
+    def contains_many(self, items: Iterable[Any]) -> np.ndarray:
+        """
+        批量判断元素是否存在 每个元素访问3个槽
+        :param items: 可迭代对象，元素需可以变成str
+        :return: 布尔数组
+        """
+        unique, index, _ = _prepare_batch(items)
+        slots, fingerprints = self._locate_many(unique)
+        table = self._read(slots)
+        found = table[:, 0] ^ table[:, 1] ^ table[:, 2]
+        return (found == fingerprints)[index]
+
+    def _header(self) -> serialization.FilterHeader:
+        return serialization.FilterHeader(
+            serialization.KIND_XOR,
+            self.m,
+            self.k,
+            tuple(self.seeds),
+            type(self.hashmaps[0]).__name__,
+            self.count,
+            False,
+            chr(self.fingerprint_bits),
+        )
+
+    def to_bytes(self) -> bytes:
+        """
+        序列化成 头部+指纹数组 的紧凑二进制格式
+        """
+        return serialization.pack_header(self._header()) + self.fingerprints.tobytes()
+
+    def save(self, path: Union[str, "os.PathLike[str]"]) -> None:
+        """写入文件 可以用load映射到内存"""
+        with open(path, "wb") as f:
+            f.write(serialization.pack_header(self._header()))
+            f.write(self.fingerprints.tobytes())
+
+    @classmethod
+    def load(
+        cls,
+        path: Union[str, "os.PathLike[str]"],
+        hash_type: Optional[Type[BaseHash]] = None,
+    ) -> "XorFilter":
+        """
+        只读映射save写入的文件 不读入内存，由操作系统按需换页，多个进程可以共享
+        :param path: 文件路径
+        :param hash_type: hash函数类型 默认使用头部记录的类型
+        :return: XorFilter
+        """
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls.from_bytes(data, hash_type)
+
+    @classmethod
+    def from_bytes(
+        cls,
+        data,
+        hash_type: Optional[Type[BaseHash]] = None,
+        copy: Optional[bool] = False,
+    ) -> "XorFilter":
+        """
+        从to_bytes的结果加载 默认不复制数据，指纹是引用传入缓冲区的numpy数组
+        :param data: 支持buffer协议的对象 bytes/bytearray/memoryview/mmap等
+        :param hash_type: hash函数类型 默认使用头部记录的类型
+        :param copy: 是否复制数据
+        :return: XorFilter
+        """
+        view = memoryview(data).cast("B")
+        header, offset = serialization.unpack_header(view)
+        hash_type = serialization.check_header(
+            header, serialization.KIND_XOR, hash_type
+        )
+        return cls._from_buffer(header, hash_type, view[offset:], copy)
+
+    @classmethod
+    def _from_buffer(
+        cls,
+        header: serialization.FilterHeader,
+        hash_type: Type[BaseHash],
+        buffer: memoryview,
+        copy: Optional[bool] = False,
+    ) -> "XorFilter":
+        self = cls.__new__(cls)
+        self.count = header.count
+        self.m = header.m
+        self.k = header.k
+        self.fingerprint_bits = ord(header.typecode)
+        if not 0 < self.fingerprint_bits <= 32:
+            raise ValueError("invalid fingerprint bits")
+        self.seeds = list(header.seeds)
+        self.hashmaps = [hash_type(self.m, self.seeds[0])]
+        size = (self.m * self.fingerprint_bits + 7) // 8
+        fingerprints = np.frombuffer(buffer, dtype=np.uint8, count=size)
+        self.fingerprints = fingerprints.copy() if copy else fingerprints
+        return self
+
+    def __reduce_ex__(self, protocol):
+        # protocol 5 用PickleBuffer传递指纹数组，可以带外传输，避免额外的复制
+        if protocol >= 5:
+            data = pickle.PickleBuffer(self.fingerprints)
+        else:
+            data = self.fingerprints.tobytes()
+        return _restore, (
+            type(self),
+            type(self.hashmaps[0]),
+            serialization.pack_header(self._header()),
+            data,
+        )
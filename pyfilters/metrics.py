@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+"""
+可选的性能统计 用InstrumentedFilter包装之后才会统计
+计时和脚本计数由类上的hash方法和注册时包装的redis脚本检查contextvar完成，不修改过滤器对象，
+没有包装的过滤器每次计算hash和调用脚本只多一次contextvar的读取
+
+每次操作上报:
+- counter: adds/removes 处理的元素个数，hits/misses 判断的结果，errors 抛出异常的操作次数(不计入前面几项)，
+  script_calls/script_bytes redis脚本的调用次数和发送的keys/args的字节数
+- histogram(秒): latency_seconds 整个操作的耗时，hash_seconds 其中计算hash的耗时，
+  io_seconds 其余的耗时(redis的往返，或者内存中的位操作)
+labels: filter 过滤器的名字，op add/remove/contains
+"""
+
+import bisect
+import contextvars
+import functools
+import threading
+import time
+from itertools import chain
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from pyfilters.utils import stringify
+
+COUNTERS = {
+    "adds": "elements passed to add/add_many",
+    "removes": "elements passed to remove/remove_many",
+    "hits": "elements found by contains/contains_many",
+    "misses": "elements not found by contains/contains_many",
+    "errors": "operations that raised an exception",
+    "script_calls": "redis script calls",
+    "script_bytes": "bytes of keys and args sent with redis script calls",
+}
+HISTOGRAMS = {
+    "latency_seconds": "time of an operation",
+    "hash_seconds": "time spent hashing in an operation",
+    "io_seconds": "time of an operation except hashing",
+}
+LATENCY_BUCKETS = (
+    0.00001,
+    0.00005,
+    0.0001,
+    0.0005,
+    0.001,
+    0.005,
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+    1.0,
+)
+
+class MetricsSink:
+    """统计结果的去向 labels是{"filter": 过滤器的名字, "op": 操作}"""
+
+    def counter(self, name: str, value: int, labels: Dict[str, str]) -> None:
+        """
+        累加计数
+        :param name: COUNTERS中的名字
+        """
+        raise NotImplementedError
+
+    def observe(self, name: str, value: float, labels: Dict[str, str]) -> None:
+        """
+        记录一次耗时
+        :param name: HISTOGRAMS中的名字
+        :param value: 秒
+        """
+        raise NotImplementedError
+
+
+class CallbackSink(MetricsSink):
+    """每个指标调用一次callback(kind, name, value, labels) kind是counter/histogram"""
+
+    def __init__(self, callback: Callable[[str, str, float, Dict[str, str]], Any]):
+        self.callback = callback
+
+    def counter(self, name: str, value: int, labels: Dict[str, str]) -> None:
+        self.callback("counter", name, value, labels)
+
+    def observe(self, name: str, value: float, labels: Dict[str, str]) -> None:
+        self.callback("histogram", name, value, labels)
+
+
+class StatsSink(MetricsSink):
+    """在本地累计 histogram按buckets分桶，随时可以读取，线程安全"""
+
+    def __init__(self, buckets: Iterable[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        # (名字, 过滤器, 操作) -> 计数
+        self.counters: Dict[Tuple[str, str, str], int] = {}
+        # (名字, 过滤器, 操作) -> 每个桶的次数 最后一个是超过所有桶的
+        self.histograms: Dict[Tuple[str, str, str], List[int]] = {}
+        self.sums: Dict[Tuple[str, str, str], float] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, value: int, labels: Dict[str, str]) -> None:
+        key = (name, labels["filter"], labels["op"])
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, labels: Dict[str, str]) -> None:
+        key = (name, labels["filter"], labels["op"])
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self.histograms.get(key)
+            if counts is None:
+                counts = self.histograms[key] = [0] * (len(self.buckets) + 1)
+            counts[index] += 1
+            self.sums[key] = self.sums.get(key, 0.0) + value
+
+    def total(self, name: str, op: Optional[str] = None) -> float:
+        """
+        counter的总数，或者histogram的耗时总和
+        :param op: 只统计这个操作 为None时统计所有操作
+        """
+        values = self.counters if name in COUNTERS else self.sums
+        with self._lock:
+            return sum(
+                value
+                for (key, _, key_op), value in values.items()
+                if key == name and op in (None, key_op)
+            )
+
+    def quantile(self, name: str, q: float, op: Optional[str] = None) -> float:
+        """
+        histogram的分位数 返回所在桶的上界，超过所有桶时为inf
+        :param q: 0到1之间
+        """
+        merged = np.zeros(len(self.buckets) + 1, dtype=np.int64)
+        with self._lock:
+            for (key, _, key_op), counts in self.histograms.items():
+                if key == name and op in (None, key_op):
+                    merged += counts
+        if not merged.sum():
+            return 0.0
+        index = int(np.searchsorted(np.cumsum(merged), q * merged.sum()))
+        return self.buckets[index] if index < len(self.buckets) else float("inf")
+
+
+class PrometheusSink(MetricsSink):
+    """prometheus_client的适配 创建时才导入prometheus_client，不使用时不需要安装"""
+
+    def __init__(
+        self,
+        namespace: str = "pyfilters",
+        registry=None,
+        buckets: Iterable[float] = LATENCY_BUCKETS,
+    ):
+        """
+        :param namespace: 指标名字的前缀
+        :param registry: prometheus_client的CollectorRegistry 默认为全局的REGISTRY
+        :param buckets: histogram的分桶
+        """
+        import prometheus_client
+
+        kwargs = {} if registry is None else {"registry": registry}
+        self._counters = {
+            name: prometheus_client.Counter(
+                name, doc, ["filter", "op"], namespace=namespace, **kwargs
+            )
+            for name, doc in COUNTERS.items()
+        }
+        self._histograms = {
+            name: prometheus_client.Histogram(
+                name,
+                doc,
+                ["filter", "op"],
+                namespace=namespace,
+                buckets=tuple(buckets),
+                **kwargs,
+            )
+            for name, doc in HISTOGRAMS.items()
+        }
+
+    def counter(self, name: str, value: int, labels: Dict[str, str]) -> None:
+        self._counters[name].labels(**labels).inc(value)
+
+    def observe(self, name: str, value: float, labels: Dict[str, str]) -> None:
+        self._histograms[name].labels(**labels).observe(value)
+
+
+class OpenTelemetrySink(MetricsSink):
+    """OpenTelemetry的适配 传入opentelemetry.metrics.get_meter()的结果，本模块不导入opentelemetry"""
+
+    def __init__(self, meter, prefix: str = "pyfilters."):
+        """
+        :param meter: opentelemetry的Meter
+        :param prefix: 指标名字的前缀
+        """
+        self._counters = {
+            name: meter.create_counter(prefix + name, description=doc)
+            for name, doc in COUNTERS.items()
+        }
+        self._histograms = {
+            name: meter.create_histogram(prefix + name, unit="s", description=doc)
+            for name, doc in HISTOGRAMS.items()
+        }
+
+    def counter(self, name: str, value: int, labels: Dict[str, str]) -> None:
+        self._counters[name].add(value, labels)
+
+    def observe(self, name: str, value: float, labels: Dict[str, str]) -> None:
+        self._histograms[name].record(value, labels)
+
+
+class _Operation:
+    """一次操作中累计的hash耗时和脚本调用 放在contextvar里，线程和asyncio的task各自独立"""
+
+    __slots__ = ("hash_ns", "hashing", "script_calls", "script_bytes")
+
+    def __init__(self):
+        self.hash_ns = 0
+        self.hashing = False  # 正在计算hash 嵌套的hash方法不重复计时
+        self.script_calls = 0
+        self.script_bytes = 0
+
+
+_current: contextvars.ContextVar = contextvars.ContextVar(
+    "pyfilters_operation", default=None
+)
+
+
+def timed_hash(method: Callable) -> Callable:
+    """过滤器的hash方法的装饰器 在InstrumentedFilter的操作中累计耗时"""
+
+    @functools.wraps(method)
+    def wrapper(*args):
+        operation = _current.get()
+        if operation is None or operation.hashing:
+            return method(*args)
+        operation.hashing = True
+        begin = time.perf_counter_ns()
+        try:
+            result = method(*args)
+            if isinstance(result, map):  # 惰性计算的偏移量要在计时内算完
+                result = list(result)
+        finally:
+            operation.hash_ns += time.perf_counter_ns() - begin
+            operation.hashing = False
+        return result
+
+    return wrapper
+
+
+class _CountingScript:
+    """包装redis的Script 统计调用次数和发送的keys/args的字节数，同步和asyncio的Script都可以"""
+
+    def __init__(self, script):
+        self._script = script
+
+    def __call__(self, keys=None, args=None, client=None):
+        operation = _current.get()
+        if operation is not None:
+            operation.script_calls += 1
+            operation.script_bytes += sum(
+                len(value) if isinstance(value, (str, bytes)) else len(str(value))
+                for value in chain(keys or (), args or ())
+            )
+        return self._script(keys=keys, args=args, client=client)
+
+    def __getattr__(self, name: str):
+        return getattr(self._script, name)
+
+
+def register_script(redis_client, script: str) -> _CountingScript:
+    """注册redis脚本 返回的脚本在InstrumentedFilter的操作中统计调用，同步和asyncio的客户端都可以"""
+    return _CountingScript(redis_client.register_script(script))
+
+
+def start_operation() -> Tuple[_Operation, contextvars.Token, int]:
+    operation = _Operation()
+    return operation, _current.set(operation), time.perf_counter_ns()
+
+
+def finish_operation(
+    sink: MetricsSink,
+    labels: Dict[str, str],
+    state: Tuple[_Operation, contextvars.Token, int],
+    size: int,
+    result: Any,
+) -> None:
+    """
+    上报一次操作
+    :param state: start_operation的结果
+    :param size: 操作的元素个数
+    :param result: 操作的结果 contains时统计hits/misses，为None表示操作抛出了异常
+    """
+    operation, token, begin = state
+    elapsed = time.perf_counter_ns() - begin
+    _current.reset(token)
+    op = labels["op"]
+    sink.observe("latency_seconds", elapsed / 1e9, labels)
+    sink.observe("hash_seconds", operation.hash_ns / 1e9, labels)
+    sink.observe("io_seconds", (elapsed - operation.hash_ns) / 1e9, labels)
+    if operation.script_calls:
+        sink.counter("script_calls", operation.script_calls, labels)
+        sink.counter("script_bytes", operation.script_bytes, labels)
+    if result is None:  # 操作失败，元素不计入adds/removes/hits/misses
+        sink.counter("errors", 1, labels)
+    elif op == "contains":
+        hits = int(np.count_nonzero(result))
+        sink.counter("hits", hits, labels)
+        sink.counter("misses", size - hits, labels)
+    else:
+        sink.counter(op + "s", size, labels)
+
+
+class InstrumentedFilter:
+    """
+    统计过滤器的操作 add/remove/contains及其批量版本上报到sink，其他属性直接访问原来的过滤器
+    只有经过这个包装的操作才会计时，过滤器对象本身不会被修改，仍然可以pickle，
+    直接调用原来的过滤器只多一次contextvar的读取
+    redis cluster的pipeline直接发送脚本内容，不经过脚本对象，不计入script_calls
+    """
+
+    def __init__(self, bloom_filter, sink: MetricsSink, name: Optional[str] = None):
+        """
+        :param bloom_filter: pyfilters中的任意过滤器
+        :param sink: 统计结果的去向
+        :param name: labels中过滤器的名字 默认是redis的key或者类名
+        """
+        self.bloom_filter = bloom_filter
+        self.sink = sink
+        self.name = name or getattr(bloom_filter, "key", type(bloom_filter).__name__)
+
+    def _call(self, op: str, method: Callable, items: List[str], **kwargs) -> Any:
+        state = start_operation()
+        result = None
+        try:
+            result = method(items, **kwargs)
+        finally:
+            labels = {"filter": self.name, "op": op}
+            finish_operation(self.sink, labels, state, len(items), result)
+        return result
+
+    def _call_one(self, op: str, method: Callable, item: Any) -> Any:
+        return self._call(op, lambda items: method(items[0]), [item])
+
+    def add(self, item: Any) -> bool:
+        return self._call_one("add", self.bloom_filter.add, item)
+
+    def add_many(self, items: Iterable[Any], **kwargs) -> np.ndarray:
+        return self._call("add", self.bloom_filter.add_many, stringify(items), **kwargs)
+
+    def remove(self, item: Any) -> bool:
+        return self._call_one("remove", self.bloom_filter.remove, item)
+
+    def remove_many(self, items: Iterable[Any], **kwargs) -> np.ndarray:
+        return self._call(
+            "remove", self.bloom_filter.remove_many, stringify(items), **kwargs
+        )
+
+    def __contains__(self, item: Any) -> bool:
+        return self._call_one("contains", self.bloom_filter.__contains__, item)
+
+    def contains_many(self, items: Iterable[Any], **kwargs) -> np.ndarray:
+        return self._call(
+            "contains", self.bloom_filter.contains_many, stringify(items), **kwargs
+        )
+
+    def __len__(self) -> int:
+        return len(self.bloom_filter)
+
+    def __getattr__(self, name: str):
+        return getattr(self.bloom_filter, name)
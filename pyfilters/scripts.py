@@ -0,0 +1,582 @@
+# -*- coding: utf-8 -*-
+"""
+redis过滤器共用的lua脚本，同步和asyncio版本都使用
+
+批量脚本的参数格式:
+KEYS: 本批次用到的所有key
+ARGV[1]: k，每个元素的偏移量个数
+ARGV[2..]: 每个元素占k+1个参数，依次是 key在KEYS中的下标, k个偏移量
+返回值: 每个元素一个整数(0/1)，顺序与传入的一致
+加入和删除的脚本还要在KEYS的后一半传入前一半每个key对应的计数key，元素个数在同一个脚本里原子地更新
+"""
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+# 把每个key新增的元素个数加到对应的计数key上
+_ADD_COUNTS = """
+local function add_counts(counts, sign)
+    local n = #KEYS / 2
+    for index, count in pairs(counts) do
+        redis.call("INCRBY", KEYS[n + index], sign * count)
+    end
+end
+"""
+
+# 批量置位 返回每个元素是否是新插入的(至少有一位原来是0)
+BATCH_SETBIT = (
+    _ADD_COUNTS
+    + """
+local k = tonumber(ARGV[1])
+local result = {}
+local counts = {}
+for i = 2, #ARGV, k + 1 do
+    local index = tonumber(ARGV[i])
+    local key = KEYS[index]
+    local new = 0
+    for j = i + 1, i + k do
+        if redis.call("SETBIT", key, ARGV[j], 1) == 0 then
+            new = 1
+        end
+    end
+    if new == 1 then
+        counts[index] = (counts[index] or 0) + 1
+    end
+    result[#result + 1] = new
+end
+add_counts(counts, 1)
+return result
+"""
+)
+
+# 批量判断 返回每个元素是否存在
+BATCH_GETBIT = """
+local k = tonumber(ARGV[1])
+local result = {}
+for i = 2, #ARGV, k + 1 do
+    local key = KEYS[tonumber(ARGV[i])]
+    local found = 1
+    for j = i + 1, i + k do
+        if redis.call("GETBIT", key, ARGV[j]) == 0 then
+            found = 0
+            break
+        end
+    end
+    result[#result + 1] = found
+end
+return result
+"""
+
+# 单个元素的脚本 KEYS[1]: key KEYS[2]: 计数key(加入和删除时) ARGV: k个偏移量
+# 判断和写入在同一个脚本里完成，一次往返，多个客户端同时加入同一个元素时只有一个返回1
+
+# 单个元素置位 返回是否是新插入的(至少有一位原来是0)
+SETBIT_ITEM = """
+local new = 0
+for i = 1, #ARGV do
+    if redis.call("SETBIT", KEYS[1], ARGV[i], 1) == 0 then
+        new = 1
+    end
+end
+if new == 1 then
+    redis.call("INCR", KEYS[2])
+end
+return new
+"""
+
+# 单个元素判断
+GETBIT_ITEM = """
+for i = 1, #ARGV do
+    if redis.call("GETBIT", KEYS[1], ARGV[i]) == 0 then
+        return 0
+    end
+end
+return 1
+"""
+
+# 合并过滤器 在redis中按位运算，数据不经过客户端
+# KEYS[1]: 结果key(也是第一个参与运算的key) KEYS[2]: 它的计数key KEYS[3..]: 其他过滤器的key
+# ARGV[1]: OR/AND ARGV[2]: m ARGV[3]: k
+# 计数按运算后置位的位数重新估计 返回估计的元素个数
+BITOP_MERGE = """
+local m, k = tonumber(ARGV[2]), tonumber(ARGV[3])
+redis.call("BITOP", ARGV[1], KEYS[1], KEYS[1], unpack(KEYS, 3))
+local bits = math.min(redis.call("BITCOUNT", KEYS[1]), m - 1)
+local count = math.floor(-m / k * math.log(1 - bits / m) + 0.5)
+redis.call("SET", KEYS[2], count)
+return count
+"""
+
+# 计数过滤器 计数器减1，减到0时删除字段 hash里只留下非0的计数器，HLEN就是非0的计数器个数
+_HASH_DECR = """
+local function decr(key, field)
+    if redis.call("HINCRBY", key, field, -1) <= 0 then
+        redis.call("HDEL", key, field)
+    end
+end
+"""
+
+# 计数过滤器 判断元素是否存在的公共部分
+_HASH_FOUND = """
+local function found(key, i, k)
+    for j = i + 1, i + k do
+        local ret = redis.call("HGET", key, ARGV[j])
+        if not ret or tonumber(ret) <= 0 then
+            return false
+        end
+    end
+    return true
+end
+"""
+
+# 计数过滤器批量加入 元素已存在则跳过
+BATCH_HASH_ADD = (
+    _HASH_FOUND
+    + _ADD_COUNTS
+    + """
+local k = tonumber(ARGV[1])
+local result = {}
+local counts = {}
+for i = 2, #ARGV, k + 1 do
+    local index = tonumber(ARGV[i])
+    local key = KEYS[index]
+    if found(key, i, k) then
+        result[#result + 1] = 0
+    else
+        for j = i + 1, i + k do
+            redis.call("HINCRBY", key, ARGV[j], 1)
+        end
+        counts[index] = (counts[index] or 0) + 1
+        result[#result + 1] = 1
+    end
+end
+add_counts(counts, 1)
+return result
+"""
+)
+
+# 计数过滤器批量删除 元素不存在则跳过
+BATCH_HASH_REMOVE = (
+    _HASH_FOUND
+    + _HASH_DECR
+    + _ADD_COUNTS
+    + """
+local k = tonumber(ARGV[1])
+local result = {}
+local counts = {}
+for i = 2, #ARGV, k + 1 do
+    local index = tonumber(ARGV[i])
+    local key = KEYS[index]
+    if found(key, i, k) then
+        for j = i + 1, i + k do
+            decr(key, ARGV[j])
+        end
+        counts[index] = (counts[index] or 0) + 1
+        result[#result + 1] = 1
+    else
+        result[#result + 1] = 0
+    end
+end
+add_counts(counts, -1)
+return result
+"""
+)
+
+# 计数过滤器批量判断
+BATCH_HASH_CONTAINS = (
+    _HASH_FOUND
+    + """
+local k = tonumber(ARGV[1])
+local result = {}
+for i = 2, #ARGV, k + 1 do
+    if found(KEYS[tonumber(ARGV[i])], i, k) then
+        result[#result + 1] = 1
+    else
+        result[#result + 1] = 0
+    end
+end
+return result
+"""
+)
+
+
+# 计数过滤器加入单个元素 已存在则跳过
+HASH_ADD_ITEM = (
+    _HASH_FOUND
+    + """
+if found(KEYS[1], 0, #ARGV) then
+    return 0
+end
+for j = 1, #ARGV do
+    redis.call("HINCRBY", KEYS[1], ARGV[j], 1)
+end
+redis.call("INCR", KEYS[2])
+return 1
+"""
+)
+
+# 计数过滤器删除单个元素 不存在则跳过
+HASH_REMOVE_ITEM = (
+    _HASH_FOUND
+    + _HASH_DECR
+    + """
+if not found(KEYS[1], 0, #ARGV) then
+    return 0
+end
+for j = 1, #ARGV do
+    decr(KEYS[1], ARGV[j])
+end
+redis.call("DECR", KEYS[2])
+return 1
+"""
+)
+
+# 计数过滤器判断单个元素
+HASH_CONTAINS_ITEM = (
+    _HASH_FOUND
+    + """
+if found(KEYS[1], 0, #ARGV) then
+    return 1
+end
+return 0
+"""
+)
+
+
+def pack_batch_args(
+    item_keys: List[str],
+    offsets: np.ndarray,
+    batch_size: int,
+    single_key: bool = False,
+) -> List[Tuple[List[str], List[int]]]:
+    """
+    按batch_size切分批次，生成每次批量脚本调用的keys和args
+    :param item_keys: 每个元素所在的key
+    :param offsets: shape为(n, k)的偏移量数组
+    :param batch_size: 每次脚本调用最多处理的元素个数，避免单个脚本阻塞redis太久
+    :param single_key: 每次调用只用一个key，key变化时开始新的调用
+                       redis cluster要求一次脚本调用的key都在同一个slot
+    :return: [(keys, args), ...]
+    """
+    if batch_size <= 0:
+        raise ValueError("batch_size must be > 0")
+    calls = []
+    k = offsets.shape[1]
+    keys: List[str] = []
+    index: Dict[str, int] = {}
+    args = [k]
+    size = 0
+    for key, row in zip(item_keys, offsets.tolist()):
+        if size == batch_size or (single_key and keys and key not in index):
+            calls.append((keys, args))
+            keys, index, args, size = [], {}, [k], 0
+        if key not in index:
+            keys.append(key)
+            index[key] = len(keys)  # lua的下标从1开始
+        args.append(index[key])
+        args.extend(row)
+        size += 1
+    if size:
+        calls.append((keys, args))
+    return calls
+
+
+def with_count_keys(
+    calls: List[Tuple[List[str], List[int]]], count_key: Callable[[str], str]
+) -> List[Tuple[List[str], List[int]]]:
+    """
+    给加入和删除的脚本调用在KEYS的后一半加上每个key对应的计数key
+    :param calls: pack_batch_args的结果
+    :param count_key: 由key得到计数key
+    """
+    return [(keys + [count_key(key) for key in keys], args) for keys, args in calls]
+
+
+def pack_flat_args(
+    head: List[int], offsets: np.ndarray, batch_size: int
+) -> List[List[int]]:
+    """
+    按batch_size切分批次 每次调用的参数是共用的head加上每个元素的一行参数
+    :param head: 每次调用共用的参数 比如可扩展过滤器的(阶段数, 容量, 每个阶段的k)
+    :param offsets: shape为(n, 每个元素的参数个数)的数组
+    :param batch_size: 每次脚本调用最多处理的元素个数
+    :return: [args, ...]
+    """
+    if batch_size <= 0:
+        raise ValueError("batch_size must be > 0")
+    return [
+        head + offsets[start : start + batch_size].ravel().tolist()
+        for start in range(0, len(offsets), batch_size)
+    ]
+
+
+# 可扩展过滤器的脚本
+# KEYS[1]: 元数据hash，stages字段是阶段数，count字段是最新阶段已插入的元素个数，total字段是所有阶段的
+# KEYS[2..]: 阶段0, 1, ...的key
+# ARGV[1]: 客户端已知的阶段数S，与redis中的不一致时直接返回，客户端刷新后重试
+# 返回值: 第一个是redis中的阶段数，之后每个元素一个整数(0/1)
+# 处理的元素个数少于传入的个数时，说明阶段数发生了变化，客户端需要刷新后重发剩余的元素
+_SCALABLE_FOUND = """
+local function found(stages, base, ks)
+    for s = stages, 1, -1 do
+        local hit = true
+        for j = base[s], base[s] + ks[s] - 1 do
+            if redis.call("GETBIT", KEYS[s + 1], ARGV[j]) == 0 then
+                hit = false
+                break
+            end
+        end
+        if hit then
+            return true
+        end
+    end
+    return false
+end
+"""
+
+# 可扩展过滤器批量判断 从最新的阶段开始查
+# ARGV[2..S+1]: 每个阶段的k  之后每个元素依次是阶段1..S的偏移量
+SCALABLE_CONTAINS = (
+    _SCALABLE_FOUND
+    + """
+local known = tonumber(ARGV[1])
+local stages = tonumber(redis.call("HGET", KEYS[1], "stages") or 1)
+local result = {stages}
+if stages ~= known then
+    return result
+end
+local ks = {}
+for s = 1, known do
+    ks[s] = tonumber(ARGV[1 + s])
+end
+local i = known + 2
+local base = {}
+while i <= #ARGV do
+    for s = 1, known do
+        base[s] = i
+        i = i + ks[s]
+    end
+    result[#result + 1] = found(stages, base, ks) and 1 or 0
+end
+return result
+"""
+)
+
+# 可扩展过滤器批量加入 最新的阶段装满时在脚本内原子地切换到下一个阶段
+# ARGV[2]: 第S个阶段的容量 ARGV[3]: 第S+1个阶段的容量
+# ARGV[4..S+4]: 阶段1..S+1的k  之后每个元素依次是阶段1..S+1的偏移量
+# 第S+1个阶段也装满时停止，由客户端补充下一个阶段的偏移量后重发
+SCALABLE_ADD = (
+    _SCALABLE_FOUND
+    + """
+local known = tonumber(ARGV[1])
+local stages = tonumber(redis.call("HGET", KEYS[1], "stages") or 1)
+local result = {stages}
+if stages ~= known then
+    return result
+end
+local capacities = {tonumber(ARGV[2]), tonumber(ARGV[3])}
+local ks = {}
+for s = 1, known + 1 do
+    ks[s] = tonumber(ARGV[3 + s])
+end
+local count = tonumber(redis.call("HGET", KEYS[1], "count") or 0)
+local added = 0
+local i = known + 5
+local base = {}
+while i <= #ARGV do
+    for s = 1, known + 1 do
+        base[s] = i
+        i = i + ks[s]
+    end
+    if found(stages, base, ks) then
+        result[#result + 1] = 0
+    else
+        if count >= capacities[stages - known + 1] then
+            if stages > known then
+                break
+            end
+            stages = stages + 1
+            count = 0
+        end
+        for j = base[stages], base[stages] + ks[stages] - 1 do
+            redis.call("SETBIT", KEYS[stages + 1], ARGV[j], 1)
+        end
+        count = count + 1
+        added = added + 1
+        result[#result + 1] = 1
+    end
+end
+if added > 0 then
+    redis.call("HSET", KEYS[1], "stages", stages, "count", count)
+    redis.call("HINCRBY", KEYS[1], "total", added)
+end
+result[1] = stages
+return result
+"""
+)
+
+
+# 布谷鸟过滤器的脚本
+# 桶按顺序保存在分片的string里，每个分片chunk_buckets个桶，每个指纹用BITFIELD读写
+# KEYS: 所有分片的key，踢出时可能访问任意一个桶，最后一个是计数key
+# ARGV[1]: 每个分片的桶数 ARGV[2]: 每个桶的槽数 ARGV[3]: 指纹位数(8/16/32)
+# ARGV[4]: 桶数(2的幂，不超过2^32) ARGV[5]: 最多踢出的次数
+# ARGV[6..]: 每个元素3个参数，依次是 候选桶1, 候选桶2, 指纹(不为0)
+# 返回值: 每个元素一个整数
+_CUCKOO_BUCKETS = """
+local chunk_buckets = tonumber(ARGV[1])
+local bucket_size = tonumber(ARGV[2])
+local ftype = "u" .. ARGV[3]
+local num_buckets = tonumber(ARGV[4])
+local max_kicks = tonumber(ARGV[5])
+
+local function locate(index)
+    local chunk = math.floor(index / chunk_buckets)
+    return KEYS[chunk + 1], (index % chunk_buckets) * bucket_size
+end
+
+local function read(index)
+    local key, base = locate(index)
+    local args = {}
+    for j = 0, bucket_size - 1 do
+        args[#args + 1] = "GET"
+        args[#args + 1] = ftype
+        args[#args + 1] = "#" .. (base + j)
+    end
+    return key, base, redis.call("BITFIELD", key, unpack(args))
+end
+
+local function find(index, fp)
+    local key, base, bucket = read(index)
+    for j = 1, bucket_size do
+        if bucket[j] == fp then
+            return key, base + j - 1
+        end
+    end
+    return nil
+end
+
+local function put(index, fp)
+    local key, base, bucket = read(index)
+    for j = 1, bucket_size do
+        if bucket[j] == 0 then
+            redis.call("BITFIELD", key, "SET", ftype, "#" .. (base + j - 1), fp)
+            return true
+        end
+    end
+    return false
+end
+
+-- 逐位异或 不依赖bit库
+local function xor(a, b)
+    local result, value = 0, 1
+    while a > 0 or b > 0 do
+        if a % 2 ~= b % 2 then
+            result = result + value
+        end
+        a, b, value = math.floor(a / 2), math.floor(b / 2), value * 2
+    end
+    return result
+end
+
+-- 与python的 (index ^ (fp * 0x5BD1E995)) & (num_buckets - 1) 一致
+-- lua的数字是double，乘法拆成高低16位，只保留低32位
+local function alt(index, fp)
+    local high = math.floor(fp / 65536)
+    local low = fp % 65536
+    local h = (low * 1540483477 + (high * 1540483477 % 65536) * 65536) % 4294967296
+    return xor(index, h % num_buckets)
+end
+"""
+
+# 布谷鸟过滤器批量加入 返回1: 插入 0: 已存在 -1: 过滤器已满
+# 两个候选桶都满时随机踢出一个指纹放到它的另一个候选桶，失败时按原路径换回
+# 过滤器满了之后不再处理之后的元素
+CUCKOO_ADD = (
+    _CUCKOO_BUCKETS
+    + """
+local result = {}
+local added = 0
+for i = 6, #ARGV, 3 do
+    local i1, i2, fp = tonumber(ARGV[i]), tonumber(ARGV[i + 1]), tonumber(ARGV[i + 2])
+    if find(i1, fp) or find(i2, fp) then
+        result[#result + 1] = 0
+    elseif put(i1, fp) or put(i2, fp) then
+        added = added + 1
+        result[#result + 1] = 1
+    else
+        local index = i1
+        if math.random(2) == 2 then
+            index = i2
+        end
+        local path = {}
+        local placed = false
+        for n = 1, max_kicks do
+            local key, base = locate(index)
+            local pos = "#" .. (base + math.random(bucket_size) - 1)
+            fp = redis.call("BITFIELD", key, "SET", ftype, pos, fp)[1]
+            path[n] = {key, pos}
+            index = alt(index, fp)
+            if put(index, fp) then
+                placed = true
+                break
+            end
+        end
+        if not placed then
+            for n = #path, 1, -1 do
+                fp = redis.call("BITFIELD", path[n][1], "SET", ftype, path[n][2], fp)[1]
+            end
+            result[#result + 1] = -1
+            break
+        end
+        added = added + 1
+        result[#result + 1] = 1
+    end
+end
+redis.call("INCRBY", KEYS[#KEYS], added)
+return result
+"""
+)
+
+# 布谷鸟过滤器批量删除 只删除一个相同的指纹
+CUCKOO_REMOVE = (
+    _CUCKOO_BUCKETS
+    + """
+local result = {}
+local removed = 0
+for i = 6, #ARGV, 3 do
+    local i1, i2, fp = tonumber(ARGV[i]), tonumber(ARGV[i + 1]), tonumber(ARGV[i + 2])
+    local key, pos = find(i1, fp)
+    if not key then
+        key, pos = find(i2, fp)
+    end
+    if key then
+        redis.call("BITFIELD", key, "SET", ftype, "#" .. pos, 0)
+        removed = removed + 1
+        result[#result + 1] = 1
+    else
+        result[#result + 1] = 0
+    end
+end
+redis.call("DECRBY", KEYS[#KEYS], removed)
+return result
+"""
+)
+
+# 布谷鸟过滤器批量判断
+CUCKOO_CONTAINS = (
+    _CUCKOO_BUCKETS
+    + """
+local result = {}
+for i = 6, #ARGV, 3 do
+    local i1, i2, fp = tonumber(ARGV[i]), tonumber(ARGV[i + 1]), tonumber(ARGV[i + 2])
+    if find(i1, fp) or find(i2, fp) then
+        result[#result + 1] = 1
+    else
+        result[#result + 1] = 0
+    end
+end
+return result
+"""
+)
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+内存过滤器的二进制格式
+
+头部(小端序):
+    magic       4s  b"PYFB"
+    version     B
+    kind        B   0: bitarray 1: 计数器数组 2: 分块的bitarray 3: xor过滤器的指纹数组
+    flags       B   bit0: double_hashing
+    typecode    c   计数器的array类型标志，"4"/"8"表示紧凑的饱和计数器，bitarray为b"\\0"
+                    xor过滤器是指纹的位数chr(1..32)，指纹按位紧凑存放，低位在前
+    m           Q
+    k           I
+    count       Q   已插入的元素个数，可以原地更新
+    name_len    H
+    seed_count  H
+    hash_name   name_len字节 hash函数类名
+    seeds       seed_count个I
+    padding     补齐到8字节
+之后紧跟着原始的缓冲区数据
+"""
+import struct
+from typing import NamedTuple, Optional, Tuple, Type
+
+from pyfilters.abc import BaseHash
+from pyfilters.hashmap import HashlibHashMap, MMH3HashMap, PyHashMap
+
+MAGIC = b"PYFB"
+VERSION = 1
+
+KIND_BITS = 0
+KIND_COUNTERS = 1
+KIND_BLOCKED_BITS = 2
+KIND_XOR = 3
+
+FLAG_DOUBLE_HASHING = 1
+
+_FIXED = struct.Struct("<4sBBBcQIQHH")
+COUNT_OFFSET = struct.calcsize("<4sBBBcQI")  # count字段的位置
+COUNT = struct.Struct("<Q")
+
+_HASH_TYPES = {cls.__name__: cls for cls in (PyHashMap, MMH3HashMap, HashlibHashMap)}
+
+
+class FilterHeader(NamedTuple):
+    kind: int
+    m: int
+    k: int
+    seeds: Tuple[int, ...]
+    hash_name: str
+    count: int = 0
+    double_hashing: bool = False
+    typecode: str = "\0"
+
+
+def pack_header(header: FilterHeader) -> bytes:
+    """
+    打包头部 长度是8的倍数
+    """
+    name = header.hash_name.encode()
+    data = _FIXED.pack(
+        MAGIC,
+        VERSION,
+        header.kind,
+        FLAG_DOUBLE_HASHING if header.double_hashing else 0,
+        header.typecode.encode(),
+        header.m,
+        header.k,
+        header.count,
+        len(name),
+        len(header.seeds),
+    )
+    data += name + struct.pack(f"<{len(header.seeds)}I", *header.seeds)
+    return data + b"\0" * (-len(data) % 8)
+
+
+def unpack_header(buffer) -> Tuple[FilterHeader, int]:
+    """
+    解析头部
+    :param buffer: 支持buffer协议的对象
+    :return: 头部, 数据开始的位置
+    """
+    if len(buffer) < _FIXED.size:
+        raise ValueError("buffer too small for a filter header")
+    (
+        magic,
+        version,
+        kind,
+        flags,
+        typecode,
+        m,
+        k,
+        count,
+        name_len,
+        seed_count,
+    ) = _FIXED.unpack_from(buffer, 0)
+    if magic != MAGIC:
+        raise ValueError("not a pyfilters buffer")
+    if version != VERSION:
+        raise ValueError(f"unsupported format version {version}")
+    offset = _FIXED.size
+    hash_name = bytes(buffer[offset : offset + name_len]).decode()
+    offset += name_len
+    seeds = struct.unpack_from(f"<{seed_count}I", buffer, offset)
+    offset += 4 * seed_count
+    offset += -offset % 8
+    header = FilterHeader(
+        kind,
+        m,
+        k,
+        seeds,
+        hash_name,
+        count,
+        bool(flags & FLAG_DOUBLE_HASHING),
+        typecode.decode(),
+    )
+    return header, offset
+
+
+def check_header(
+    header: FilterHeader,
+    kind: int,
+    hash_type: Optional[Type[BaseHash]] = None,
+    m: Optional[int] = None,
+    k: Optional[int] = None,
+    double_hashing: Optional[bool] = None,
+) -> Type[BaseHash]:
+    """
+    检查头部记录的参数是否与预期一致
+    :param header: 头部
+    :param kind: 预期的数据类型
+    :param hash_type: hash函数类型 为None时按头部记录的类名查找内置的类型，自定义的hash函数需要显式传入
+    :param m: 预期的m 为None时不检查
+    :param k: 预期的k 为None时不检查
+    :param double_hashing: 预期的模式 为None时不检查
+    :return: hash函数类型
+    """
+    if header.kind != kind:
+        raise ValueError(f"unexpected filter kind {header.kind}, expected {kind}")
+    for name, expected in (("m", m), ("k", k), ("double_hashing", double_hashing)):
+        if expected is not None and getattr(header, name) != expected:
+            raise ValueError(f"{name} mismatch: {expected} != {getattr(header, name)}")
+    if hash_type is None:
+        try:
+            return _HASH_TYPES[header.hash_name]
+        except KeyError:
+            raise ValueError(
+                f"unknown hash type {header.hash_name}, pass hash_type explicitly"
+            ) from None
+    if hash_type.__name__ != header.hash_name:
+        raise ValueError(
+            f"hash type mismatch: {hash_type.__name__} != {header.hash_name}"
+        )
+    return hash_type
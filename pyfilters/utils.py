@@ -1,17 +1,221 @@
 # -*- coding: utf-8 -*-
 import math
-from typing import Tuple
+from binascii import crc_hqx
+from functools import lru_cache
+from typing import Any, Iterable, List, Tuple
 
+CLUSTER_SLOTS = 16384  # redis cluster的slot数
 
-def calculation_bloom_filter(n: int, p: float) -> Tuple[int, int, int, int]:
+
+def calculation_bloom_filter(
+    n: int, p: float, block_bits: int = 0
+) -> Tuple[int, int, int, int]:
     """
     计算布隆过滤器的位数m hash函数个数k
     :param n: 插入的元素的个数
     :param p: 误报率
+    :param block_bits: 分块布隆过滤器每块的位数，为0时不分块
+                       分块后每个块里的元素个数不均匀，误报率会略高，需要增加m来补偿
     :return: 布隆过滤器位数, hash函数个数 需要内存(Mb) 需要多少内存块
     """
     m = -(n * (math.log(p)) / (math.log(2)) ** 2)  # bit number bitarray长度
     k = m / n * math.log(2)  # hash functions
+    m, k = math.ceil(m), math.ceil(k)
+    if block_bits > 0:
+        blocks = math.ceil(m / block_bits)
+        while True:
+            m = blocks * block_bits
+            # 块内的位有限，k不能随m无限增大，在标准k附近选误报率最低的
+            k = min(
+                range(1, 2 * math.ceil(m / n * math.log(2)) + 1),
+                key=lambda x: blocked_false_positive_rate(n, m, x, block_bits),
+            )
+            if blocked_false_positive_rate(n, m, k, block_bits) <= p:
+                break
+            blocks += max(1, blocks // 100)  # 每次增加1%
     mem = math.ceil(m / 8 / 1024 / 1024)  # 需要的多少 M 内存
-    block_num = math.ceil(mem / 512)  # 需要多少个 Redis 512M 的内存块 Redis一个string最大512M
-    return math.ceil(m), math.ceil(k), mem, block_num
+    block_num = math.ceil(
+        mem / 512
+    )  # 需要多少个 Redis 512M 的内存块 Redis一个string最大512M
+    return m, k, mem, block_num
+
+
+def blocked_false_positive_rate(n: int, m: int, k: int, block_bits: int) -> float:
+    """
+    分块布隆过滤器的误报率
+    每个块里的元素个数近似服从泊松分布，按块内元素个数对普通布隆过滤器的误报率加权求和
+    :param n: 插入的元素的个数
+    :param m: 总位数
+    :param k: hash函数个数
+    :param block_bits: 每块的位数
+    :return: 误报率
+    """
+    lam = n * block_bits / m  # 每个块平均的元素个数
+    result = 0.0
+    for i in range(int(lam + 10 * math.sqrt(lam) + 10)):
+        weight = math.exp(-lam + i * math.log(lam) - math.lgamma(i + 1))
+        result += weight * (1 - (1 - 1 / block_bits) ** (i * k)) ** k
+    return result
+
+
+def calculation_cuckoo_filter(
+    n: int, p: float, bucket_size: int, fingerprint_bits: int = 0
+) -> Tuple[int, int]:
+    """
+    计算布谷鸟过滤器的桶数和指纹位数
+    桶数取2的幂，装载率按0.95计算；误报率约为 2*bucket_size/2^f
+    :param n: 插入的元素的个数
+    :param p: 误报率
+    :param bucket_size: 每个桶的槽数
+    :param fingerprint_bits: 指纹位数，为0时按误报率选择8/16/32
+    :return: 桶数, 指纹位数
+    """
+    buckets = max(1, math.ceil(n / bucket_size / 0.95))
+    buckets = 1 << (buckets - 1).bit_length()
+    if not fingerprint_bits:
+        need = math.ceil(math.log2(2 * bucket_size / p))
+        fingerprint_bits = next((bits for bits in (8, 16, 32) if bits >= need), 32)
+    return buckets, fingerprint_bits
+
+
+def calculation_xor_filter(
+    n: int, p: float, fingerprint_bits: int = 0
+) -> Tuple[int, int]:
+    """
+    计算xor过滤器的槽数和指纹位数
+    槽数取 1.23n+32 分成长度相同的3段，误报率约为 1/2^f
+    :param n: 元素的个数
+    :param p: 误报率
+    :param fingerprint_bits: 指纹位数 1到32，为0时取ceil(log2(1/p))
+    :return: 槽数(3的倍数), 指纹位数
+    """
+    segment = math.ceil((math.floor(1.23 * n) + 32) / 3)
+    if not fingerprint_bits:
+        fingerprint_bits = min(max(math.ceil(math.log2(1 / p)), 1), 32)
+    return 3 * segment, fingerprint_bits
+
+
+def scalable_stage(
+    initial_capacity: int, error_rate: float, growth: int, ratio: float, index: int
+) -> Tuple[int, float]:
+    """
+    可扩展布隆过滤器第index个过滤器的参数
+    容量按growth倍增长，错误率按ratio倍收紧，所有过滤器的错误率之和不超过error_rate
+    :return: 容量, 错误率
+    """
+    return (
+        initial_capacity * growth**index,
+        error_rate * (1 - ratio) * ratio**index,
+    )
+
+
+def stringify(items: Iterable[Any]) -> List[str]:
+    """
+    批量操作的预处理 把元素都变成str
+    :param items: 可迭代对象
+    :return: str列表
+    """
+    return [item if isinstance(item, str) else str(item) for item in items]
+
+
+def key_slot(key: str) -> int:
+    """
+    计算key在redis cluster中的slot 与redis一样，key中有非空的{...}时只计算第一个{}中的部分
+    :param key: redis中的键名
+    :return: 0-16383
+    """
+    data = key.encode()
+    start = data.find(b"{")
+    if start != -1:
+        end = data.find(b"}", start + 1)
+        if end > start + 1:
+            data = data[start + 1 : end]
+    return crc_hqx(data, 0) % CLUSTER_SLOTS  # crc_hqx就是redis使用的CRC16/XMODEM
+
+
+@lru_cache(maxsize=None)
+def slot_tags() -> Tuple[str, ...]:
+    """
+    每个slot对应的一个hash tag，key带上{tag}后就会落在指定的slot
+    从"0"开始依次尝试整数，直到每个slot都找到一个，只在第一次调用时计算
+    """
+    tags: List[str] = [""] * CLUSTER_SLOTS
+    missing = CLUSTER_SLOTS
+    i = 0
+    while missing:
+        tag = str(i)
+        slot = crc_hqx(tag.encode(), 0) % CLUSTER_SLOTS
+        if not tags[slot]:
+            tags[slot] = tag
+            missing -= 1
+        i += 1
+    return tuple(tags)
+
+
+def spread_keys(key: str, count: int) -> List[str]:
+    """
+    生成count个分片的key 分片i的key是 key:i:{tag}，tag使各个分片的slot从key的slot开始等间隔分布，
+    slot连续分配给节点时，分片就均匀地分布在集群的所有节点上
+    :param key: redis中的键名
+    :param count: 分片个数
+    :return: 每个分片的key
+    """
+    start = key_slot(key)
+    tags = slot_tags()
+    return [
+        f"{key}:{i}:{{{tags[(start + i * CLUSTER_SLOTS // count) % CLUSTER_SLOTS]}}}"
+        for i in range(count)
+    ]
+
+
+def same_slot_key(key: str, suffix: str) -> str:
+    """
+    生成与key在同一个redis cluster slot上的key，脚本可以同时访问两者
+    key中已经有hash tag时直接加上后缀，否则把key整个作为hash tag
+    :param key: redis中的键名
+    :param suffix: 后缀
+    :return: 新的key
+    """
+    for result in (key + suffix, f"{{{key}}}{suffix}"):
+        if key_slot(result) == key_slot(key):
+            return result
+    return key + suffix  # key中有不完整的{}，只在单机redis上使用
+
+
+def estimate_cardinality(m: int, k: int, bits: int) -> float:
+    """
+    由置位的位数估计布隆过滤器中的元素个数(Swamidass–Baldi)
+    n = -m/k * ln(1 - X/m)
+    :param m: 位数
+    :param k: hash函数个数
+    :param bits: 置位的位数X
+    :return: 估计的元素个数 所有位都置位时为inf
+    """
+    if bits >= m:
+        return math.inf
+    return -m / k * math.log1p(-bits / m)
+
+
+def bloom_health(
+    parts: Iterable[Tuple[int, int, int]], stages: bool = False
+) -> Tuple[float, float, int]:
+    """
+    由每一部分的(m, k, 置位的位数)估计过滤器的状态 计数过滤器用非0的计数器个数代替置位的位数
+    :param parts: 分片或者可扩展过滤器的阶段
+    :param stages: parts是阶段，判断时要查所有阶段；否则每个元素只落在一个分片里
+    :return: (填充率, 当前的误判率, 估计的元素个数 全部置位时按差一位估计)
+    """
+    parts = list(parts)
+    fill = sum(bits for _, _, bits in parts) / sum(m for m, _, _ in parts)
+    rates = [(bits / m) ** k for m, k, bits in parts]
+    if stages:
+        miss = 1.0
+        for rate in rates:
+            miss *= 1 - rate
+        fpr = 1 - miss
+    else:
+        fpr = sum(rates) / len(rates)  # 元素均匀地分到各个分片
+    items = sum(
+        round(estimate_cardinality(m, k, min(bits, m - 1))) for m, k, bits in parts
+    )
+    return fill, fpr, items
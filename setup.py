@@ -40,7 +40,7 @@ def main():
         author_email="diguohuangjiajinweijun@gmail.com",
         maintainer="v-vinson",
         python_requires=">=3.7",
-        install_requires=["bitarray", "mmh3", "typing-extensions"],
+        install_requires=["bitarray", "mmh3", "numpy", "typing-extensions"],
         extra_requires={"redis": ["redis"]},
         license="GPLv3",
         classifiers=[
@@ -1,14 +1,23 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import os
 import unittest
 
 from redis.asyncio import Redis
 
 from pyfilters.asyncio import (
+    BufferedFilter,
     ChunkedRedisBloomFilter,
+    CoalescingFilter,
     CountRedisBloomFilter,
+    CuckooRedisFilter,
+    HealthMonitor,
+    InstrumentedFilter,
     RedisBloomFilter,
+    ScalableRedisBloomFilter,
 )
+from pyfilters import PositiveCache, StatsSink
+from pyfilters.utils import key_slot
 
 redis_addr = os.getenv("REDIS_ADDRESS", "localhost")
 redis_password = os.getenv("REDIS_PASSWORD", "")
@@ -30,9 +39,9 @@ class TestAsyncRedisBloomFilter(unittest.IsolatedAsyncioTestCase):
             await self.rbf.add(i)
             await self.crbf.add(i)
             await self.chunkrbf.add(i)
-        self.assertTrue(len(self.rbf) == 1000)
-        self.assertTrue(len(self.crbf) == 1000)
-        self.assertTrue(len(self.chunkrbf) == 1000)
+        self.assertTrue(await self.rbf.size() == 1000)
+        self.assertTrue(await self.crbf.size() == 1000)
+        self.assertTrue(await self.chunkrbf.size() == 1000)
         for i in range(1000):
             self.assertTrue(await self.rbf.contains(i), f"{i}居然不在里面")
             self.assertTrue(await self.crbf.contains(i), f"{i}居然不在里面")
@@ -44,9 +53,8 @@ class TestAsyncRedisBloomFilter(unittest.IsolatedAsyncioTestCase):
         for i in range(1000):
             await self.crbf.remove(i)
             self.assertFalse(await self.crbf.contains(i), f"{i}居然没有被remove")
-            self.assertTrue(
-                len(self.crbf) == 1000 - i - 1, f"i={i}; len={len(self.crbf)}"
-            )
+            size = await self.crbf.size()
+            self.assertTrue(size == 1000 - i - 1, f"i={i}; len={size}")
 
         await self.rbf.clear()
         self.assertFalse(await self.rbf.contains(1))
@@ -54,9 +62,9 @@ class TestAsyncRedisBloomFilter(unittest.IsolatedAsyncioTestCase):
         self.assertFalse(await self.crbf.contains(1))
         await self.chunkrbf.clear()
         self.assertFalse(await self.chunkrbf.contains(1))
-        self.assertTrue(len(self.rbf) == 0)
-        self.assertTrue(len(self.crbf) == 0)
-        self.assertTrue(len(self.chunkrbf) == 0)
+        self.assertTrue(await self.rbf.size() == 0)
+        self.assertTrue(await self.crbf.size() == 0)
+        self.assertTrue(await self.chunkrbf.size() == 0)
 
     def test_raise(self):
         with self.assertRaises(NotImplementedError):
@@ -65,6 +73,313 @@ class TestAsyncRedisBloomFilter(unittest.IsolatedAsyncioTestCase):
             1 in self.crbf
         with self.assertRaises(NotImplementedError):
             1 in self.chunkrbf
+        with self.assertRaises(NotImplementedError):
+            len(self.rbf)
+        with self.assertRaises(NotImplementedError):
+            self.rbf |= self.rbf
+
+    async def test_add_many(self):
+        await self.rbf.clear()
+        await self.crbf.clear()
+        self.assertTrue((await self.rbf.add_many(range(1000), batch_size=100)).all())
+        self.assertTrue((await self.crbf.add_many(range(1000), batch_size=100)).all())
+        self.assertTrue(await self.rbf.size() == 1000)
+        self.assertTrue(await self.crbf.size() == 1000)
+        self.assertTrue((await self.rbf.contains_many(range(1000))).all())
+        self.assertTrue((await self.crbf.contains_many(range(1000))).all())
+        self.assertFalse((await self.rbf.contains_many([1001, 1002])).any())
+        self.assertTrue((await self.crbf.remove_many(range(500))).all())
+        self.assertFalse((await self.crbf.contains_many(range(500))).any())
+        await self.rbf.clear()
+        await self.crbf.clear()
+
+    async def test_union(self):
+        other = RedisBloomFilter(self.redis, "bloomfilter:other", 10000, 0.00001)
+        await self.rbf.clear()
+        await other.clear()
+        await self.rbf.add_many(range(1000))
+        await other.add_many(range(500, 1500))
+        await self.rbf.update(other)
+        self.assertTrue((await self.rbf.contains_many(range(1500))).all())
+        self.assertTrue(abs(await self.rbf.size() - 1500) < 100)
+        await self.rbf.intersection_update(other)
+        self.assertTrue((await self.rbf.contains_many(range(500, 1500))).all())
+        self.assertTrue((await self.rbf.contains_many(range(500))).sum() < 5)
+        shards = [
+            ChunkedRedisBloomFilter(
+                self.redis, f"chunkedbloomfilter:{i}", 10000, 0.00001, chunk_num=4
+            )
+            for i in range(2)
+        ]
+        for i, shard in enumerate(shards):
+            await shard.clear()
+            await shard.add_many(range(i * 1000, i * 1000 + 1000))
+        await shards[0].update(shards[1])
+        self.assertTrue((await shards[0].contains_many(range(2000))).all())
+        for f in shards + [self.rbf, other]:
+            await f.clear()
+
+    async def test_add_race(self):
+        # 判断和写入是一个脚本，并发加入同一个元素只有一个成功
+        for bloom_filter in (self.rbf, self.crbf):
+            await bloom_filter.clear()
+            results = await asyncio.gather(*(bloom_filter.add(1) for _ in range(20)))
+            self.assertTrue(sum(results) == 1)
+            self.assertTrue(await bloom_filter.size() == 1)
+        results = await asyncio.gather(*(self.crbf.remove(1) for _ in range(20)))
+        self.assertTrue(sum(results) == 1)
+        await self.rbf.clear()
+        await self.crbf.clear()
+
+    async def test_coalesce(self):
+        await self.rbf.clear()
+        async with CoalescingFilter(self.rbf, max_batch_size=100) as cf:
+            results = await asyncio.gather(*(cf.add(i) for i in range(1000)))
+            self.assertTrue(all(results))
+            results = await asyncio.gather(*(cf.contains(i) for i in range(1000)))
+            self.assertTrue(all(results))
+            self.assertFalse(await cf.contains(1001), "1001居然在里面了")
+        self.assertTrue(await self.rbf.size() == 1000)
+        with self.assertRaises(RuntimeError):
+            await cf.add(1)
+        # 背压的信号量在使用时才创建，属于当前的事件循环
+        async with CoalescingFilter(self.rbf, max_batch_size=10, max_pending=5) as cf:
+            results = await asyncio.gather(*(cf.add(i) for i in range(1000, 1100)))
+            self.assertTrue(all(results))
+        self.assertTrue(await self.rbf.size() == 1100)
+        await self.rbf.clear()
+
+    async def test_coalesce_cancel(self):
+        class Stalled:
+            async def add_many(self, items, batch_size):
+                await asyncio.Event().wait()  # redis一直不返回
+
+        cf = CoalescingFilter(Stalled(), max_batch_size=2)
+        calls = [asyncio.ensure_future(cf.add(i)) for i in range(2)]
+        await asyncio.sleep(0.01)
+        flush = asyncio.ensure_future(cf.flush())
+        await asyncio.sleep(0.01)
+        flush.cancel()  # 取消flush会取消正在执行的批次
+        for call in calls:
+            with self.assertRaises(asyncio.CancelledError):
+                await asyncio.wait_for(call, 1)  # 之前调用者会一直等待
+
+    async def test_scalable(self):
+        sbf = ScalableRedisBloomFilter(self.redis, "scalablebloomfilter", 100)
+        await sbf.clear()
+        self.assertTrue((await sbf.add_many(range(1000), batch_size=64)).all())
+        self.assertTrue(await sbf.size() == 1000)
+        estimate = await sbf.estimate_cardinality()
+        self.assertTrue(abs(estimate - 1000) < 50, f"{estimate}")
+        self.assertTrue(sbf.stages > 1)
+        self.assertTrue((await sbf.contains_many(range(1000))).all())
+        self.assertFalse(await sbf.contains(1001), "1001居然在里面了")
+        with self.assertRaises(NotImplementedError):
+            1 in sbf
+        await sbf.clear()
+        self.assertFalse(await sbf.contains(1))
+
+    async def test_cuckoo(self):
+        cf = CuckooRedisFilter(self.redis, "cuckoofilter", 10000, 0.00001)
+        await cf.clear()
+        self.assertTrue((await cf.add_many(range(1000), batch_size=100)).all())
+        self.assertFalse(await cf.add(0))
+        self.assertTrue(await cf.size() == 1000)
+        self.assertTrue((await cf.contains_many(range(1000))).all())
+        self.assertFalse(await cf.contains(1001), "1001居然在里面了")
+        self.assertTrue(await cf.remove(0))
+        self.assertFalse(await cf.contains(0), "0居然没有被remove")
+        self.assertTrue((await cf.remove_many(range(1, 1000))).all())
+        self.assertTrue(await cf.size() == 0)
+        with self.assertRaises(NotImplementedError):
+            1 in cf
+        await cf.clear()
+
+    async def test_instrumented(self):
+        sink = StatsSink()
+        cf = InstrumentedFilter(
+            CuckooRedisFilter(self.redis, "cuckoofilter", 10000, 0.00001), sink
+        )
+        await cf.clear()
+        self.assertTrue((await cf.add_many(range(1000), batch_size=100)).all())
+        await asyncio.gather(*(cf.contains(i) for i in range(10)))
+        self.assertTrue(await cf.remove(0))
+        self.assertFalse(await cf.contains(0), "0居然没有被remove")
+        self.assertTrue(sink.total("adds") == 1000)
+        self.assertTrue(sink.total("removes") == 1)
+        self.assertTrue(sink.total("hits") == 10)
+        self.assertTrue(sink.total("misses") == 1)
+        self.assertTrue(sink.total("script_calls", "add") == 10)
+        self.assertTrue(sink.total("hash_seconds", "add") > 0)
+        with self.assertRaises(NotImplementedError):
+            1 in cf
+        await cf.clear()
+        small = InstrumentedFilter(
+            CuckooRedisFilter(self.redis, "smallcuckoo", 10), sink
+        )
+        await small.clear()
+        with self.assertRaises(OverflowError):
+            await small.add_many(range(1000))
+        self.assertTrue(sink.total("adds") == 1000, "失败的add不应该计入adds")
+        self.assertTrue(sink.total("errors", "add") == 1)
+        await small.clear()
+
+    async def test_health(self):
+        rbf = RedisBloomFilter(self.redis, "healthbloomfilter", 1000, 0.01)
+        await rbf.clear()
+        events = []
+
+        async def rotate(bloom_filter, fpr):
+            events.append(fpr)
+            await bloom_filter.clear()
+
+        bf = HealthMonitor(rbf, 0.01, rotate, check_every=100)
+        for i in range(0, 1500, 100):
+            await bf.add_many(range(i, i + 100))
+        self.assertTrue(len(events) == 1, f"{events}")
+        self.assertTrue(await bf.estimated_fpr() < 0.01, "callback没有清空过滤器")
+        self.assertTrue(0 < await bf.fill_ratio() < 0.5)
+        items = await bf.estimated_items()
+        self.assertTrue(0 < items < 600, f"{items}")
+        cf = CuckooRedisFilter(self.redis, "cuckoofilter", 10000, 0.00001)
+        await cf.clear()
+        await cf.add_many(range(1000))
+        self.assertTrue(await cf.estimated_items() == 1000)
+        self.assertTrue(0 < await cf.estimated_fpr() < 0.00001)
+        with self.assertRaises(NotImplementedError):
+            len(bf)
+        await rbf.clear()
+        await cf.clear()
+
+    async def test_cache(self):
+        cache = PositiveCache(max_entries=1000, check_interval=0)
+        bf = RedisBloomFilter(self.redis, "cachedbloomfilter", 10000, cache=cache)
+        await bf.clear()
+        self.assertTrue((await bf.add_many(range(100))).all())
+        self.assertTrue(await bf.contains(1))
+        self.assertTrue((await bf.contains_many(range(100))).all())
+        self.assertTrue(cache.hits == 101, f"{cache.hits}")
+        self.assertFalse(await bf.add(1))
+        other = RedisBloomFilter(self.redis, "cachedbloomfilter", 10000)
+        await other.clear()
+        self.assertFalse(await bf.contains(1), "1居然还在缓存里")
+        await bf.clear()
+
+    async def test_buffered(self):
+        await self.rbf.clear()
+        async with BufferedFilter(self.rbf, max_pending=100, flush_interval=60) as bf:
+            self.assertTrue((await bf.add_many(range(50))).all())
+            self.assertTrue(await bf.contains(49))
+            self.assertFalse(
+                await self.rbf.contains(49), "还没有flush，49居然已经在redis里"
+            )
+            await bf.add_many(range(50, 150))  # 攒够max_pending个，后台task立即发送
+            for _ in range(100):
+                if not bf._pending:
+                    break
+                await asyncio.sleep(0.01)
+            self.assertTrue(await self.rbf.contains(49), "后台task没有写入")
+            await bf.add(1000)
+        self.assertTrue(await self.rbf.contains(1000), "close之后没有写入")
+        self.assertTrue(await self.rbf.size() == 151)
+        await self.rbf.clear()
+
+    async def test_buffered_overflow(self):
+        rbf = RedisBloomFilter(self.redis, "overflowbloomfilter", 10000, 0.00001)
+        await rbf.clear()
+        add_many = rbf.add_many
+        down = True
+
+        async def flaky_add_many(items):
+            if down:
+                raise ConnectionError("redis is down")
+            return await add_many(items)
+
+        rbf.add_many = flaky_add_many  # redis不可用，down改成False后恢复
+        bf = BufferedFilter(rbf, max_pending=10, flush_interval=0.01, max_buffered=100)
+        await bf.add_many(range(100))
+        blocked = asyncio.ensure_future(bf.add_many(range(100, 150)))
+        await asyncio.sleep(0.2)
+        self.assertFalse(blocked.done(), "缓冲区满了add_many应该等待")
+        self.assertTrue(isinstance(bf.last_error, ConnectionError))
+        self.assertTrue(await bf.size() == 100, "正在发送的元素也要计入")
+        down = False
+        await asyncio.wait_for(blocked, 5)
+        await bf.close()
+        self.assertTrue((await rbf.contains_many(range(150))).all())
+
+        await rbf.clear()
+        down = True
+        bf = BufferedFilter(
+            rbf,
+            max_pending=10,
+            flush_interval=0.01,
+            max_buffered=100,
+            overflow="drop_oldest",
+        )
+        await bf.add_many(range(160))
+        self.assertTrue(bf.dropped == 60, f"{bf.dropped}")
+        down = False
+        await bf.close()
+        self.assertTrue(await rbf.size() == 100)
+        self.assertTrue((await rbf.contains_many(range(60, 160))).all())
+
+        await rbf.clear()
+        down = True
+        bf = BufferedFilter(rbf, shadow_capacity=10000, overflow="drop_oldest")
+        await bf.add_many(range(100000))
+        self.assertTrue(bf.shadow.count <= 10000, f"{bf.shadow.count}")
+        absent = bf.shadow.contains_many(range(10**6, 10**6 + 10000)).mean()
+        self.assertTrue(absent < 0.01, f"{absent}")
+        down = False
+        await bf.close()
+        self.assertTrue(await rbf.size() == 5000)
+
+        await rbf.clear()
+        down = True
+        bf = BufferedFilter(rbf, max_pending=10, max_buffered=100, overflow="raise")
+        await bf.add_many(range(200, 300))
+        with self.assertRaises(OverflowError):
+            await bf.add_many(range(300, 310))
+        down = False
+        await bf.close()
+        self.assertTrue(await rbf.size() == 100)
+        await rbf.clear()
+
+    async def test_cluster(self):
+        redis = self.redis
+        nodes = set()
+
+        class Node:
+            def __init__(self, name):
+                self.name = name
+
+        class FakeCluster:
+            """把单机redis当成3个节点的集群，只实现过滤器用到的接口"""
+
+            def get_node_from_key(self, key):
+                nodes.add(key_slot(key) * 3 // 16384)
+                return Node(str(key_slot(key) * 3 // 16384))
+
+            def pipeline(self, transaction=None):
+                return redis.pipeline(transaction=False)
+
+            def __getattr__(self, name):
+                return getattr(redis, name)
+
+        bf = ChunkedRedisBloomFilter(
+            FakeCluster(), "clusterbloomfilter", 10000, cluster=True, chunk_num=8
+        )
+        await bf.clear()
+        self.assertTrue((await bf.add_many(range(1000), batch_size=100)).all())
+        self.assertTrue(nodes == {0, 1, 2}, "没有分散到所有节点")
+        self.assertTrue((await bf.contains_many(range(1000))).all())
+        self.assertTrue(await bf.contains(999))
+        self.assertFalse(await bf.contains(1001), "1001居然在里面了")
+        self.assertTrue(await bf.size() == 1000)
+        estimate = await bf.estimate_cardinality()
+        self.assertTrue(abs(estimate - 1000) < 50, f"{estimate}")
+        await bf.clear()
 
 
 class TestAsyncRedisBloomFilterResp3(unittest.IsolatedAsyncioTestCase):
@@ -86,9 +401,9 @@ class TestAsyncRedisBloomFilterResp3(unittest.IsolatedAsyncioTestCase):
             await self.rbf.add(i)
             await self.crbf.add(i)
             await self.chunkrbf.add(i)
-        self.assertTrue(len(self.rbf) == 1000)
-        self.assertTrue(len(self.crbf) == 1000)
-        self.assertTrue(len(self.chunkrbf) == 1000)
+        self.assertTrue(await self.rbf.size() == 1000)
+        self.assertTrue(await self.crbf.size() == 1000)
+        self.assertTrue(await self.chunkrbf.size() == 1000)
         for i in range(1000):
             self.assertTrue(await self.rbf.contains(i), f"{i}居然不在里面")
             self.assertTrue(await self.crbf.contains(i), f"{i}居然不在里面")
@@ -100,9 +415,8 @@ class TestAsyncRedisBloomFilterResp3(unittest.IsolatedAsyncioTestCase):
         for i in range(1000):
             await self.crbf.remove(i)
             self.assertFalse(await self.crbf.contains(i), f"{i}居然没有被remove")
-            self.assertTrue(
-                len(self.crbf) == 1000 - i - 1, f"i={i}; len={len(self.crbf)}"
-            )
+            size = await self.crbf.size()
+            self.assertTrue(size == 1000 - i - 1, f"i={i}; len={size}")
 
         await self.rbf.clear()
         self.assertFalse(await self.rbf.contains(1))
@@ -110,9 +424,9 @@ class TestAsyncRedisBloomFilterResp3(unittest.IsolatedAsyncioTestCase):
         self.assertFalse(await self.crbf.contains(1))
         await self.chunkrbf.clear()
         self.assertFalse(await self.chunkrbf.contains(1))
-        self.assertTrue(len(self.rbf) == 0)
-        self.assertTrue(len(self.crbf) == 0)
-        self.assertTrue(len(self.chunkrbf) == 0)
+        self.assertTrue(await self.rbf.size() == 0)
+        self.assertTrue(await self.crbf.size() == 0)
+        self.assertTrue(await self.chunkrbf.size() == 0)
 
     def test_raise(self):
         with self.assertRaises(NotImplementedError):
@@ -1,13 +1,37 @@
+import multiprocessing
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
 
+import pyfilters
 from pyfilters import (
+    BlockedMemoryBloomFilter,
     CountMemoryBloomFilter,
+    CuckooMemoryFilter,
     HashlibHashMap,
+    HealthMonitor,
+    InstrumentedFilter,
     MemoryBloomFilter,
+    MmapMemoryBloomFilter,
     PyHashMap,
+    ScalableMemoryBloomFilter,
+    SharedMemoryBloomFilter,
+    StatsSink,
+    XorFilter,
+    build_parallel,
+    serialization,
 )
 
 
+def _shared_add(bf, start):
+    bf.add_many(range(start, start + 1000))
+    bf.close()
+
+
 class MyTestCase(unittest.TestCase):
     def setUp(self) -> None:
         self.bf = MemoryBloomFilter(10000, 0.00001, HashlibHashMap)
@@ -34,6 +58,470 @@ class MyTestCase(unittest.TestCase):
         self.cbf.clear()
         self.assertNotIn(1, self.cbf)
 
+    def test_add_many(self):
+        self.assertTrue(self.bf.add_many(range(1000)).all())
+        self.assertTrue(self.cbf.add_many(range(1000)).all())
+        self.assertTrue(len(self.bf) == 1000)
+        self.assertTrue(len(self.cbf) == 1000)
+        for i in range(1000):
+            self.assertTrue(i in self.bf, f"{i}居然不在里面")
+            self.assertTrue(i in self.cbf, f"{i}居然不在里面")
+        self.assertTrue(self.bf.contains_many(range(1000)).all())
+        self.assertTrue(self.cbf.contains_many(range(1000)).all())
+        self.assertFalse(self.bf.contains_many([1001, 1002]).any())
+        self.assertFalse(self.cbf.contains_many([1001, 1002]).any())
+        # 重复元素只插入一次
+        self.assertEqual(
+            self.bf.add_many([999, 2000, 2000]).tolist(), [False, True, False]
+        )
+        self.assertTrue(len(self.bf) == 1001)
+
+        self.assertTrue(self.cbf.remove_many(range(500)).all())
+        self.assertTrue(len(self.cbf) == 500)
+        self.assertFalse(self.cbf.contains_many(range(500)).any())
+        self.assertTrue(self.cbf.contains_many(range(500, 1000)).all())
+
+    def test_double_hashing(self):
+        bf = MemoryBloomFilter(10000, 0.00001, HashlibHashMap, double_hashing=True)
+        cbf = CountMemoryBloomFilter(10000, 0.00001, PyHashMap, double_hashing=True)
+        self.assertTrue(len(bf.hashmaps) == 1)
+        for i in range(1000):
+            self.assertTrue(bf.add(i))
+            self.assertTrue(cbf.add(i))
+        for i in range(1000):
+            self.assertTrue(i in bf, f"{i}居然不在里面")
+            self.assertTrue(i in cbf, f"{i}居然不在里面")
+        self.assertNotIn(1001, bf, "1001居然在里面了")
+        self.assertNotIn(1001, cbf, "1001居然在里面了")
+        # 批量计算的偏移量与逐个计算的一致
+        self.assertEqual(
+            bf._offsets_many(["1", "2"]).tolist(),
+            [list(bf._offsets("1")), list(bf._offsets("2"))],
+        )
+        self.assertTrue(bf.contains_many(range(1000)).all())
+        self.assertTrue(cbf.remove_many(range(1000)).all())
+        self.assertFalse(cbf.contains_many(range(1000)).any())
+
+    def test_mmap(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "filter.bf")
+            with MmapMemoryBloomFilter(path, 10000, 0.00001, HashlibHashMap) as bf:
+                for i in range(1000):
+                    bf.add(i)
+                self.assertTrue(len(bf) == 1000)
+            # 重新打开 参数从文件头读取
+            with MmapMemoryBloomFilter(path) as bf:
+                self.assertTrue(len(bf) == 1000)
+                self.assertTrue(bf.contains_many(range(1000)).all())
+                self.assertNotIn(1001, bf, "1001居然在里面了")
+                reader = MmapMemoryBloomFilter(path, readonly=True)
+                bf.add(1001)
+                self.assertIn(1001, reader)
+                self.assertTrue(len(reader) == 1001)
+                with self.assertRaises(TypeError):
+                    reader.add(1002)
+                reader.close()
+            with self.assertRaises(ValueError):
+                MmapMemoryBloomFilter(path, 20000, 0.00001, HashlibHashMap)
+            with self.assertRaises(ValueError):
+                MmapMemoryBloomFilter(path, 10000, 0.00001, PyHashMap)
+
+    def test_shared_memory(self):
+        lock = multiprocessing.Lock()
+        with SharedMemoryBloomFilter(None, 10000, 0.00001, lock=lock) as bf:
+            bf.add_many(range(1000))
+            other = SharedMemoryBloomFilter(bf.name)  # 按名字连接 参数从头部读取
+            self.assertTrue(len(other) == 1000)
+            self.assertTrue(other.contains_many(range(1000)).all())
+            other.add(1001)
+            self.assertIn(1001, bf)
+            other.close()
+            workers = [
+                multiprocessing.Process(target=_shared_add, args=(bf, start))
+                for start in (2000, 3000)
+            ]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            self.assertTrue(all(worker.exitcode == 0 for worker in workers))
+            self.assertTrue(bf.contains_many(range(2000, 4000)).all())
+            self.assertTrue(len(bf) == 3001, f"{len(bf)}")
+            # 锁只能在创建进程时传递，不带锁的可以随意pickle
+            reader = SharedMemoryBloomFilter(bf.name)
+            loaded = pickle.loads(pickle.dumps(reader))
+            self.assertTrue(loaded.name == bf.name and len(loaded) == 3001)
+            loaded.close()
+            reader.close()
+            self.assertTrue(MemoryBloomFilter.from_bytes(bf.to_bytes()).m == bf.m)
+        with self.assertRaises(FileNotFoundError):
+            SharedMemoryBloomFilter(bf.name)
+
+    def test_shared_memory_attach(self):
+        # 无关的进程(有自己的resource_tracker)连接之后退出，不能释放共享内存
+        root = os.path.dirname(os.path.dirname(os.path.abspath(pyfilters.__file__)))
+        env = dict(os.environ, PYTHONPATH=root)
+        with SharedMemoryBloomFilter(None, 10000, 0.00001) as bf:
+            bf.add_many(range(1000))
+            code = (
+                "import sys\n"
+                "from pyfilters import SharedMemoryBloomFilter\n"
+                "bf = SharedMemoryBloomFilter(sys.argv[1])\n"
+                "bf.add(1001)\n"
+                "bf.close()\n"
+            )
+            result = subprocess.run(
+                [sys.executable, "-c", code, bf.name],
+                env=env,
+                capture_output=True,
+                text=True,
+                timeout=60,
+            )
+            self.assertTrue(result.returncode == 0, result.stderr)
+            self.assertNotIn("leaked", result.stderr)
+            other = SharedMemoryBloomFilter(bf.name)  # 共享内存还在
+            self.assertTrue(len(other) == 1001)
+            self.assertIn(1001, other)
+            other.close()
+        with self.assertRaises(FileNotFoundError):
+            SharedMemoryBloomFilter(bf.name)
+
+    def test_serialization(self):
+        self.bf.add_many(range(1000))
+        self.cbf.add_many(range(1000))
+        for f in (self.bf, self.cbf):
+            data = f.to_bytes()
+            loaded = type(f).from_bytes(memoryview(data))
+            self.assertTrue(len(loaded) == 1000)
+            self.assertTrue(loaded.contains_many(range(1000)).all())
+            self.assertNotIn(1001, loaded, "1001居然在里面了")
+            loaded = type(f).from_bytes(data, copy=True)
+            loaded.add(1001)
+            self.assertIn(1001, loaded)
+            self.assertNotIn(1001, f)
+            for protocol in range(2, pickle.HIGHEST_PROTOCOL + 1):
+                loaded = pickle.loads(pickle.dumps(f, protocol=protocol))
+                self.assertTrue(len(loaded) == 1000)
+                self.assertTrue(loaded.contains_many(range(1000)).all())
+                loaded.add(1001)
+                self.assertIn(1001, loaded)
+            # protocol 5 带外传输
+            buffers = []
+            data = pickle.dumps(f, protocol=5, buffer_callback=buffers.append)
+            loaded = pickle.loads(data, buffers=buffers)
+            self.assertTrue(loaded.contains_many(range(1000)).all())
+        with self.assertRaises(ValueError):
+            CountMemoryBloomFilter.from_bytes(self.bf.to_bytes())
+
+    def test_stripes(self):
+        filters = [
+            MemoryBloomFilter(100000, 0.00001, stripes=16),
+            BlockedMemoryBloomFilter(100000, 0.00001, stripes=16),
+            CountMemoryBloomFilter(100000, 0.00001, counter_bits=4, stripes=16),
+        ]
+        for f in filters:
+
+            def work(start):
+                # 每个线程的区间有一半和下一个线程重叠，同一个元素只能有一个线程插入成功
+                for i in range(start, start + 500, 100):
+                    f.add_many(range(i, i + 100))
+                for i in range(start + 500, start + 1000):
+                    f.add(i)
+
+            threads = [threading.Thread(target=work, args=(i * 500,)) for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertTrue(len(f) == 4500, f"{type(f).__name__} {len(f)}")
+            self.assertTrue(f.contains_many(range(4500)).all())
+            if isinstance(f, CountMemoryBloomFilter):
+                threads = [
+                    threading.Thread(target=f.remove_many, args=(range(i, 4500, 8),))
+                    for i in range(8)
+                ]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                self.assertTrue(len(f) == 0)
+                self.assertFalse(f._counters().any())
+            f.clear()
+            self.assertTrue(len(f) == 0)
+
+    def test_build_parallel(self):
+        for f in (
+            MemoryBloomFilter(100000, 0.001),
+            BlockedMemoryBloomFilter(100000, 0.001),
+            CountMemoryBloomFilter(100000, 0.001, counter_bits=4),
+        ):
+            expected = type(f).from_bytes(f.to_bytes(), copy=True)
+            expected.add_many(range(20000))
+            build_parallel(f, range(20000), workers=2, chunk_size=3000)
+            self.assertTrue(f.to_bytes() == expected.to_bytes(), "并行构建的结果不一样")
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "items.txt")
+            with open(path, "w") as f:
+                f.write("\n".join(map(str, range(5000))) + "\n\n")
+            build_parallel(self.bf, path, workers=2)
+        self.assertTrue(len(self.bf) == 5000)
+        self.assertTrue(self.bf.contains_many(range(5000)).all())
+
+    def test_merge(self):
+        other = MemoryBloomFilter(10000, 0.00001, HashlibHashMap)
+        self.bf.add_many(range(1000))
+        other.add_many(range(1000, 2000))
+        self.bf.merge(MemoryBloomFilter.from_bytes(other.to_bytes()))
+        self.assertTrue(self.bf.contains_many(range(2000)).all())
+        self.assertTrue(len(self.bf) == 2000)
+        counters = CountMemoryBloomFilter(10000, 0.00001, PyHashMap)
+        counters.add_many(range(500))
+        self.cbf.add_many(range(500))
+        self.cbf.merge(counters)
+        self.assertTrue(self.cbf.remove_many(range(500)).all())
+        self.assertIn(1, self.cbf, "计数器相加后删除一次应该还在")
+        with self.assertRaises(ValueError):
+            self.bf.merge(MemoryBloomFilter(10000, 0.00001, PyHashMap))
+        with self.assertRaises(ValueError):
+            self.cbf.merge(CountMemoryBloomFilter(10000, 0.00001, PyHashMap, "i"))
+
+    def test_union(self):
+        shards = [MemoryBloomFilter(10000, 0.00001, HashlibHashMap) for _ in range(3)]
+        for i, shard in enumerate(shards):
+            shard.add_many(range(i * 500, i * 500 + 1000))
+        merged = shards[0].union(*shards[1:])
+        self.assertTrue(merged.contains_many(range(2000)).all())
+        self.assertTrue(abs(len(merged) - 2000) < 100, f"{len(merged)}")
+        self.assertNotIn(1500, shards[0], "union不应该修改原来的过滤器")
+        both = shards[0] & shards[1]
+        self.assertTrue(both.contains_many(range(500, 1000)).all())
+        self.assertTrue(both.contains_many(range(500)).sum() < 5, "误判太多")
+        self.bf |= shards[2]
+        self.bf &= shards[1]
+        self.assertTrue(self.bf.contains_many(range(1000, 1500)).all())
+        counters = [
+            CountMemoryBloomFilter(10000, 0.00001, counter_bits=4) for _ in "ab"
+        ]
+        counters[0].add_many(range(1000))
+        counters[1].add_many(range(500, 1500))
+        merged = counters[0] | counters[1]
+        self.assertTrue(merged.remove_many(range(1500)).all())
+        self.assertTrue(merged.contains_many(range(500, 1000)).all(), "计数器没有相加")
+        both = counters[0] & counters[1]
+        self.assertTrue(both.remove_many(range(500, 1000)).all())
+        self.assertFalse(both.contains_many(range(500, 1000)).any())
+        with self.assertRaises(ValueError):
+            self.bf |= self.cbf
+        with self.assertRaises(TypeError):
+            self.bf |= ScalableMemoryBloomFilter(100)
+
+    def test_instrumented(self):
+        sink = StatsSink()
+        bf = InstrumentedFilter(self.bf, sink, "memory")
+        self.assertTrue(bf.add_many(range(1000)).all())
+        self.assertTrue(bf.add(1000))
+        self.assertTrue(bf.contains_many(range(2000)).sum() == 1001)
+        self.assertIn(1, bf)
+        self.assertTrue(len(bf) == len(self.bf) == 1001)
+        self.assertTrue(sink.total("adds") == 1001)
+        self.assertTrue(sink.total("hits") == 1002)
+        self.assertTrue(sink.total("misses") == 999)
+        self.assertTrue(sink.total("hash_seconds") > 0, "没有统计hash的耗时")
+        self.assertTrue(sink.quantile("latency_seconds", 0.5, "add") > 0)
+        self.assertTrue(self.bf.add(2000), "直接调用原来的过滤器应该正常工作")
+        self.assertTrue(sink.total("adds") == 1001, "没有包装的操作不应该统计")
+        # 可扩展过滤器后来新增的阶段也要统计hash
+        sbf = InstrumentedFilter(ScalableMemoryBloomFilter(100), sink)
+        sbf.add_many(range(1000))
+        stages = sbf.bloom_filter.filters
+        self.assertTrue(len(stages) > 1)
+        hashed = sink.total("hash_seconds", "contains")
+        sbf.contains_many(range(10))
+        self.assertTrue(sink.total("hash_seconds", "contains") > hashed)
+        self.assertTrue(sink.total("adds", "add") == 2001)
+        # 包装不修改原来的过滤器，仍然可以pickle
+        cf = CuckooMemoryFilter(1000)
+        InstrumentedFilter(cf, sink).add_many(range(100))
+        for f in (sbf.bloom_filter, cf):
+            self.assertFalse({"_offsets", "_locate"} & set(vars(f)))
+            loaded = pickle.loads(pickle.dumps(f))
+            self.assertTrue(loaded.contains_many(range(100)).all())
+        # 失败的操作只计入errors
+        adds = sink.total("adds")
+        with self.assertRaises(OverflowError):
+            InstrumentedFilter(CuckooMemoryFilter(10), sink).add_many(range(1000))
+        self.assertTrue(sink.total("adds") == adds, "失败的add不应该计入adds")
+        self.assertTrue(sink.total("errors", "add") == 1)
+
+    def test_health(self):
+        self.assertTrue(self.bf.fill_ratio() == 0)
+        self.assertTrue(self.bf.estimated_fpr() == 0)
+        self.bf.add_many(range(10000))
+        self.assertTrue(
+            abs(self.bf.fill_ratio() - 0.5) < 0.01, f"{self.bf.fill_ratio()}"
+        )
+        self.assertTrue(abs(self.bf.estimated_fpr() - 0.00001) < 0.000005)
+        self.assertTrue(abs(self.bf.estimated_items() - 10000) < 100)
+        sbf = ScalableMemoryBloomFilter(1000, 0.001)
+        sbf.add_many(range(10000))
+        self.assertTrue(sbf.estimated_fpr() < 0.001, f"{sbf.estimated_fpr()}")
+        self.assertTrue(abs(sbf.estimated_items() - 10000) < 200)
+        cf = CuckooMemoryFilter(10000, 0.001)
+        cf.add_many(range(5000))
+        self.assertTrue(cf.estimated_items() == 5000)
+        self.assertTrue(0 < cf.estimated_fpr() < 0.001)
+        cbf = CountMemoryBloomFilter(100, 0.01, counter_bits=4)
+        for _ in range(20):
+            cbf._change_many(cbf._offsets_many(["0"]), 1)
+        self.assertTrue(cbf.estimated_items() == 1)
+        self.assertTrue(cbf.saturation() == cbf.k / cbf.m, f"{cbf.saturation()}")
+
+        events = []
+
+        def rotate(bloom_filter, fpr):
+            events.append(fpr)
+            return MemoryBloomFilter(1000, 0.01)
+
+        bf = HealthMonitor(MemoryBloomFilter(1000, 0.01), 0.01, rotate, 100)
+        for i in range(0, 3000, 50):
+            bf.add_many(range(i, i + 50))
+        self.assertTrue(len(events) == 2, f"{events}")
+        self.assertTrue(all(fpr >= 0.01 for fpr in events))
+        self.assertTrue(bf.estimated_fpr() < 0.01, "没有换成新的过滤器")
+        self.assertIn(2999, bf)
+
+    def test_counter_bits(self):
+        for bits in (4, 8):
+            cbf = CountMemoryBloomFilter(10000, 0.00001, counter_bits=bits)
+            self.assertTrue(len(cbf.array) == (cbf.m * bits + 7) // 8)
+            for i in range(1000):
+                self.assertTrue(cbf.add(i))
+            self.assertTrue(cbf.contains_many(range(1000)).all())
+            self.assertTrue(cbf.remove_many(range(500)).all())
+            for i in range(500, 1000):
+                self.assertTrue(cbf.remove(i))
+                self.assertNotIn(i, cbf, f"{i}居然没有被remove")
+            self.assertTrue(len(cbf) == 0)
+            self.assertFalse(cbf._counters().any())
+            # 饱和之后不再变化
+            for _ in range((1 << bits) + 2):
+                cbf._change(0, 1)
+            self.assertTrue(cbf._get(0) == (1 << bits) - 1)
+            cbf._change(0, -1)
+            self.assertTrue(cbf._get(0) == (1 << bits) - 1)
+            loaded = CountMemoryBloomFilter.from_bytes(cbf.to_bytes())
+            self.assertTrue(loaded.counter_bits == bits)
+            self.assertTrue(loaded._get(0) == (1 << bits) - 1)
+            cbf.clear()
+            self.assertFalse(cbf._counters().any())
+
+    def test_blocked(self):
+        for double_hashing in (False, True):
+            bf = BlockedMemoryBloomFilter(10000, 0.001, double_hashing=double_hashing)
+            self.assertTrue(bf.m % 512 == 0)
+            for i in range(1000):
+                self.assertTrue(bf.add(i))
+                # 一个元素的所有位都在同一个512位的块内
+                self.assertTrue(len({o // 512 for o in bf._offsets(str(i))}) == 1)
+            self.assertTrue(bf.contains_many(range(1000)).all())
+            self.assertTrue(
+                bf._offsets_many(["1", "2"]).tolist()
+                == [list(bf._offsets("1")), list(bf._offsets("2"))]
+            )
+            loaded = pickle.loads(pickle.dumps(bf))
+            self.assertTrue(type(loaded) is BlockedMemoryBloomFilter)
+            self.assertTrue(loaded.contains_many(range(1000)).all())
+            with self.assertRaises(ValueError):
+                MemoryBloomFilter.from_bytes(bf.to_bytes())
+
+    def test_scalable(self):
+        sbf = ScalableMemoryBloomFilter(1000, 0.001)
+        for i in range(3000):
+            self.assertTrue(sbf.add(i))
+        self.assertTrue(len(sbf.filters) == 2)
+        self.assertFalse(sbf.add(0))
+        added = sbf.add_many(range(2000, 20000))
+        self.assertFalse(added[:1000].any())
+        self.assertTrue(len(sbf) == 3000 + int(added.sum()))
+        self.assertTrue(len(sbf) <= sbf.capacity)
+        self.assertTrue(sbf.contains_many(range(20000)).all())
+        # 总的错误率不超过error_rate
+        self.assertTrue(sbf.contains_many(range(10**6, 10**6 + 100000)).mean() < 0.001)
+        sbf.clear()
+        self.assertTrue(len(sbf.filters) == 1 and len(sbf) == 0)
+        # 重复加入已有的元素不会新建过滤器
+        sbf = ScalableMemoryBloomFilter(10, 0.01)
+        sbf.add_many(range(10))
+        self.assertFalse(sbf.add(5))
+        self.assertTrue(len(sbf.filters) == 1, f"{len(sbf.filters)}")
+
+    def test_cuckoo(self):
+        cf = CuckooMemoryFilter(10000, 0.00001, PyHashMap)
+        self.assertTrue(cf.fingerprint_bits == 32)
+        for i in range(1000):
+            self.assertTrue(cf.add(i))
+        self.assertFalse(cf.add(0))
+        self.assertTrue(cf.add_many(range(1000, 9000)).all())
+        self.assertTrue(len(cf) == 9000)
+        self.assertTrue(cf.contains_many(range(9000)).all())
+        self.assertFalse(cf.contains_many(range(10**6, 10**6 + 10000)).any())
+        self.assertTrue(cf.remove(0))
+        self.assertNotIn(0, cf, "0居然没有被remove")
+        self.assertFalse(cf.remove(0))
+        self.assertTrue(cf.remove_many(range(1, 9000)).all())
+        self.assertTrue(len(cf) == 0)
+        self.assertFalse(cf.table.any())
+
+        small = CuckooMemoryFilter(10, fingerprint_bits=8)
+        with self.assertRaises(OverflowError):
+            small.add_many(range(1000))
+        self.assertTrue(len(small) == small.capacity)
+        cf.clear()
+        self.assertNotIn(1, cf)
+
+    def test_xor(self):
+        xf = XorFilter(range(10000), 0.00001, PyHashMap)
+        self.assertTrue(xf.fingerprint_bits == 17)
+        # 指纹按位紧凑存放，比同样误判率的布隆过滤器小
+        bits_per_key = xf.fingerprints.nbytes * 8 / len(xf)
+        bloom = MemoryBloomFilter(10000, 0.00001)
+        self.assertTrue(bits_per_key < 1.25 * 17 + 1, f"{bits_per_key}")
+        self.assertTrue(bits_per_key < bloom.m / 10000, f"{bits_per_key}")
+        self.assertTrue(len(xf) == 10000)
+        for i in range(1000):
+            self.assertTrue(i in xf, f"{i}居然不在里面")
+        self.assertTrue(xf.contains_many(range(10000)).all())
+        self.assertFalse(xf.contains_many(range(10**6, 10**6 + 10000)).any())
+        with self.assertRaises(NotImplementedError):
+            xf.add(1)
+
+        xf = XorFilter(map(str, range(10000)), fingerprint_bits=8)
+        self.assertTrue(xf.contains_many(range(10000)).all())
+        self.assertTrue(xf.contains_many(range(10**6, 10**6 + 100000)).mean() < 0.01)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "blocklist.xf")
+            xf.save(path)
+            loaded = XorFilter.load(path)
+            self.assertTrue(loaded.contains_many(range(10000)).all())
+            self.assertTrue(len(loaded) == 10000)
+            del loaded
+        loaded = pickle.loads(pickle.dumps(xf, protocol=5))
+        self.assertTrue(loaded.contains_many(range(10000)).all())
+
+        for bits in (1, 7, 13, 16, 31):
+            xf = XorFilter(range(3000), fingerprint_bits=bits)
+            self.assertTrue(xf.contains_many(range(3000)).all(), f"{bits}")
+            self.assertTrue(all(i in xf for i in range(0, 3000, 7)), f"{bits}")
+            rate = xf.contains_many(range(10**6, 10**6 + 20000)).mean()
+            self.assertTrue(rate < 2.0**-bits * 1.5 + 0.001, f"{bits} {rate}")
+            loaded = XorFilter.from_bytes(xf.to_bytes())
+            self.assertTrue(loaded.contains_many(range(3000)).all())
+        invalid = serialization.pack_header(xf._header()._replace(typecode="H"))
+        with self.assertRaises(ValueError):
+            XorFilter.from_bytes(invalid + xf.fingerprints.tobytes())
+        with self.assertRaises(ValueError):
+            MemoryBloomFilter.from_bytes(xf.to_bytes())
+
 
 if __name__ == "__main__":
     unittest.main()
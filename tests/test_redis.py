@@ -1,13 +1,27 @@
 # -*- coding: utf-8 -*-
 import os
+import threading
+import time
 import unittest
+from collections import Counter
 
 redis_addr = os.getenv("REDIS_ADDRESS", "localhost")
 redis_password = os.getenv("REDIS_PASSWORD", "")
 
 from redis import Redis
 
-from pyfilters import ChunkedRedisBloomFilter, CountRedisBloomFilter, RedisBloomFilter
+from pyfilters import (
+    BufferedFilter,
+    CallbackSink,
+    ChunkedRedisBloomFilter,
+    CountRedisBloomFilter,
+    CuckooRedisFilter,
+    InstrumentedFilter,
+    PositiveCache,
+    RedisBloomFilter,
+    ScalableRedisBloomFilter,
+)
+from pyfilters.utils import key_slot
 
 
 class TestRedis(unittest.TestCase):
@@ -42,6 +56,99 @@ class TestRedis(unittest.TestCase):
         self.rcbf.clear()
         self.assertNotIn(1, self.rcbf)
 
+    def test_add_many(self):
+        self.rbf.clear()
+        self.rcbf.clear()
+        self.assertTrue(self.rbf.add_many(range(1000), batch_size=100).all())
+        self.assertTrue(self.rcbf.add_many(range(1000), batch_size=100).all())
+        self.assertTrue(len(self.rbf) == 1000)
+        self.assertTrue(len(self.rcbf) == 1000)
+        for i in range(1000):
+            self.assertTrue(i in self.rbf, f"{i}居然不在里面")
+            self.assertTrue(i in self.rcbf, f"{i}居然不在里面")
+        self.assertTrue(self.rbf.contains_many(range(1000)).all())
+        self.assertTrue(self.rcbf.contains_many(range(1000)).all())
+        self.assertFalse(self.rbf.contains_many([1001, 1002]).any())
+        self.assertFalse(self.rcbf.contains_many([1001, 1002]).any())
+        self.assertEqual(
+            self.rbf.add_many([999, 2000, 2000]).tolist(), [False, True, False]
+        )
+
+        self.assertTrue(self.rcbf.remove_many(range(500)).all())
+        self.assertTrue(len(self.rcbf) == 500)
+        self.assertFalse(self.rcbf.contains_many(range(500)).any())
+
+        self.rbf.clear()
+        self.rcbf.clear()
+
+    def test_shared_count(self):
+        # 计数保存在redis中，其他客户端的len也是准确的
+        self.rbf.clear()
+        other = RedisBloomFilter(self.redis, "bloomfilter", 10000, 0.00001)
+        self.rbf.add_many(range(500))
+        other.add_many(range(250, 1000))
+        self.assertTrue(len(self.rbf) == len(other) == 1000, f"{len(other)}")
+        estimate = self.rbf.estimate_cardinality()
+        self.assertTrue(abs(estimate - 1000) < 50, f"{estimate}")
+        other.clear()
+        self.assertTrue(len(self.rbf) == 0)
+        self.assertTrue(self.rbf.estimate_cardinality() == 0)
+
+    def test_union(self):
+        days = [
+            RedisBloomFilter(self.redis, f"bloomfilter:day{i}", 10000, 0.00001)
+            for i in range(3)
+        ]
+        for i, day in enumerate(days):
+            day.clear()
+            day.add_many(range(i * 500, i * 500 + 1000))
+        self.rbf.clear()
+        self.rbf |= days[0]
+        self.rbf.update(*days[1:])
+        self.assertTrue(self.rbf.contains_many(range(2000)).all())
+        self.assertTrue(abs(len(self.rbf) - 2000) < 100, f"{len(self.rbf)}")
+        self.rbf &= days[1]
+        self.assertTrue(self.rbf.contains_many(range(500, 1500)).all())
+        self.assertTrue(self.rbf.contains_many(range(500)).sum() < 5, "误判太多")
+        with self.assertRaises(ValueError):
+            self.rbf.update(RedisBloomFilter(self.redis, "bloomfilter:small", 100))
+        shards = [
+            ChunkedRedisBloomFilter(
+                self.redis, f"chunkedbloomfilter:{i}", 10000, 0.00001, chunk_num=4
+            )
+            for i in range(2)
+        ]
+        for i, shard in enumerate(shards):
+            shard.clear()
+            shard.add_many(range(i * 1000, i * 1000 + 1000))
+        shards[0] |= shards[1]
+        self.assertTrue(shards[0].contains_many(range(2000)).all())
+        self.assertTrue(abs(len(shards[0]) - 2000) < 100, f"{len(shards[0])}")
+        for f in days + shards:
+            f.clear()
+
+
+    def test_health(self):
+        self.rbf.clear()
+        self.rcbf.clear()
+        self.rbf.add_many(range(10000))
+        self.rcbf.add_many(range(5000))
+        other = RedisBloomFilter(self.redis, "bloomfilter", 10000, 0.00001)
+        other.add_many(range(10000, 12000))
+        # 其他客户端加入的元素也能估计出来
+        self.assertTrue(abs(self.rbf.estimated_items() - 12000) < 200)
+        self.assertTrue(self.rbf.estimated_fpr() > 0.00001, "超过容量后误判率应该变大")
+        self.assertTrue(0.5 < self.rbf.fill_ratio() < 0.7)
+        self.assertTrue(abs(self.rcbf.estimated_items() - 5000) < 100)
+        self.assertTrue(self.rcbf.estimated_fpr() < 0.00001)
+        self.rcbf.remove_many(range(4999))
+        self.rcbf.remove(4999)
+        self.assertTrue(self.rcbf.fill_ratio() == 0, "计数器减到0不应该计入")
+        self.assertTrue(self.redis.hlen(self.rcbf.key) == 0, "减到0的计数器没有删除")
+        self.rbf.clear()
+        self.rcbf.clear()
+
+
 class TestRedisResp3(unittest.TestCase):
     def setUp(self):
         self.redis = Redis(redis_addr, port=6379, db=0, password=redis_password, protocol=3)
@@ -76,6 +183,7 @@ class TestRedisResp3(unittest.TestCase):
         self.rcbf.clear()
         self.assertNotIn(1, self.rcbf)
 
+
 class TestChunkedRedis(unittest.TestCase):
     def setUp(self):
         self.redis = Redis(redis_addr, port=6379, db=0, password=redis_password)
@@ -95,6 +203,28 @@ class TestChunkedRedis(unittest.TestCase):
         self.rbf.clear()
         self.assertNotIn(1, self.rbf)
 
+    def test_add_many(self):
+        self.rbf.clear()
+        self.assertTrue(self.rbf.add_many(range(1000), batch_size=100).all())
+        self.assertTrue(len(self.rbf) == 1000)
+        for i in range(1000):
+            self.assertTrue(i in self.rbf, f"{i}居然不在里面")
+        self.assertTrue(self.rbf.contains_many(range(1000)).all())
+        self.assertFalse(self.rbf.contains_many([1001, 1002]).any())
+
+        self.rbf.clear()
+
+    def test_chunk_balance(self):
+        rbf = ChunkedRedisBloomFilter(
+            self.redis, "chunkedbloomfilter:balance", 100000, 0.001, chunk_num=300
+        )
+        counts = Counter(rbf._chunk_key(str(i)) for i in range(300000))
+        head = [counts[key] for key in rbf.chunk_keys[:196]]
+        tail = [counts[key] for key in rbf.chunk_keys[196:]]
+        ratio = (sum(head) / len(head)) / (sum(tail) / len(tail))
+        self.assertTrue(abs(ratio - 1) < 0.03, f"分片不均匀 {ratio}")
+
+
 class TestChunkedRedisResp3(unittest.TestCase):
     def setUp(self):
         self.redis = Redis(redis_addr, port=6379, db=0, password=redis_password, protocol=3)
@@ -114,5 +244,327 @@ class TestChunkedRedisResp3(unittest.TestCase):
         self.rbf.clear()
         self.assertNotIn(1, self.rbf)
 
+
+class TestScalableRedis(unittest.TestCase):
+    def setUp(self):
+        self.redis = Redis(redis_addr, port=6379, db=0, password=redis_password)
+        self.sbf = ScalableRedisBloomFilter(self.redis, "scalablebloomfilter", 100)
+        self.sbf.clear()
+
+    def test_add_many(self):
+        self.assertTrue(self.sbf.add_many(range(1000), batch_size=64).all())
+        self.assertTrue(len(self.sbf) == 1000)
+        self.assertTrue(self.sbf.stages > 1)
+        self.assertTrue(self.sbf.contains_many(range(1000)).all())
+        for i in range(1000):
+            self.assertTrue(i in self.sbf, f"{i}居然不在里面")
+        self.assertFalse(self.sbf.add(999))
+
+        # 另一个客户端的阶段数落后，脚本返回后刷新
+        other = ScalableRedisBloomFilter(self.redis, "scalablebloomfilter", 100)
+        self.assertTrue(other.contains_many(range(1000)).all())
+        self.assertTrue(other.stages == self.sbf.stages)
+        self.assertTrue(other.add_many(range(1000, 2000)).all())
+        self.assertTrue(self.sbf.contains_many(range(2000)).all())
+        self.assertTrue(len(self.sbf) == 2000)
+        estimate = self.sbf.estimate_cardinality()
+        self.assertTrue(abs(estimate - 2000) < 100, f"{estimate}")
+
+        self.assertTrue(abs(self.sbf.estimated_items() - 2000) < 100)
+        self.assertTrue(self.sbf.estimated_fpr() < 0.001)
+
+        self.sbf.clear()
+        self.assertNotIn(1, self.sbf)
+        self.assertTrue(self.sbf.stages == 1)
+
+    def test_instrumented(self):
+        events = []
+        sbf = InstrumentedFilter(
+            self.sbf,
+            CallbackSink(lambda *event: events.append(event)),
+            "scalable",
+        )
+        self.assertTrue(sbf.add_many(range(1000), batch_size=100).all())
+        self.assertTrue(sbf.contains_many(range(1000)).all())
+        counters = {}
+        for kind, name, value, labels in events:
+            self.assertTrue(labels["filter"] == "scalable")
+            if kind == "counter":
+                counters[name] = counters.get(name, 0) + value
+        self.assertTrue(counters["adds"] == 1000)
+        self.assertTrue(counters["hits"] == 1000)
+        self.assertTrue(counters["script_calls"] >= 20, f"{counters}")
+        self.assertTrue(counters["script_bytes"] > 0)
+        kinds = {name for kind, name, _, _ in events if kind == "histogram"}
+        self.assertTrue(kinds == {"latency_seconds", "hash_seconds", "io_seconds"})
+
+
+class TestCuckooRedis(unittest.TestCase):
+    def setUp(self):
+        self.redis = Redis(redis_addr, port=6379, db=0, password=redis_password)
+        self.cf = CuckooRedisFilter(
+            self.redis, "cuckoofilter", 10000, 0.00001, chunk_buckets=1000
+        )
+        self.cf.clear()
+
+    def test_add(self):
+        for i in range(1000):
+            self.assertTrue(self.cf.add(i))
+        self.assertFalse(self.cf.add(0))
+        self.assertTrue(self.cf.add_many(range(1000, 9000), batch_size=500).all())
+        self.assertTrue(len(self.cf) == 9000)
+        for i in range(1000):
+            self.assertTrue(i in self.cf, f"{i}居然不在里面")
+        self.assertTrue(self.cf.contains_many(range(9000)).all())
+        self.assertFalse(self.cf.contains_many(range(10**6, 10**6 + 1000)).any())
+
+        self.assertTrue(self.cf.remove(0))
+        self.assertNotIn(0, self.cf, "0居然没有被remove")
+        self.assertFalse(self.cf.remove(0))
+        self.assertTrue(self.cf.remove_many(range(1, 9000)).all())
+        self.assertTrue(len(self.cf) == 0)
+        self.assertFalse(self.cf.contains_many(range(9000)).any())
+
+        small = CuckooRedisFilter(self.redis, "smallcuckoofilter", 10)
+        small.clear()
+        with self.assertRaises(OverflowError):
+            small.add_many(range(1000))
+        self.assertTrue(len(small) == small.capacity)
+        small.clear()
+        self.cf.clear()
+
+
+class TestCachedRedis(unittest.TestCase):
+    def setUp(self):
+        self.redis = Redis(redis_addr, port=6379, db=0, password=redis_password)
+
+    def test_cache(self):
+        cache = PositiveCache(max_entries=500, check_interval=0)
+        bf = ChunkedRedisBloomFilter(
+            self.redis, "cachedbloomfilter", 10000, 0.00001, cache=cache
+        )
+        bf.clear()
+        self.assertTrue(bf.add_many(range(1000)).all())
+        self.assertTrue(len(cache) == 500, f"{len(cache)}")
+        self.assertFalse(bf.add(999))
+        self.assertTrue(cache.hits == 1)
+        self.assertTrue(bf.contains_many(range(1000)).all())
+        self.assertTrue(cache.hits == 501, f"{cache.hits}")
+        self.assertNotIn(1001, bf, "1001居然在里面了")
+        self.assertTrue(len(bf) == 1000)
+
+        other = ChunkedRedisBloomFilter(self.redis, "cachedbloomfilter", 10000, 0.00001)
+        other.clear()  # 其他客户端clear后，代数变化，缓存失效
+        self.assertNotIn(999, bf, "999居然还在缓存里")
+        self.assertTrue(len(cache) == 0)
+
+        sized = PositiveCache(max_bytes=10000)
+        rbf = RedisBloomFilter(self.redis, "cachedbloomfilter2", 10000, cache=sized)
+        rbf.clear()
+        rbf.add_many(range(1000))
+        self.assertTrue(0 < sized.nbytes <= 10000)
+        self.assertTrue(1 in rbf)
+        rbf.clear()
+        self.assertTrue(len(sized) == 0)
+
+
+class TestBufferedRedis(unittest.TestCase):
+    def setUp(self):
+        self.redis = Redis(redis_addr, port=6379, db=0, password=redis_password)
+        self.rbf = RedisBloomFilter(self.redis, "bufferedbloomfilter", 10000, 0.00001)
+        self.rbf.clear()
+
+    def test_add(self):
+        with BufferedFilter(self.rbf, max_pending=100, flush_interval=60) as bf:
+            self.assertTrue(bf.add_many(range(50)).all())
+            self.assertFalse(bf.add(0))
+            self.assertTrue(bf.contains_many(range(50)).all())
+            self.assertTrue(49 in bf, "49居然不在里面")
+            self.assertNotIn(49, self.rbf, "还没有flush，49居然已经在redis里")
+            bf.flush()
+            self.assertTrue(self.rbf.contains_many(range(50)).all())
+            bf.add_many(range(50, 1000))
+        self.assertTrue(len(self.rbf) == 1000)  # close之后全部写入redis
+        self.assertTrue(self.rbf.contains_many(range(1000)).all())
+        with self.assertRaises(RuntimeError):
+            bf.add(1)
+
+        bf = BufferedFilter(self.rbf, flush_interval=0.01, shadow_capacity=10)
+        bf.add_many(range(1000, 1100))
+        for _ in range(100):
+            if not bf._pending:
+                break
+            time.sleep(0.05)
+        self.assertTrue(
+            self.rbf.contains_many(range(1000, 1100)).all(), "后台线程没有写入"
+        )
+        self.assertTrue(bf.shadow.count < 100, "影子过滤器没有重建")
+        self.assertTrue(bf.contains_many(range(1000, 1100)).all())
+        bf.close()
+        self.rbf.clear()
+
+    def test_overflow(self):
+        add_many = self.rbf.add_many
+        down = True
+
+        def flaky_add_many(items):
+            if down:
+                raise ConnectionError("redis is down")
+            return add_many(items)
+
+        self.rbf.add_many = flaky_add_many  # redis不可用，down改成False后恢复
+        with self.assertRaises(ValueError):
+            BufferedFilter(self.rbf, overflow="ignore")
+        bf = BufferedFilter(
+            self.rbf, max_pending=10, flush_interval=0.01, max_buffered=100
+        )
+        bf.add_many(range(100))
+        blocked = threading.Thread(target=bf.add_many, args=(range(100, 150),))
+        blocked.start()
+        blocked.join(0.2)
+        self.assertTrue(blocked.is_alive(), "缓冲区满了add_many应该等待")
+        self.assertTrue(isinstance(bf.last_error, ConnectionError))
+        self.assertTrue(len(bf) == 100, "正在发送的元素也要计入")
+        down = False
+        blocked.join(5)
+        self.assertFalse(blocked.is_alive(), "发送之后add_many没有继续")
+        bf.close()
+        self.assertTrue(self.rbf.contains_many(range(150)).all())
+
+        self.rbf.clear()
+        down = True
+        bf = BufferedFilter(
+            self.rbf,
+            max_pending=10,
+            flush_interval=0.01,
+            max_buffered=100,
+            overflow="drop_oldest",
+        )
+        bf.add_many(range(160))
+        self.assertTrue(bf.dropped == 60, f"{bf.dropped}")
+        down = False
+        bf.close()
+        self.assertTrue(len(self.rbf) == 100)
+
+        # redis不可用时影子过滤器也不能装得过满，否则几乎所有元素都会判断为存在
+        self.rbf.clear()
+        down = True
+        with self.assertRaises(ValueError):
+            BufferedFilter(self.rbf, shadow_capacity=100, max_buffered=1000)
+        bf = BufferedFilter(self.rbf, shadow_capacity=10000, overflow="drop_oldest")
+        bf.add_many(range(100000))
+        self.assertTrue(bf.shadow.count <= 10000, f"{bf.shadow.count}")
+        absent = bf.shadow.contains_many(range(10**6, 10**6 + 10000)).mean()
+        self.assertTrue(absent < 0.01, f"{absent}")
+        down = False
+        bf.close()
+        self.assertTrue(len(self.rbf) == 5000)
+
+        self.rbf.clear()
+        down = True
+        bf = BufferedFilter(
+            self.rbf, max_pending=10, max_buffered=100, overflow="raise"
+        )
+        bf.add_many(range(200, 300))
+        with self.assertRaises(OverflowError):
+            bf.add_many(range(300, 310))
+        self.assertTrue(bf.contains_many(range(300, 310)).sum() < 5, "这一批不应该加入")
+        down = False
+        bf.close()
+        self.assertTrue(len(self.rbf) == 100)
+        self.rbf.clear()
+
+
+class FakeCluster:
+    """把单机redis当成3个节点的集群，只实现过滤器用到的接口"""
+
+    class Node:
+        def __init__(self, name):
+            self.name = name
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.nodes = set()
+
+    def get_node_from_key(self, key):
+        node = self.Node(str(key_slot(key) * 3 // 16384))
+        self.nodes.add(node.name)
+        return node
+
+    def pipeline(self, transaction=None):
+        return self.redis.pipeline(transaction=False)
+
+    def __getattr__(self, name):
+        return getattr(self.redis, name)
+
+
+class TestClusterRedis(unittest.TestCase):
+    def setUp(self):
+        self.redis = Redis(redis_addr, port=6379, db=0, password=redis_password)
+        self.cluster = FakeCluster(self.redis)
+
+    def test_spread(self):
+        bf = ChunkedRedisBloomFilter(
+            self.cluster,
+            "clusterbloomfilter",
+            10000,
+            0.00001,
+            cluster=True,
+            chunk_num=8,
+        )
+        slots = [key_slot(key) for key in bf.chunk_keys]
+        self.assertTrue(len(slots) == 8)
+        self.assertTrue(
+            all((b - a) % 16384 == 2048 for a, b in zip(slots, slots[1:])), f"{slots}"
+        )
+        bf.clear()
+        self.assertTrue(bf.add_many(range(1000), batch_size=100).all())
+        self.assertTrue(self.cluster.nodes == {"0", "1", "2"}, "没有分散到所有节点")
+        self.assertFalse(bf.add_many(range(1000)).any())
+        result = bf.contains_many(list(range(2000)))
+        self.assertTrue(result[:1000].all())
+        self.assertTrue(result[1000:].sum() < 5, "误判太多")
+        for i in range(1000):
+            self.assertTrue(i in bf, f"{i}居然不在里面")
+        self.assertTrue(len(bf) == 1000)
+        estimate = bf.estimate_cardinality()
+        self.assertTrue(abs(estimate - 1000) < 50, f"{estimate}")
+        bf.clear()
+        self.assertFalse(bf.contains_many(range(1000)).any())
+        self.assertTrue(len(bf) == 0)
+
+    def test_hash_tag(self):
+        sbf = ScalableRedisBloomFilter(
+            self.cluster, "clusterscalable", 100, 0.001, cluster=True
+        )
+        sbf.clear()
+        self.assertTrue(sbf.add_many(range(1000), batch_size=100).all())
+        self.assertTrue(sbf.contains_many(range(1000)).all())
+        keys = [sbf.meta_key] + [f.key for f in sbf.filters]
+        self.assertTrue(len({key_slot(key) for key in keys}) == 1, f"{keys}")
+        sbf.clear()
+        cf = CuckooRedisFilter(
+            self.cluster, "clustercuckoo", 10000, chunk_buckets=256, cluster=True
+        )
+        cf.clear()
+        self.assertTrue(len({key_slot(key) for key in cf.chunk_keys}) == 1)
+        self.assertTrue(cf.add_many(range(1000), batch_size=100).all())
+        self.assertTrue(cf.remove_many(range(1000)).all())
+        cf.clear()
+
+    def test_union_slot(self):
+        a = RedisBloomFilter(self.cluster, "{clusterunion}a", 10000)
+        b = RedisBloomFilter(self.cluster, "{clusterunion}b", 10000)
+        a.clear()
+        b.clear()
+        b.add_many(range(100))
+        a |= b  # 相同的hash tag，在同一个slot
+        self.assertTrue(a.contains_many(range(100)).all())
+        with self.assertRaises(ValueError):
+            a.update(RedisBloomFilter(self.cluster, "clusterunion:c", 10000))
+        a.clear()
+        b.clear()
+
+
 if __name__ == "__main__":
     unittest.main()